@@ -1,10 +1,28 @@
-from flask import Flask, request, jsonify
-import requests
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 import base64
+import json
+import logging
+import threading
+import time
 from flask_cors import CORS, cross_origin
 import inference_module
-import math
+from image_handle import ImageHandle
+import tile_cache
+import inference_cache
+import wayback
+from wayback import fetch_tile
+import scan_pipeline
+from scan_pipeline import save_to_database
+import jobs
+import area_scan
+from tile_math import latlon_to_tile
 import psycopg2
+import db
+import image_store
+import image_index
+import metrics
+import violations_query
+import upstream_limiter
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from dotenv import load_dotenv
@@ -13,6 +31,9 @@ import os
 # Load environment variables from .env file
 load_dotenv()
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 CORS(app)
 
@@ -29,117 +50,34 @@ api_url = os.getenv("API_URL")
 project_id = os.getenv("PROJECT_ID")
 model_version = int(os.getenv("MODEL_VERSION"))
 
-import psycopg2
-
-
-def latlon_to_tile(lat, lon, zoom):
-    lat_rad = math.radians(lat)
-    n = 2.0**zoom
-    xtile = int((lon + 180.0) / 360.0 * n)
-    ytile = int(
-        (1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi)
-        / 2.0
-        * n
-    )
-    return xtile, ytile
-
-
-def fetch_tile(version, zoom, x, y):
-    url = f"https://wayback.maptiles.arcgis.com/arcgis/rest/services/World_Imagery/MapServer/tile/{version}/{zoom}/{y}/{x}"
-    print(url)
-    headers = {
-        "Referer": "https://livingatlas.arcgis.com/",
-        "Origin": "https://livingatlas.arcgis.com",
-        "sec-ch-ua": '"Not)A;Brand";v="99", "Google Chrome";v="127", "Chromium";v="127"',
-        "sec-ch-ua-mobile": "?0",
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36",
-        "sec-ch-ua-platform": '"Windows"',
-    }
-
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.content
-    else:
-        return None
-
-
-def fetch_and_encode_tile(version, zoom, x, y):
-    tile_data = fetch_tile(version, zoom, x, y)
-    if tile_data:
-        return base64.b64encode(tile_data).decode("utf-8")
-    else:
-        return None
-
 
-def save_to_database(
-    description, latitude, longitude, county, severity, status, before_img, after_img
-):
-
-    connection = None
-    try:
-
-
-        connection = psycopg2.connect(os.getenv("DATABASE_URL"))
-
-        cursor = connection.cursor()
-
-        insert_query = """
-        INSERT INTO violations (description, latitude, longitude, county, severity, status, before_img, after_img)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id;
-        """
-
-        cursor.execute(
-            insert_query,
-            (
-                description,
-                latitude,
-                longitude,
-                county,
-                severity,
-                status,
-                before_img,
-                after_img,
-            ),
-        )
-        new_id = cursor.fetchone()[0]
-
-        connection.commit()
-        cursor.close()
-        connection.close()
+# Per-request counters and latency, exported on /metrics instead of printed
+@app.before_request
+def before_request():
+    g.request_started = time.perf_counter()
 
-        return new_id
 
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(f"Error: {error}")
-        if connection is not None:
-            connection.rollback()
-            cursor.close()
-            connection.close()
-        return (
-            jsonify({"error": "Failed to save processed images to the database"}),
-            500,
+@app.after_request
+def after_request(response):
+    started = g.pop("request_started", None)
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.HTTP_REQUESTS.inc(
+        method=request.method, endpoint=endpoint, status=response.status_code
+    )
+    if started is not None:
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started, endpoint=endpoint
         )
+    return response
 
 
-request_count = 0
-
-# Define ANSI escape codes for colors
-GREEN = "\033[92m"
-YELLOW = "\033[93m"
-RESET = "\033[0m"
-
-
-# Middleware to increment request count
-@app.before_request
-def before_request():
-    global request_count
-    request_count += 1
-
-    # Print the colored output
-    print(f"{GREEN}request:{RESET} {YELLOW}{request_count}{RESET}")
-
-import random
+# Wayback is throttling us or its circuit is open, the client should back off
+@app.errorhandler(upstream_limiter.UpstreamBusy)
+def upstream_busy(error):
+    response = jsonify({"error": str(error), "retry_after": error.retry_after})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
 
 
 @app.route("/submit_scan", methods=["GET"])
@@ -149,7 +87,7 @@ def get_tile():
 
     x = request.args.get("x")
     y = request.args.get("y")
-    zoom = 18
+    zoom = scan_pipeline.ZOOM
 
     if not x or not y:
         return jsonify({"error": "Please provide both x and y coordinates"}), 400
@@ -164,105 +102,125 @@ def get_tile():
         # Convert to tile coordinates
         xtile, ytile = latlon_to_tile(lat, lon, zoom)
 
-        print(f"Tile coordinates for lat: {lat}, lon: {lon} at zoom level {zoom}:")
-        print(f"Column: {xtile}, Row: {ytile}")
+        log.debug("Tile for lat %s, lon %s at zoom %s: column %s, row %s", lat, lon, zoom, xtile, ytile)
     except ValueError:
         return jsonify({"error": "Error Translating coordinates"}), 400
 
-    years_versions = {
-        "2024-03-07": "60013",
-        # "2023-06-13": "25982",
-        "2023-02-23": "57965",
-        #  "2017-10-04": "15212",
-        # "2016-10-25": "4222",
-    }
-    zoom_level = zoom
-
-    tiles = {}
-    for year, version in years_versions.items():
-        encoded_tile = fetch_and_encode_tile(version, zoom_level, xtile, ytile)
-        if encoded_tile:
-            tiles[year] = encoded_tile
-        else:
-            return jsonify({"error": f"Failed to fetch tile for year {year}"}), 500
-
-    processed_images,percentage_difference = inference_module.main(
-        api_key, api_url, project_id, model_version, tiles
+    if request.args.get("async") == "1":
+        # Only enqueue, the client polls /scan_jobs/<id> or its events stream
+        try:
+            job_id = jobs.get_job_queue().submit(
+                lat, lon, key=scan_pipeline.scan_key(xtile, ytile, zoom)
+            )
+        except jobs.QueueFull as error:
+            return jsonify({"error": str(error)}), 503
+        return (
+            jsonify(
+                {
+                    "job_id": job_id,
+                    "status_url": f"/scan_jobs/{job_id}",
+                    "events_url": f"/scan_jobs/{job_id}/events",
+                }
+            ),
+            202,
+        )
+
+    try:
+        result = scan_pipeline.run_scan(lat, lon, zoom)
+    except scan_pipeline.ScanError as error:
+        return jsonify({"error": str(error)}), 500
+
+    return jsonify(result)
+
+
+@app.route("/area_scan", methods=["POST"])
+@cross_origin()  # Allow CORS for this route
+def area_scan_route():
+    # Streams newline-delimited JSON events (start, result/error per tile,
+    # periodic progress, done) while the covering tiles are scanned
+    payload = request.get_json(silent=True) or {}
+    zoom = scan_pipeline.ZOOM
+
+    try:
+        tiles = area_scan.parse_area(payload, zoom)
+    except area_scan.AreaScanError as error:
+        return jsonify({"error": str(error)}), 400
+
+    cancelled = threading.Event()
+
+    def generate():
+        try:
+            for event in area_scan.run_area_scan(tiles, zoom, cancelled=cancelled):
+                yield json.dumps(event) + "\n"
+        finally:
+            # Client went away, stop scheduling new tiles
+            cancelled.set()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"},
     )
 
-    if percentage_difference == None:
-        percentage_difference = 0
 
+@app.route("/scan_jobs", methods=["POST"])
+@cross_origin()  # Allow CORS for this route
+def submit_scan_job():
     try:
-        percentage_difference = percentage_difference.__round__(2)
-    except:
-        percentage_difference = 0
+        lat = float(request.args.get("x"))
+        lon = float(request.args.get("y"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Please provide both x and y coordinates"}), 400
 
-    
-    # for year, (image, area) in processed_images.items():
-    #     print(f"Detected hedge with area: {area:.2f} square pixels in { year }")
-
-    # Example data, replace with actual data from processed_images
-
-    description = str(percentage_difference) + "% - "+ "Illegal trimming of hedges"
-        
-        
-    # latitude = 53
-    # longitude = -6
-    county = "Cork"
-    severity = percentage_difference
-    status = "pending"
-    # before_img = "a"
-
-    # after_img = "b"
-    if len(processed_images) < 2:
-        return jsonify({"error": "Not enough processed images returned"}), 500
-
-    # Extract the first and second values from the JSON object
-    processed_values = list(processed_images.values())
-    if len(processed_values) < 2:
-        return jsonify({"error": "Not enough values in processed images"}), 500
-
-    # if (len(processed_images) >= 2):
-    # print(processed_images)
-    print("lat", lat, "lon", lon)
-    inserted_id = save_to_database(
-        description,
-        lat,
-        lon,
-        county,
-        severity,
-        status,
-        processed_values[0],
-        processed_values[1],
-    )
+    xtile, ytile = latlon_to_tile(lat, lon, scan_pipeline.ZOOM)
+    try:
+        job_id = jobs.get_job_queue().submit(
+            lat, lon, key=scan_pipeline.scan_key(xtile, ytile, scan_pipeline.ZOOM)
+        )
+    except jobs.QueueFull as error:
+        return jsonify({"error": str(error)}), 503
 
-    # try:
-    #     print("1", processed_images["2024-03-07"][1])
-    #     print("2", processed_images["2023-02-23"][1])
-    #     difference = (
-    #         (
-    #             (
-    #                 float(processed_images["2024-03-07"][1])
-    #                 - float(processed_images["2023-02-23"][1])
-    #             )
-    #             / float(processed_images["2023-02-23"][1])
-    #         )
-    #         * 100
-    #     ).__round__(2)
-    # except:
-    #     difference = 0
+    return jsonify({"job_id": job_id, "status_url": f"/scan_jobs/{job_id}"}), 202
 
-    return jsonify(
-        {
-            "processed_images": processed_images,
-            "new_id": inserted_id,
-            "difference": percentage_difference
-    })
-    # return jsonify(processed_images)
 
+@app.route("/scan_jobs/stats", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+@limiter.exempt
+def scan_job_stats():
+    return jsonify(jobs.get_job_queue().stats())
 
-import os
+
+@app.route("/scan_jobs/<job_id>", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+@limiter.exempt
+def get_scan_job(job_id):
+    job = jobs.get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify(job)
+
+
+@app.route("/scan_jobs/<job_id>/events", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+@limiter.exempt
+def scan_job_events(job_id):
+    queue = jobs.get_job_queue()
+    if queue.get(job_id) is None:
+        return jsonify({"error": "Unknown job"}), 404
+
+    def generate():
+        # Server-sent events, one per status change, ends once the job finishes
+        last_status = None
+        for job in queue.watch(job_id):
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield f"event: {job['status']}\ndata: {json.dumps(job)}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/submit_images", methods=["GET"])
@@ -273,34 +231,170 @@ def process_images():
     images = {}
 
     for filename in os.listdir("images"):
-        with open(f"images/{filename}", "rb") as file:
-            encoded_image = base64.b64encode(file.read()).decode("utf-8")
-            images[filename] = encoded_image
+        images[filename] = ImageHandle.from_path(f"images/{filename}")
 
-    processed_images = inference_module.main(
+    processed_images, percentage_difference = inference_module.main(
         api_key, api_url, project_id, model_version, images
     )
 
-    processed_values = list(processed_images.values())
-
     #  save results to /ssed
+    index = image_index.get_index()
     for filename, image in processed_images.items():
-        with open(f"ssed/{filename}", "wb") as file:
-            file.write(base64.b64decode(image))
+        index.save(filename, image)
+
+    return jsonify(
+        {
+            "processed_images": {
+                filename: image.to_base64()
+                for filename, image in processed_images.items()
+            },
+            "difference": percentage_difference,
+        }
+    )
+
+
+@app.route("/images/<key>", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+def get_stored_image(key):
+    if not image_store.is_valid_key(key):
+        return jsonify({"error": "Invalid image key"}), 400
+
+    store = image_store.get_store()
+    etag = key.split(".")[0]
+    content_type = image_store.content_type_for(key)
+
+    if isinstance(store, image_store.LocalImageStore):
+        path = store.path(key)
+        if not os.path.exists(path):
+            return jsonify({"error": "Image not found"}), 404
+        # send_file handles If-None-Match/If-Modified-Since and Range requests
+        response = send_file(
+            path, mimetype=content_type, conditional=True, etag=etag, max_age=31536000
+        )
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
 
-    return jsonify({"processed_images": processed_images, "new_id": inserted_id})
+    # Keys are content hashes so the ETag never changes for a key
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    try:
+        stored = store.get_range(key, request.headers.get("Range"))
+    except Exception as error:
+        log.error("Error reading image %s: %s", key, error)
+        return jsonify({"error": "Image not found"}), 404
+
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(stored["ContentLength"]),
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    status = 200
+    if stored.get("ContentRange"):
+        headers["Content-Range"] = stored["ContentRange"]
+        status = 206
+
+    return Response(
+        stored["Body"].iter_chunks(chunk_size=64 * 1024),
+        status=status,
+        headers=headers,
+        mimetype=content_type,
+    )
+
+
+@app.route("/violations", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+def list_violations():
+    # ?bbox=min_lon,min_lat,max_lon,max_lat&county=&status=&min_severity=
+    # &max_severity=&after=<cursor>&limit=
+    try:
+        bbox = request.args.get("bbox")
+        page = violations_query.query_violations(
+            bbox=violations_query.parse_bbox(bbox) if bbox else None,
+            county=request.args.get("county"),
+            status=request.args.get("status"),
+            min_severity=request.args.get("min_severity", type=float),
+            max_severity=request.args.get("max_severity", type=float),
+            after_id=request.args.get("after", type=int),
+            limit=request.args.get("limit", violations_query.VIOLATIONS_PAGE_SIZE, type=int),
+        )
+    except violations_query.QueryError as error:
+        return jsonify({"error": str(error)}), 400
+    except psycopg2.Error as error:
+        log.error("Error querying violations: %s", error)
+        return jsonify({"error": "Error querying violations"}), 500
+
+    return jsonify(page)
 
 
 @app.route("/all_imgs", methods=["GET"])
 @cross_origin()  # Allow CORS for this route
 def get_all_images():
-    images = {}
-    for filename in os.listdir("ssed"):
-        with open(f"ssed/{filename}", "rb") as file:
-            encoded_image = base64.b64encode(file.read()).decode("utf-8")
-            images[filename] = encoded_image
+    # ?after=<cursor>&limit=, images themselves are fetched from /all_imgs/<name>
+    page = image_index.get_index().page(
+        after=request.args.get("after"),
+        limit=request.args.get("limit", image_index.IMAGE_INDEX_PAGE_SIZE, type=int),
+    )
+    for item in page["images"]:
+        item["url"] = f"/all_imgs/{item['name']}"
+
+    response = jsonify(page)
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route("/all_imgs/<name>", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+def get_processed_image(name):
+    index = image_index.get_index()
+    # Only names present in the index are served, nothing outside ssed/
+    entry = index.get(name)
+    if entry is None:
+        return jsonify({"error": "Image not found"}), 404
+
+    # Files can be overwritten by the next run, so clients revalidate: send_file
+    # sets ETag/Last-Modified from the file and answers 304 when unchanged
+    response = send_file(
+        index.path(name), mimetype=entry["mime_type"], conditional=True, max_age=0
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@app.route("/tile_cache_stats", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+def get_tile_cache_stats():
+    cache = tile_cache.get_default_cache()
+    if cache is None:
+        return jsonify({"enabled": False})
+
+    return jsonify({"enabled": True, **cache.stats()})
+
+
+@app.route("/inference_cache_stats", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+def get_inference_cache_stats():
+    cache = inference_cache.get_cache(project_id, model_version)
+    if cache is None:
+        return jsonify({"enabled": False})
+
+    return jsonify({"enabled": True, **cache.stats()})
+
+@app.route("/scan_cache_stats", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+def get_scan_cache_stats():
+    return jsonify(scan_pipeline.scan_stats())
+
+@app.route("/upstream_stats", methods=["GET"])
+@cross_origin()  # Allow CORS for this route
+def get_upstream_stats():
+    return jsonify(upstream_limiter.stats())
 
-    return jsonify(images)
+@app.route("/metrics", methods=["GET"])
+@limiter.exempt
+def get_metrics():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
 
 @app.route("/test", methods=["GET"])
 @cross_origin()  # Allow CORS for this route
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from shapely.geometry import box, shape
+from shapely.prepared import prep
+
+import image_store
+import scan_pipeline
+import upstream_limiter
+from tile_math import latlon_to_tile, tile_bounds, tile_center
+
+AREA_SCAN_MAX_TILES = int(os.getenv("AREA_SCAN_MAX_TILES", 5000))
+AREA_SCAN_WORKERS = int(os.getenv("AREA_SCAN_WORKERS", 4))
+# Emit a progress event at least this often even if no tile finished
+AREA_SCAN_PROGRESS_INTERVAL = float(os.getenv("AREA_SCAN_PROGRESS_INTERVAL", 2))
+
+
+class AreaScanError(Exception):
+    pass
+
+
+def tile_range(min_lat, min_lon, max_lat, max_lon, zoom):
+    # Tile rows grow southwards, so the north edge gives the smallest row
+    min_x, min_y = latlon_to_tile(max_lat, min_lon, zoom)
+    max_x, max_y = latlon_to_tile(min_lat, max_lon, zoom)
+    return min_x, min_y, max_x, max_y
+
+
+def tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, zoom):
+    min_x, min_y, max_x, max_y = tile_range(min_lat, min_lon, max_lat, max_lon, zoom)
+    for ytile in range(min_y, max_y + 1):
+        for xtile in range(min_x, max_x + 1):
+            yield xtile, ytile
+
+
+def count_tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, zoom):
+    min_x, min_y, max_x, max_y = tile_range(min_lat, min_lon, max_lat, max_lon, zoom)
+    return (max_x - min_x + 1) * (max_y - min_y + 1)
+
+
+def tiles_in_polygon(geometry, zoom):
+    # geometry is a shapely geometry in lon/lat, e.g. a county boundary
+    min_lon, min_lat, max_lon, max_lat = geometry.bounds
+    prepared = prep(geometry)
+    for xtile, ytile in tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, zoom):
+        if prepared.intersects(box(*tile_bounds(xtile, ytile, zoom))):
+            yield xtile, ytile
+
+
+def parse_area(payload, zoom):
+    # Accepts {"bbox": {"min_lat", "min_lon", "max_lat", "max_lon"}} or
+    # {"polygon": <GeoJSON geometry>} and returns the list of covering tiles
+    if "bbox" in payload:
+        bbox = payload["bbox"]
+        try:
+            min_lat, min_lon = float(bbox["min_lat"]), float(bbox["min_lon"])
+            max_lat, max_lon = float(bbox["max_lat"]), float(bbox["max_lon"])
+        except (KeyError, TypeError, ValueError):
+            raise AreaScanError("bbox needs numeric min_lat, min_lon, max_lat, max_lon")
+        if min_lat > max_lat or min_lon > max_lon:
+            raise AreaScanError("bbox minimums must not exceed maximums")
+        if count_tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, zoom) > AREA_SCAN_MAX_TILES:
+            raise AreaScanError(f"Area covers more than {AREA_SCAN_MAX_TILES} tiles")
+        return list(tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, zoom))
+
+    if "polygon" in payload:
+        try:
+            geometry = shape(payload["polygon"])
+        except Exception:
+            raise AreaScanError("polygon must be a GeoJSON Polygon or MultiPolygon")
+        if geometry.is_empty or geometry.geom_type not in ("Polygon", "MultiPolygon"):
+            raise AreaScanError("polygon must be a GeoJSON Polygon or MultiPolygon")
+        min_lon, min_lat, max_lon, max_lat = geometry.bounds
+        if count_tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, zoom) > AREA_SCAN_MAX_TILES:
+            raise AreaScanError(f"Area covers more than {AREA_SCAN_MAX_TILES} tiles")
+        return list(tiles_in_polygon(geometry, zoom))
+
+    raise AreaScanError("Provide either a bbox or a polygon")
+
+
+def scan_one(xtile, ytile, zoom):
+    lat, lon = tile_center(xtile, ytile, zoom)
+    try:
+        # A sweep waits out upstream busy periods instead of failing tiles
+        scan = upstream_limiter.wait_out(scan_pipeline.scan_tile, xtile, ytile, zoom)
+    except Exception as error:
+        return {
+            "type": "error",
+            "xtile": xtile,
+            "ytile": ytile,
+            "lat": lat,
+            "lon": lon,
+            "error": str(error),
+        }
+
+    store = image_store.get_store()
+    return {
+        "type": "result",
+        "xtile": xtile,
+        "ytile": ytile,
+        "lat": lat,
+        "lon": lon,
+        "difference": scan["percentage_difference"],
+        "unchanged": scan.get("unchanged", False),
+        "loss_area_m2": scan["geo"]["loss_area_m2"],
+        "gain_area_m2": scan["geo"]["gain_area_m2"],
+        "loss": scan["geo"]["loss"],
+        "image_urls": {
+            key: f"/images/{store.put(image)['key']}"
+            for key, image in scan["processed_images"].items()
+        },
+    }
+
+
+def run_area_scan(tiles, zoom, workers=AREA_SCAN_WORKERS, cancelled=None):
+    # Generator of progress/result events. At most workers * 2 tiles are in
+    # flight so a county-sized sweep never queues thousands of futures, and
+    # results are yielded as soon as each tile finishes.
+    cancelled = cancelled or threading.Event()
+    total = len(tiles)
+    done = 0
+    failed = 0
+    started = time.monotonic()
+    last_progress = 0.0
+
+    yield {"type": "start", "total": total, "zoom": zoom}
+
+    pending = iter(tiles)
+    in_flight = set()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="area-scan")
+    try:
+        while not cancelled.is_set():
+            while len(in_flight) < workers * 2:
+                try:
+                    xtile, ytile = next(pending)
+                except StopIteration:
+                    break
+                in_flight.add(executor.submit(scan_one, xtile, ytile, zoom))
+
+            if not in_flight:
+                break
+
+            finished, in_flight = wait(
+                in_flight, timeout=AREA_SCAN_PROGRESS_INTERVAL, return_when=FIRST_COMPLETED
+            )
+            for future in finished:
+                event = future.result()
+                done += 1
+                if event["type"] == "error":
+                    failed += 1
+                yield event
+
+            now = time.monotonic()
+            if now - last_progress >= AREA_SCAN_PROGRESS_INTERVAL or not in_flight:
+                last_progress = now
+                yield {
+                    "type": "progress",
+                    "done": done,
+                    "failed": failed,
+                    "total": total,
+                    "elapsed": round(now - started, 2),
+                }
+    finally:
+        # Also runs on GeneratorExit when the client disconnects mid-yield,
+        # queued tiles are dropped and running ones aren't waited for
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    yield {
+        "type": "done",
+        "done": done,
+        "failed": failed,
+        "total": total,
+        "cancelled": cancelled.is_set(),
+        "elapsed": round(time.monotonic() - started, 2),
+    }
@@ -0,0 +1,113 @@
+import os
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+
+import archive_scraper_api
+import async_scan
+import jobs
+import metrics
+import scan_pipeline
+import upstream_limiter
+from tile_math import latlon_to_tile
+
+# Async serving mode: `python asgi_app.py` (or `uvicorn asgi_app:app --port
+# 3001`). /submit_scan runs on asyncio, see async_scan.py; every other route is
+# the Flask app from archive_scraper_api served through a WSGI bridge, so both
+# modes expose the same API.
+
+ASGI_HOST = os.getenv("ASGI_HOST", "0.0.0.0")
+ASGI_PORT = int(os.getenv("ASGI_PORT", 3001))
+# Threads running the Flask routes
+ASGI_WSGI_WORKERS = int(os.getenv("ASGI_WSGI_WORKERS", 10))
+
+scanner = async_scan.AsyncScanner()
+
+
+async def submit_scan(request):
+    x = request.query_params.get("x")
+    y = request.query_params.get("y")
+    zoom = scan_pipeline.ZOOM
+
+    if not x or not y:
+        return JSONResponse({"error": "Please provide both x and y coordinates"}, 400)
+
+    try:
+        lat = float(x)
+        lon = float(y)
+        xtile, ytile = latlon_to_tile(lat, lon, zoom)
+    except ValueError:
+        return JSONResponse({"error": "Error Translating coordinates"}, 400)
+
+    if request.query_params.get("async") == "1":
+        # Only enqueue, the client polls /scan_jobs/<id> or its events stream
+        try:
+            job_id = jobs.get_job_queue().submit(
+                lat, lon, key=scan_pipeline.scan_key(xtile, ytile, zoom)
+            )
+        except jobs.QueueFull as error:
+            return JSONResponse({"error": str(error)}, 503)
+        return JSONResponse(
+            {
+                "job_id": job_id,
+                "status_url": f"/scan_jobs/{job_id}",
+                "events_url": f"/scan_jobs/{job_id}/events",
+            },
+            202,
+        )
+
+    try:
+        result = await scanner.run_scan(lat, lon, zoom)
+    except scan_pipeline.ScanError as error:
+        return JSONResponse({"error": str(error)}, 500)
+
+    return JSONResponse(result)
+
+
+async def scan_cache_stats(request):
+    return JSONResponse(scanner.stats())
+
+
+async def get_metrics(request):
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+async def upstream_busy(request, error):
+    return JSONResponse(
+        {"error": str(error), "retry_after": error.retry_after},
+        503,
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await scanner.start()
+    try:
+        yield
+    finally:
+        await scanner.close()
+
+
+app = Starlette(
+    routes=[
+        Route("/submit_scan", submit_scan, methods=["GET"]),
+        Route("/scan_cache_stats", scan_cache_stats, methods=["GET"]),
+        Route("/metrics", get_metrics, methods=["GET"]),
+        Mount("/", app=WSGIMiddleware(archive_scraper_api.app, workers=ASGI_WSGI_WORKERS)),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"])],
+    exception_handlers={upstream_limiter.UpstreamBusy: upstream_busy},
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host=ASGI_HOST, port=ASGI_PORT)
@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import aiohttp
+import asyncpg
+
+import db
+import image_store
+import inference_cache
+import inference_module
+import metrics
+import mosaic
+import preprocessing
+import scan_pipeline
+import tile_cache
+import upstream_limiter
+import wayback
+from image_handle import ImageHandle
+from scan_pipeline import ScanError
+from singleflight import AsyncSingleFlight
+from tile_math import latlon_to_tile
+
+log = logging.getLogger(__name__)
+
+# The /submit_scan pipeline on asyncio for asgi_app.py. Upstream I/O (Wayback
+# over aiohttp, the inference server through infer_async, Postgres through
+# asyncpg) only parks a coroutine, so one process can keep hundreds of scans
+# in flight. Diffing and rendering run in an executor, blocking cache and
+# image store calls in the default thread pool.
+
+ASYNC_WAYBACK_CONNECTIONS = int(os.getenv("ASYNC_WAYBACK_CONNECTIONS", 100))
+# "process" sidesteps the GIL for diff/render, "thread" avoids pickling
+ASYNC_CPU_EXECUTOR = os.getenv("ASYNC_CPU_EXECUTOR", "process")
+ASYNC_CPU_WORKERS = int(os.getenv("ASYNC_CPU_WORKERS", os.cpu_count() or 2))
+ASYNC_DB_POOL_MAX = int(os.getenv("ASYNC_DB_POOL_MAX", 20))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class AsyncScanner:
+    def __init__(self):
+        self.http = None
+        self.client = None
+        self.db_pool = None
+        self.cpu = None
+        self.scans = AsyncSingleFlight(
+            scan_pipeline.SCAN_RESULT_TTL, scan_pipeline.SCAN_RESULT_CACHE_ITEMS
+        )
+
+    async def start(self):
+        self.http = aiohttp.ClientSession(
+            headers=wayback.HEADERS,
+            timeout=aiohttp.ClientTimeout(total=wayback.WAYBACK_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=ASYNC_WAYBACK_CONNECTIONS),
+        )
+        self.client = inference_module.configure_client(
+            scan_pipeline.api_key, scan_pipeline.api_url
+        )
+        self.db_pool = await asyncpg.create_pool(
+            os.getenv("DATABASE_URL"), min_size=db.DB_POOL_MIN, max_size=ASYNC_DB_POOL_MAX
+        )
+
+        if ASYNC_CPU_EXECUTOR == "process":
+            self.cpu = ProcessPoolExecutor(
+                max_workers=ASYNC_CPU_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        else:
+            self.cpu = ThreadPoolExecutor(
+                max_workers=ASYNC_CPU_WORKERS, thread_name_prefix="scan-cpu"
+            )
+
+    async def close(self):
+        await self.http.close()
+        await self.db_pool.close()
+        self.cpu.shutdown(wait=False, cancel_futures=True)
+
+    async def fetch_tile(self, version, zoom, x, y):
+        cache = tile_cache.get_default_cache()
+        if cache is not None:
+            cached = await asyncio.to_thread(cache.get, version, zoom, x, y)
+            if cached is not None:
+                metrics.CACHE_REQUESTS.inc(cache="tile", result="hit")
+                return cached
+            metrics.CACHE_REQUESTS.inc(cache="tile", result="miss")
+
+        url = wayback.tile_url(version, zoom, x, y)
+        limiter = upstream_limiter.get_limiter(url)
+        # Same retry policy as wayback.fetch_tile: 5xx and connection errors
+        # back off, 429s wait for the limiter
+        for attempt in range(wayback.WAYBACK_RETRIES + 1):
+            await limiter.acquire_async()
+            try:
+                async with self.http.get(url) as response:
+                    status = response.status
+                    retry_after = response.headers.get("Retry-After")
+                    data = await response.read() if status == 200 else None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                limiter.record(None)
+                metrics.UPSTREAM_RESPONSES.inc(upstream="wayback", status="error")
+                log.warning("Error fetching %s: %s", url, error)
+                status = None
+                data = None
+            else:
+                limiter.record(status, retry_after)
+                metrics.UPSTREAM_RESPONSES.inc(upstream="wayback", status=status)
+
+            if status is not None and status not in RETRY_STATUSES:
+                break
+            if status != 429 and attempt < wayback.WAYBACK_RETRIES:
+                await asyncio.sleep(wayback.WAYBACK_BACKOFF * (2**attempt))
+        else:
+            if status == 429:
+                raise limiter.busy("rate limited by upstream")
+
+        if data is not None and cache is not None:
+            await asyncio.to_thread(cache.put, version, zoom, x, y, data)
+        return data
+
+    async def fetch_tiles(self, requests_by_key):
+        with metrics.span("fetch"):
+            keys = list(requests_by_key)
+            tiles = await asyncio.gather(
+                *(self.fetch_tile(*requests_by_key[key]) for key in keys)
+            )
+        return dict(zip(keys, tiles))
+
+    async def infer_cached(self, images):
+        # inference_module.infer_cached with the blocking parts (sqlite cache,
+        # decoding and preprocessing) in threads and the HTTP call awaited
+        project_id, model_version = scan_pipeline.project_id, scan_pipeline.model_version
+        cache = inference_cache.get_cache(project_id, model_version)
+        config = preprocessing.config_key()
+        keys = [image.digest if config is None else f"{image.digest}:{config}" for image in images]
+        cached = await asyncio.to_thread(cache.get_many, keys) if cache is not None else {}
+        metrics.CACHE_REQUESTS.inc(len(cached), cache="inference", result="hit")
+        metrics.CACHE_REQUESTS.inc(len(keys) - len(cached), cache="inference", result="miss")
+
+        missing = {}
+        for key, image in zip(keys, images):
+            if key not in cached and key not in missing:
+                missing[key] = image
+
+        fresh = {}
+        if missing:
+            prepared = await asyncio.to_thread(preprocessing.prepare, list(missing.values()))
+            metrics.INFERENCE_IMAGES.inc(len(prepared))
+            try:
+                with metrics.span("inference"):
+                    results = await self.client.infer_async(
+                        prepared, model_id=f"{project_id}/{model_version}"
+                    )
+            except Exception as error:
+                metrics.INFERENCE_ERRORS.inc(error=type(error).__name__)
+                metrics.UPSTREAM_RESPONSES.inc(
+                    upstream="inference", status=getattr(error, "status_code", None) or "error"
+                )
+                raise
+            metrics.UPSTREAM_RESPONSES.inc(upstream="inference", status=200)
+            if not isinstance(results, list):
+                results = [results]
+            fresh = dict(zip(missing.keys(), results))
+            if cache is not None:
+                await asyncio.to_thread(cache.put_many, fresh)
+
+        return [cached[key] if key in cached else fresh[key] for key in keys]
+
+    async def scan_tile(self, xtile, ytile, zoom, years_versions):
+        timings = {}
+        loop = asyncio.get_running_loop()
+        if len(years_versions) < 2:
+            return scan_pipeline.unchanged_scan(xtile, ytile, zoom, years_versions, timings)
+
+        started = time.perf_counter()
+        if mosaic.SCAN_MOSAIC_RADIUS > 0:
+            radius = mosaic.SCAN_MOSAIC_RADIUS
+            fetched = await self.fetch_tiles(
+                mosaic.mosaic_requests(years_versions, zoom, xtile, ytile, radius)
+            )
+            timings["fetch"] = time.perf_counter() - started
+
+            started = time.perf_counter()
+            mosaics = await asyncio.to_thread(
+                mosaic.build_mosaics, years_versions, fetched, radius
+            )
+            tiles = {}
+            for year, year_mosaic in mosaics.items():
+                if year_mosaic.center is None:
+                    raise ScanError(f"Failed to fetch tile for year {year}")
+                tiles[year] = year_mosaic.center
+            unchanged = await asyncio.to_thread(
+                scan_pipeline.precheck, xtile, ytile, zoom, tiles, timings
+            )
+            if unchanged is not None:
+                return unchanged
+            year_windows, flat = mosaic.plan_windows(mosaics)
+            responses = await self.infer_cached(flat)
+            results = await asyncio.to_thread(
+                mosaic.merge_responses, mosaics, year_windows, responses
+            )
+            timings["mosaic_inference"] = time.perf_counter() - started
+        else:
+            fetched = await self.fetch_tiles(
+                {
+                    year: (version, zoom, xtile, ytile)
+                    for year, version in years_versions.items()
+                }
+            )
+            timings["fetch"] = time.perf_counter() - started
+
+            tiles = {}
+            for year, tile_data in fetched.items():
+                if not tile_data:
+                    raise ScanError(f"Failed to fetch tile for year {year}")
+                tiles[year] = ImageHandle(tile_data)
+            unchanged = await asyncio.to_thread(
+                scan_pipeline.precheck, xtile, ytile, zoom, tiles, timings
+            )
+            if unchanged is not None:
+                return unchanged
+
+            started = time.perf_counter()
+            years = list(tiles)
+            responses = await self.infer_cached([tiles[year] for year in years])
+            results = dict(zip(years, responses))
+            timings["inference_request"] = time.perf_counter() - started
+
+        # Change detection and rendering, with inference results supplied
+        args = (xtile, ytile, zoom, tiles, results, timings)
+        if ASYNC_CPU_EXECUTOR != "process":
+            return await loop.run_in_executor(self.cpu, scan_pipeline.analyse, *args)
+        scan, stages = await loop.run_in_executor(
+            self.cpu, scan_pipeline.analyse_collecting, *args
+        )
+        metrics.record_stages(stages)
+        return scan
+
+    async def save(self, row, before_img, after_img):
+        # Same upsert as db.insert_violation, asyncpg takes $n placeholders and
+        # JSON columns as text
+        row.update(
+            await asyncio.to_thread(
+                image_store.store_pair, before_img, after_img
+            )
+        )
+        columns = db.VIOLATION_COLUMNS
+        query = f"""
+        INSERT INTO violations ({", ".join(columns)})
+        VALUES ({", ".join(f"${index}" for index in range(1, len(columns) + 1))})
+        {db.UPSERT_CLAUSE}
+        RETURNING id
+        """
+        values = [
+            json.dumps(value) if isinstance(value, (dict, list)) else value
+            for value in (row.get(column) for column in columns)
+        ]
+        with metrics.span("database"):
+            async with self.db_pool.acquire() as conn:
+                return await conn.fetchval(query, *values)
+
+    async def _run_scan(self, lat, lon, xtile, ytile, zoom, key, years_versions):
+        scan = await self.scan_tile(xtile, ytile, zoom, years_versions)
+        if scan.get("unchanged"):
+            return scan_pipeline.scan_response(scan, None)
+        processed_values = list(scan["processed_images"].values())
+
+        started = time.perf_counter()
+        try:
+            inserted_id = await self.save(
+                scan_pipeline.violation_row(lat, lon, scan, key),
+                processed_values[0],
+                processed_values[1],
+            )
+        except Exception as error:
+            log.error("Error: %s", error)
+            raise ScanError("Failed to save processed images to the database")
+        scan["timings"]["database"] = time.perf_counter() - started
+
+        return await asyncio.to_thread(scan_pipeline.scan_response, scan, inserted_id)
+
+    async def run_scan(self, lat, lon, zoom=scan_pipeline.ZOOM):
+        xtile, ytile = latlon_to_tile(lat, lon, zoom)
+        years_versions = scan_pipeline.releases_for_tile(xtile, ytile, zoom)
+        key = scan_pipeline.scan_key(xtile, ytile, zoom, years_versions)
+        return await self.scans.do(
+            key, self._run_scan, lat, lon, xtile, ytile, zoom, key, years_versions
+        )
+
+    def stats(self):
+        return self.scans.stats()
@@ -1,215 +1,277 @@
-from inference_sdk import InferenceHTTPClient
-from PIL import Image
-import matplotlib.pyplot as plt
+import multiprocessing
 import os
-import numpy as np
-import io
-import base64
-from shapely.geometry import *
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from image_handle import ImageHandle
+from geometry import PredictionSet
+from change_detection import detect_changes
+from overlay import render_overlay
+from inference_module import get_batcher, infer_cached
+import similarity
 
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-def configure_client(api_key, api_url):
-    os.environ["API_KEY"] = api_key
-    return InferenceHTTPClient(api_url=api_url, api_key=os.environ["API_KEY"])
 
-
-def polygon_area(points):
-    x = [p["x"] for p in points]
-    y = [p["y"] for p in points]
-    return 0.5 * np.abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
-
-
-def draw_predictions(image, predictions):
-    plt.figure(figsize=(10, 10))
-    # plt.imshow(image)
-    ax = plt.gca()
-
-    if isinstance(predictions, Polygon):
-        # Handle a single Polygon
-        x, y = predictions.exterior.xy
-        ax.plot(x, y, color="red")
-        ax.add_patch(plt.Polygon(np.column_stack([x, y]), fill=None, edgecolor="red"))
-    elif isinstance(predictions, MultiPolygon):
-        # Iterate over each Polygon in the MultiPolygon
-        for polygon in predictions.geoms:
-            x, y = polygon.exterior.xy
-            ax.plot(x, y, color="red")
-            ax.add_patch(
-                plt.Polygon(np.column_stack([x, y]), fill=None, edgecolor="red")
-            )
-    elif isinstance(predictions, GeometryCollection):
-        # Handle GeometryCollection
-        for geom in predictions.geoms:
-            if isinstance(geom, Polygon):
-                x, y = geom.exterior.xy
-                ax.plot(x, y, color="red")
-                ax.add_patch(
-                    plt.Polygon(np.column_stack([x, y]), fill=None, edgecolor="red")
-                )
-            elif isinstance(geom, LineString):
-                x, y = geom.xy
-                ax.plot(x, y, color="blue")
-            elif isinstance(geom, Point):
-                ax.plot(geom.x, geom.y, "bo")
-    else:
-        # Assuming predictions is a dictionary with key "predictions"
-        for prediction in predictions["predictions"]:
-            points = prediction["points"]
-            mpl_polygon = plt.Polygon(
-                [(p["x"], p["y"]) for p in points], fill=None, edgecolor="red"
-            )
-            ax.add_patch(mpl_polygon)
-            ax.text(
-                points[0]["x"],
-                points[0]["y"],
-                prediction["class"],
-                color="red",
-                fontsize=12,
-            )
-
-    plt.axis("off")
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png", bbox_inches="tight", pad_inches=0)
-    buf.seek(0)
-    return base64.b64encode(buf.read()).decode("utf-8")
-
-
-def process_image(image_path, client, project_id, model_version):
-    pil_image = Image.open(image_path)
-
-    if pil_image.mode == "RGBA":
-        pil_image = pil_image.convert("RGB")
-
-    results = client.infer(pil_image, model_id=f"{project_id}/{model_version}")
-    return results, pil_image
+def load_image(image_path):
+    return ImageHandle.from_path(image_path)
 
 
 def draw_predictions(image, predictions):
-    plt.figure(figsize=(10, 10))
-    # plt.imshow(image)
-    ax = plt.gca()
-
-    if isinstance(predictions, Polygon):
-        # Handle a single Polygon
-        x, y = predictions.exterior.xy
-        ax.plot(x, y, color="red")
-        ax.add_patch(plt.Polygon(np.column_stack([x, y]), fill=None, edgecolor="red"))
-    elif isinstance(predictions, MultiPolygon):
-        # Iterate over each Polygon in the MultiPolygon
-        for polygon in predictions.geoms:
-            x, y = polygon.exterior.xy
-            ax.plot(x, y, color="red")
-            ax.add_patch(
-                plt.Polygon(np.column_stack([x, y]), fill=None, edgecolor="red")
-            )
-    else:
-        # Assuming predictions is a dictionary with key "predictions"
-        for prediction in predictions["predictions"]:
-            points = prediction["points"]
-            mpl_polygon = plt.Polygon(
-                [(p["x"], p["y"]) for p in points], fill=None, edgecolor="red"
-            )
-            ax.add_patch(mpl_polygon)
-            ax.text(
-                points[0]["x"],
-                points[0]["y"],
-                prediction["class"],
-                color="red",
-                fontsize=12,
+    # Outlines only, on a blank canvas the size of the tile
+    return render_overlay(
+        image,
+        predictions,
+        fill_color="red",
+        fill=False,
+        line_color="blue",
+        label_color="red",
+        background="white",
+    )
+
+
+def compare_images(image1, image2, predictions1, predictions2):
+    # predictions are PredictionSets, image1 is treated as the earlier release.
+    # An epoch without hedges is still compared, if every hedge is gone the
+    # whole earlier area is the loss.
+    change = detect_changes(
+        {"before": predictions1, "after": predictions2}, order=("before", "after")
+    )["latest"]
+    return change["loss_area"], change["loss"]
+
+
+AUTOSCAN_WORKERS = int(os.getenv("AUTOSCAN_WORKERS", os.cpu_count() or 2))
+# Pairs that may be read/inferred/rendered at the same time
+AUTOSCAN_MAX_IN_FLIGHT = int(os.getenv("AUTOSCAN_MAX_IN_FLIGHT", 64))
+# Releases needed per coordinate in the input folder, extra older releases
+# are ignored and the newest two are compared
+AUTOSCAN_RELEASES = int(os.getenv("AUTOSCAN_RELEASES", 2))
+MANIFEST_NAME = ".autoscan_manifest"
+
+
+def discover_files(input_folder):
+    # Lazily walk the folder instead of listing hundreds of thousands of names
+    with os.scandir(input_folder) as entries:
+        for entry in entries:
+            if entry.is_file() and not entry.name.startswith("."):
+                yield entry.name
+
+
+def coord_key_for(image_file):
+    # Assuming file name format is version_x_y.jpg
+    parts = image_file.split("_")
+    if len(parts) < 3:
+        return None
+    return f"{parts[1]}_{parts[2]}"
+
+
+def release_of(image_file):
+    # The version/date prefix, dates (YYYY-MM-DD) and numeric versions both
+    # sort oldest first
+    release = image_file.split("_")[0]
+    return (0, int(release), "") if release.isdigit() else (1, 0, release)
+
+
+def group_pairs(image_files, expected=AUTOSCAN_RELEASES):
+    # Yields (coord_key, files) with the newest `expected` releases of each
+    # coordinate, oldest first whatever order the directory listing had. A
+    # coordinate's releases can be anywhere in the listing, so every name is
+    # grouped before the first pair goes out.
+    groups = {}
+    for image_file in image_files:
+        coord_key = coord_key_for(image_file)
+        if coord_key is None:
+            print(f"Skipping {image_file}: unexpected file name")
+            continue
+        groups.setdefault(coord_key, []).append(image_file)
+
+    for coord_key, files in groups.items():
+        if len(files) < expected:
+            print(
+                f"Skipping group {coord_key}: Expected {expected} versions, found {len(files)} "
+                "(see AUTOSCAN_RELEASES)."
             )
-
-    plt.axis("off")
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png", bbox_inches="tight", pad_inches=0)
-    buf.seek(0)
-    return base64.b64encode(buf.read()).decode("utf-8")
-
-
-def compare_images(image1, image2, results1, results2):
-    if not results1["predictions"] or not results2["predictions"]:
-        print("No predictions found in one of the images.")
-        return None, None
-
-    hedge1 = Polygon([(p["x"], p["y"]) for p in results1["predictions"][0]["points"]])
-    hedge2 = Polygon([(p["x"], p["y"]) for p in results2["predictions"][0]["points"]])
-
-    difference = hedge1.difference(hedge2)
-    diff_area = difference.area
-
-    return diff_area, difference
+            continue
+        yield coord_key, sorted(files, key=release_of)[-expected:]
+
+
+class Manifest:
+    # Append-only record of finished coordinate keys so a rerun after a crash
+    # skips work that is already done
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as file:
+                self.done = {line.strip() for line in file if line.strip()}
+        self._file = open(path, "a", buffering=1)
+
+    def __contains__(self, coord_key):
+        return coord_key in self.done
+
+    def mark(self, coord_key):
+        self.done.add(coord_key)
+        self._file.write(coord_key + "\n")
+
+    def close(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def render_pair(coord_key, image_file1, image_file2, data1, data2, results1, results2, output_folder):
+    # Runs in a worker process: diff, render and save one pair
+    process_pair(
+        coord_key,
+        image_file1,
+        image_file2,
+        ImageHandle(data1),
+        ImageHandle(data2),
+        results1,
+        results2,
+        output_folder,
+    )
+    return coord_key
+
+
+def infer_pair(coord_key, files, input_folder, output_folder, infer, project_id, model_version, pool):
+    # Runs in an I/O thread: read both files, infer them through the shared
+    # batcher (and cache), then hand the CPU-heavy part to the process pool
+    # files are sorted oldest first, the newest two releases are compared
+    image_file1, image_file2 = files[-2:]
+    image1 = load_image(os.path.join(input_folder, image_file1))
+    image2 = load_image(os.path.join(input_folder, image_file2))
+
+    # Near-identical pairs have nothing to diff or render
+    same, metric = similarity.unchanged([image1, image2])
+    if same:
+        print(f"Skipped {image_file1} and {image_file2}: unchanged ({metric:.1f})")
+        return coord_key
+
+    results1, results2 = infer_cached([image1, image2], project_id, model_version, infer)
+
+    return pool.submit(
+        render_pair,
+        coord_key,
+        image_file1,
+        image_file2,
+        image1.data,
+        image2.data,
+        results1,
+        results2,
+        output_folder,
+    ).result()
 
 
 def main(api_key, api_url, project_id, model_version, input_folder, output_folder):
-    client = configure_client(api_key, api_url)
-
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    # Group images by their coordinates (x, y)
-    image_groups = {}
-    for image_file in os.listdir(input_folder):
-        if os.path.isfile(os.path.join(input_folder, image_file)):
-            # Assuming file name format is version_x_y.jpg
-            parts = image_file.split("_")
-            coord_key = f"{parts[1]}_{parts[2]}"
-            if coord_key not in image_groups:
-                image_groups[coord_key] = []
-            image_groups[coord_key].append(image_file)
-
-    # Process each pair
-    for coord_key, files in image_groups.items():
-        if len(files) == 2:  # Ensure there are exactly two versions
-            image_file1 = files[0]
-            image_file2 = files[1]
-
-            image_path1 = os.path.join(input_folder, image_file1)
-            image_path2 = os.path.join(input_folder, image_file2)
-
-            results1, pil_image1 = process_image(
-                image_path1, client, project_id, model_version
-            )
-            results2, pil_image2 = process_image(
-                image_path2, client, project_id, model_version
-            )
-
-            diff_area, difference = compare_images(
-                pil_image1, pil_image2, results1, results2
-            )
-
-            if diff_area is None or difference is None:
-                print(
-                    f"Skipping pair {image_file1} and {image_file2} due to no predictions."
-                )
+    # Concurrent pairs share inference requests through the batcher
+    batcher = get_batcher(api_key, api_url, project_id, model_version)
+    manifest = Manifest(os.path.join(output_folder, MANIFEST_NAME))
+
+    processed = 0
+    skipped = 0
+    failed = 0
+    started = time.monotonic()
+
+    pool = ProcessPoolExecutor(
+        max_workers=AUTOSCAN_WORKERS, mp_context=multiprocessing.get_context("spawn")
+    )
+    io_pool = ThreadPoolExecutor(max_workers=AUTOSCAN_MAX_IN_FLIGHT)
+    in_flight = {}
+
+    def collect(finished):
+        nonlocal processed, failed
+        for future in finished:
+            coord_key = in_flight.pop(future)
+            try:
+                future.result()
+            except Exception as error:
+                failed += 1
+                print(f"Error processing {coord_key}: {error}")
+                continue
+            manifest.mark(coord_key)
+            processed += 1
+            if processed % 100 == 0:
+                rate = processed / (time.monotonic() - started)
+                print(f"{processed} pairs done ({rate:.1f}/s), {skipped} skipped")
+
+    try:
+        for coord_key, files in group_pairs(discover_files(input_folder)):
+            if coord_key in manifest:
+                skipped += 1
                 continue
 
-            diff_percentage = (
-                diff_area / polygon_area(results1["predictions"][0]["points"])
-            ) * 100
-
-            diff_image_name = (
-                f"difference_{int(diff_percentage)}_percent_{coord_key.replace(".jpg","")}.png"
+            if len(in_flight) >= AUTOSCAN_MAX_IN_FLIGHT:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(finished)
+
+            future = io_pool.submit(
+                infer_pair,
+                coord_key,
+                files,
+                input_folder,
+                output_folder,
+                batcher.infer_many,
+                project_id,
+                model_version,
+                pool,
             )
-            diff_image_path = os.path.join(output_folder, diff_image_name)
-
-            diff_image_base64 = draw_predictions(pil_image2, difference)
-            diff_image = Image.open(io.BytesIO(base64.b64decode(diff_image_base64)))
-            diff_image.save(diff_image_path)
+            in_flight[future] = coord_key
+
+        collect(list(wait(in_flight).done))
+    finally:
+        io_pool.shutdown(wait=True)
+        pool.shutdown(wait=True)
+        manifest.close()
+
+    print(
+        f"Finished: {processed} processed, {skipped} already done, {failed} failed in {time.monotonic() - started:.1f}s"
+    )
+
+
+def process_pair(
+    coord_key,
+    image_file1,
+    image_file2,
+    pil_image1,
+    pil_image2,
+    results1,
+    results2,
+    output_folder,
+):
+    predictions1 = PredictionSet.from_inference(results1)
+    predictions2 = PredictionSet.from_inference(results2)
+
+    diff_area, difference = compare_images(
+        pil_image1, pil_image2, predictions1, predictions2
+    )
+
+    before_area = predictions1.filter("hedge").total_area()
+    diff_percentage = (diff_area / before_area) * 100 if before_area else 0.0
+
+    diff_image = draw_predictions(pil_image2, difference)
+    extension = diff_image.mime_type.split("/")[-1].replace("jpeg", "jpg")
+    diff_image_name = f"difference_{int(diff_percentage)}_percent_{coord_key.replace('.jpg', '')}.{extension}"
+    diff_image_path = os.path.join(output_folder, diff_image_name)
+
+    # draw_predictions already returns encoded bytes, write them out as-is
+    diff_image.save(diff_image_path)
+
+    print(
+        f"Processed {image_file1} and {image_file2}: Difference {diff_percentage:.2f}% saved as {diff_image_name}"
+    )
 
-            print(
-                f"Processed {image_file1} and {image_file2}: Difference {diff_percentage:.2f}% saved as {diff_image_name}"
-            )
-        else:
-            print(
-                f"Skipping group {coord_key}: Expected 2 versions, found {len(files)}."
-            )
 
 if __name__ == "__main__":
     api_key = os.getenv("API_KEY")
@@ -0,0 +1,624 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Offline benchmark of /submit_scan, inference_module.main and
+# autoscan_infer.main. Wayback is replaced by a local HTTP server serving
+# fixture JPEGs with a configurable delay, the inference server by a fake
+# client returning canned hedge polygons and Postgres by a SQLite table with
+# the same upsert, so the numbers only depend on this code and the knobs in
+# the environment (mosaic radius, batch size, workers, ...).
+#
+#   python benchmark.py --concurrency 1,4,16 --requests 64 --tile-latency-ms 40
+#   python benchmark.py --compare benchmark_results/<previous>.json
+#
+# Every target reports end-to-end p50/p95/p99 latency and requests/sec per
+# concurrency level, plus the same percentiles for each internal stage span
+# (fetch, decode, precheck, inference, diff, render, database). Results are
+# written as JSON so runs can be compared.
+
+TARGETS = ("submit_scan", "inference_main", "autoscan")
+
+TILE_SIZE = 256
+# Horizontal hedge rows drawn on the fixtures as (top, bottom), the newest
+# release loses the last one
+HEDGE_ROWS = ((52, 64), (122, 134), (192, 204))
+HEDGE_LEFT, HEDGE_RIGHT = 16, 240
+BEFORE_RELEASE = "2023-02-23"
+AFTER_RELEASE = "2024-03-07"
+
+# Dublin, any tile works since the fake server ignores the coordinates
+BASE_TILE = (126966, 84759)
+
+
+def fixture_jpeg(hedges, seed):
+    # A field with some texture and dark hedge rows, encoded like Wayback tiles
+    rng = np.random.default_rng(seed)
+    field = np.empty((TILE_SIZE, TILE_SIZE, 3), dtype=np.uint8)
+    field[...] = (96, 140, 72)
+    noise = rng.integers(-12, 13, size=(TILE_SIZE, TILE_SIZE, 1))
+    field = np.clip(field.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+    image = Image.fromarray(field)
+    draw = ImageDraw.Draw(image)
+    for top, bottom in hedges:
+        draw.rectangle((HEDGE_LEFT, top, HEDGE_RIGHT, bottom), fill=(34, 58, 28))
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class Fixtures:
+    def __init__(self, unchanged_fraction=0.0):
+        self.before = fixture_jpeg(HEDGE_ROWS, seed=1)
+        self.after = fixture_jpeg(HEDGE_ROWS[:-1], seed=2)
+        self.unchanged_fraction = unchanged_fraction
+        # Wayback version numbers of the two releases, set once wayback.py
+        # can be imported
+        self.before_version = None
+        self.after_version = None
+
+    def unchanged(self, x, y):
+        # Deterministic share of tiles whose imagery is the same in every release
+        return (x * 31 + y * 17) % 100 < self.unchanged_fraction * 100
+
+    def tile(self, version, x, y):
+        if version == self.after_version and not self.unchanged(x, y):
+            return self.after
+        return self.before
+
+    def pair(self, x, y):
+        return self.tile(self.before_version, x, y), self.tile(self.after_version, x, y)
+
+
+class FakeWayback:
+    # Serves /{version}/{zoom}/{y}/{x} from the fixtures after latency_ms
+
+    def __init__(self, fixtures, latency_ms=0.0, jitter_ms=0.0):
+        self.fixtures = fixtures
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start(self):
+        wayback = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with wayback._lock:
+                    wayback.requests += 1
+                delay = wayback.latency
+                if wayback.jitter:
+                    delay += np.random.uniform(0, wayback.jitter)
+                if delay:
+                    time.sleep(delay)
+
+                try:
+                    version, _zoom, y, x = self.path.strip("/").split("/")[-4:]
+                    body = wayback.fixtures.tile(version, int(x), int(y))
+                except ValueError:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeInferenceClient:
+    # Stands in for InferenceHTTPClient: a hedge polygon is reported for every
+    # fixture row that is actually drawn in each 256px cell of the image, after
+    # latency_ms per request plus per_image_ms per image
+
+    def __init__(self, latency_ms=0.0, per_image_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.per_image = per_image_ms / 1000.0
+        self.requests = 0
+        self.images = 0
+        self._lock = threading.Lock()
+
+    def _predict(self, image):
+        gray = np.asarray(image.convert("L"))
+        predictions = []
+        for top in range(0, gray.shape[0] - TILE_SIZE + 1, TILE_SIZE):
+            for left in range(0, gray.shape[1] - TILE_SIZE + 1, TILE_SIZE):
+                for row_top, row_bottom in HEDGE_ROWS:
+                    middle = top + (row_top + row_bottom) // 2
+                    if gray[middle, left + TILE_SIZE // 2] > 80:
+                        continue
+                    x0, x1 = left + HEDGE_LEFT, left + HEDGE_RIGHT
+                    y0, y1 = top + row_top, top + row_bottom
+                    predictions.append(
+                        {
+                            "class": "hedge",
+                            "confidence": 0.9,
+                            "points": [
+                                {"x": x0, "y": y0},
+                                {"x": x1, "y": y0},
+                                {"x": x1, "y": y1},
+                                {"x": x0, "y": y1},
+                            ],
+                        }
+                    )
+        return {
+            "image": {"width": gray.shape[1], "height": gray.shape[0]},
+            "predictions": predictions,
+        }
+
+    def _delay(self, count):
+        with self._lock:
+            self.requests += 1
+            self.images += count
+        return self.latency + self.per_image * count
+
+    def infer(self, images, model_id=None):
+        single = not isinstance(images, list)
+        images = [images] if single else images
+        time.sleep(self._delay(len(images)))
+        results = [self._predict(image) for image in images]
+        return results[0] if single else results
+
+    async def infer_async(self, images, model_id=None):
+        single = not isinstance(images, list)
+        images = [images] if single else images
+        await asyncio.sleep(self._delay(len(images)))
+        results = [self._predict(image) for image in images]
+        return results[0] if single else results
+
+
+class SQLiteViolations:
+    # In-process stand-in for the violations table. Same columns and the same
+    # ON CONFLICT (tile_key) upsert as db.py, JSON columns stored as text.
+
+    def __init__(self, path, latency_ms=0.0):
+        import db
+
+        self.columns = db.VIOLATION_COLUMNS
+        self.upsert = db.UPSERT_CLAUSE
+        self.latency = latency_ms / 1000.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS violations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {", ".join(column for column in self.columns if column != "tile_key")},
+                tile_key TEXT UNIQUE,
+                updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+
+    def _values(self, row):
+        return tuple(
+            json.dumps(value) if isinstance(value, (dict, list)) else value
+            for value in (row.get(column) for column in self.columns)
+        )
+
+    def insert_violation(self, row):
+        return self.insert_violations([row])[0]
+
+    def insert_violations(self, rows):
+        import metrics
+
+        query = f"""
+        INSERT INTO violations ({", ".join(self.columns)})
+        VALUES ({", ".join(["?"] * len(self.columns))})
+        {self.upsert}
+        RETURNING id
+        """
+        with metrics.span("database"):
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock, self._conn:
+                return [
+                    self._conn.execute(query, self._values(row)).fetchone()[0]
+                    for row in rows
+                ]
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM violations").fetchone()[0]
+
+
+class StageRecorder:
+    # Keeps every observation of metrics.STAGE_SECONDS so stage percentiles
+    # are exact rather than read off histogram buckets. Spans recorded in
+    # worker processes (autoscan rendering) aren't seen here.
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.samples = {}
+        self._lock = threading.Lock()
+        self._observe = histogram.observe
+        histogram.observe = self.observe
+
+    def observe(self, value, **labels):
+        with self._lock:
+            self.samples.setdefault(labels.get("stage", ""), []).append(value)
+        self._observe(value, **labels)
+
+    def take(self):
+        with self._lock:
+            samples, self.samples = self.samples, {}
+        return samples
+
+
+def summarize(latencies):
+    if not latencies:
+        return {"count": 0}
+    values = np.asarray(latencies) * 1000.0
+    p50, p95, p99 = np.percentile(values, (50, 95, 99))
+    return {
+        "count": len(values),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(values.max()), 3),
+    }
+
+
+def measure(fn, args, concurrency):
+    # Runs fn(*arg) for every arg with `concurrency` callers at once and
+    # returns (per-call latencies, errors, wall seconds)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def call(arg):
+        started = time.perf_counter()
+        try:
+            fn(*arg)
+        except Exception as error:
+            with lock:
+                errors.append(f"{type(error).__name__}: {error}")
+            return
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(call, args))
+    return latencies, errors, time.perf_counter() - started
+
+
+class Benchmark:
+    def __init__(self, fixtures, workdir):
+        import archive_scraper_api
+        import scan_pipeline
+        from tile_math import tile_center
+
+        self.fixtures = fixtures
+        self.workdir = workdir
+        self.app = archive_scraper_api.app
+        # The benchmark is the only client, Flask-Limiter would 429 it
+        archive_scraper_api.limiter.enabled = False
+        self.scan_pipeline = scan_pipeline
+        self.tile_center = tile_center
+        # Every call gets a tile no earlier call used, so the scan result
+        # cache and single-flight never answer from memory
+        self._tiles = itertools.count()
+
+    def next_tiles(self, count):
+        tiles = []
+        for _ in range(count):
+            offset = next(self._tiles)
+            tiles.append((BASE_TILE[0] + offset % 512, BASE_TILE[1] + offset // 512))
+        return tiles
+
+    def submit_scan(self, requests, concurrency):
+        zoom = self.scan_pipeline.ZOOM
+        args = []
+        for xtile, ytile in self.next_tiles(requests):
+            lat, lon = self.tile_center(xtile, ytile, zoom)
+            args.append((lat, lon))
+
+        def call(lat, lon):
+            response = self.app.test_client().get(f"/submit_scan?x={lat}&y={lon}")
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.get_data(as_text=True)[:200]}")
+
+        return measure(call, args, concurrency)
+
+    def inference_main(self, requests, concurrency):
+        import inference_module
+        from image_handle import ImageHandle
+
+        scan_pipeline = self.scan_pipeline
+        args = []
+        for xtile, ytile in self.next_tiles(requests):
+            before, after = self.fixtures.pair(xtile, ytile)
+            args.append(
+                ({BEFORE_RELEASE: ImageHandle(before), AFTER_RELEASE: ImageHandle(after)},)
+            )
+
+        def call(images):
+            inference_module.main(
+                scan_pipeline.api_key,
+                scan_pipeline.api_url,
+                scan_pipeline.project_id,
+                scan_pipeline.model_version,
+                images,
+            )
+
+        return measure(call, args, concurrency)
+
+    def autoscan(self, requests, concurrency):
+        # autoscan_infer.main is one batch run, so concurrency is its number of
+        # pairs in flight and the per-pair latency is timed around infer_pair.
+        # Wall time includes starting its render process pool.
+        import autoscan_infer
+
+        scan_pipeline = self.scan_pipeline
+        run_dir = tempfile.mkdtemp(dir=self.workdir)
+        input_folder = os.path.join(run_dir, "images")
+        output_folder = os.path.join(run_dir, "inferred")
+        os.makedirs(input_folder)
+        for xtile, ytile in self.next_tiles(requests):
+            before, after = self.fixtures.pair(xtile, ytile)
+            for release, data in ((BEFORE_RELEASE, before), (AFTER_RELEASE, after)):
+                with open(os.path.join(input_folder, f"{release}_{xtile}_{ytile}.jpg"), "wb") as f:
+                    f.write(data)
+
+        latencies = []
+        lock = threading.Lock()
+        infer_pair = autoscan_infer.infer_pair
+
+        def timed_infer_pair(*args):
+            started = time.perf_counter()
+            result = infer_pair(*args)
+            with lock:
+                latencies.append(time.perf_counter() - started)
+            return result
+
+        autoscan_infer.infer_pair = timed_infer_pair
+        in_flight = autoscan_infer.AUTOSCAN_MAX_IN_FLIGHT
+        autoscan_infer.AUTOSCAN_MAX_IN_FLIGHT = concurrency
+        started = time.perf_counter()
+        try:
+            autoscan_infer.main(
+                scan_pipeline.api_key,
+                scan_pipeline.api_url,
+                scan_pipeline.project_id,
+                scan_pipeline.model_version,
+                input_folder,
+                output_folder,
+            )
+        finally:
+            autoscan_infer.infer_pair = infer_pair
+            autoscan_infer.AUTOSCAN_MAX_IN_FLIGHT = in_flight
+        wall = time.perf_counter() - started
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+        errors = [f"{requests - len(latencies)} pairs failed"] if len(latencies) < requests else []
+        return latencies, errors, wall
+
+
+def configure_environment(args, workdir, wayback_url):
+    # Has to run before any repo module is imported, they read the
+    # environment at import time
+    os.environ["WAYBACK_URL"] = wayback_url
+    os.environ["WAYBACK_RELEASES"] = f"{AFTER_RELEASE},{BEFORE_RELEASE}"
+    os.environ.setdefault("API_KEY", "benchmark")
+    os.environ.setdefault("API_URL", "http://127.0.0.1:9")
+    os.environ.setdefault("PROJECT_ID", "benchmark")
+    os.environ.setdefault("MODEL_VERSION", "1")
+    os.environ["IMAGE_STORE"] = "local"
+    os.environ["IMAGE_STORE_DIR"] = os.path.join(workdir, "image_store")
+    os.environ["CHANGE_INDEX_PATH"] = ""
+    # The fake server never throttles, keep the outbound limiter out of the
+    # numbers unless a rate is given
+    os.environ.setdefault("UPSTREAM_RATE", "0")
+    if args.caches:
+        os.environ["TILE_CACHE_DIR"] = os.path.join(workdir, "tile_cache")
+        os.environ["INFERENCE_CACHE_PATH"] = os.path.join(workdir, "inference_cache.sqlite3")
+    else:
+        os.environ["TILE_CACHE_DIR"] = ""
+        os.environ["INFERENCE_CACHE_PATH"] = ""
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+
+def install_fakes(args, workdir):
+    import db
+    import inference_module
+
+    client = FakeInferenceClient(args.inference_latency_ms, args.inference_per_image_ms)
+    inference_module.configure_client = lambda api_key, api_url: client
+
+    violations = SQLiteViolations(os.path.join(workdir, "violations.sqlite3"), args.db_latency_ms)
+    db.insert_violation = violations.insert_violation
+    db.insert_violations = violations.insert_violations
+    return client, violations
+
+
+def settings():
+    # Knobs that change the numbers, recorded with every run
+    names = (
+        "SCAN_MOSAIC_RADIUS", "MOSAIC_MODE", "INFERENCE_BATCH_SIZE", "INFERENCE_MAX_CONCURRENCY",
+        "INFERENCE_MAX_WAIT_MS", "WAYBACK_MAX_WORKERS", "AUTOSCAN_WORKERS", "PREPROCESS_CLAHE",
+        "SIMILARITY_THRESHOLD", "RENDER_FORMAT", "DB_WRITE_BEHIND", "UPSTREAM_RATE",
+        "UPSTREAM_MAX_WAIT",
+    )
+    return {name: os.environ[name] for name in names if name in os.environ}
+
+
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    old = {(run["target"], run["concurrency"]): run for run in previous["runs"]}
+    print(f"\nCompared with {previous_path}")
+    for run in results["runs"]:
+        before = old.get((run["target"], run["concurrency"]))
+        if before is None or not run["latency"]["count"] or not before["latency"]["count"]:
+            continue
+        p95 = run["latency"]["p95_ms"] / before["latency"]["p95_ms"] - 1
+        rps = run["rps"] / before["rps"] - 1 if before["rps"] else 0.0
+        print(
+            f"{run['target']:>16} x{run['concurrency']:<3} p95 {p95:+7.1%}  rps {rps:+7.1%}"
+        )
+
+
+def main(args):
+    workdir = tempfile.mkdtemp(prefix="sceach-bench-")
+    fixtures = Fixtures(args.unchanged_fraction)
+    server = FakeWayback(fixtures, args.tile_latency_ms, args.tile_jitter_ms)
+    configure_environment(args, workdir, server.start())
+
+    import metrics
+    import wayback
+
+    fixtures.before_version = wayback.RELEASES[BEFORE_RELEASE]
+    fixtures.after_version = wayback.RELEASES[AFTER_RELEASE]
+    client, violations = install_fakes(args, workdir)
+    recorder = StageRecorder(metrics.STAGE_SECONDS)
+    bench = Benchmark(fixtures, workdir)
+
+    results = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "options": vars(args),
+        "settings": settings(),
+        "runs": [],
+    }
+
+    try:
+        for target in args.targets:
+            for concurrency in args.concurrency:
+                if args.warmup:
+                    with open(os.devnull, "w") as sink, contextlib.redirect_stdout(sink):
+                        getattr(bench, target)(args.warmup, concurrency)
+                recorder.take()
+                tile_requests = server.requests
+                inference_requests = client.requests
+
+                # The pipeline prints per tile, keep the report readable
+                output = sys.stdout if args.verbose else open(os.devnull, "w")
+                with contextlib.redirect_stdout(output):
+                    latencies, errors, wall = getattr(bench, target)(args.requests, concurrency)
+                if output is not sys.stdout:
+                    output.close()
+
+                run = {
+                    "target": target,
+                    "concurrency": concurrency,
+                    "requests": args.requests,
+                    "errors": len(errors),
+                    "error_samples": errors[:5],
+                    "wall_seconds": round(wall, 3),
+                    "rps": round(len(latencies) / wall, 3) if wall else 0.0,
+                    "latency": summarize(latencies),
+                    "stages": {
+                        stage: summarize(samples)
+                        for stage, samples in sorted(recorder.take().items())
+                    },
+                    "upstream_tile_requests": server.requests - tile_requests,
+                    "upstream_inference_requests": client.requests - inference_requests,
+                }
+                results["runs"].append(run)
+
+                latency = run["latency"]
+                print(
+                    f"{target:>16} x{concurrency:<3} {run['rps']:8.2f} req/s"
+                    f"  p50 {latency.get('p50_ms', 0):8.1f}ms"
+                    f"  p95 {latency.get('p95_ms', 0):8.1f}ms"
+                    f"  p99 {latency.get('p99_ms', 0):8.1f}ms"
+                    f"  errors {run['errors']}"
+                )
+                for stage, summary in run["stages"].items():
+                    print(
+                        f"{'':>18}{stage:<12} n={summary['count']:<5}"
+                        f" p50 {summary['p50_ms']:8.1f}ms  p95 {summary['p95_ms']:8.1f}ms"
+                        f"  p99 {summary['p99_ms']:8.1f}ms"
+                    )
+    finally:
+        server.stop()
+
+    results["violations_written"] = violations.count()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    output_path = args.output or os.path.join(
+        "benchmark_results", time.strftime("%Y%m%d-%H%M%S") + ".json"
+    )
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output_path}")
+
+    if args.compare:
+        compare(results, args.compare)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark")
+    parser.add_argument(
+        "--targets", default=",".join(TARGETS), help=f"Comma separated, from {', '.join(TARGETS)}"
+    )
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated levels")
+    parser.add_argument("--requests", type=int, default=32, help="Calls per target and level")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed calls before each level")
+    parser.add_argument("--tile-latency-ms", type=float, default=30.0)
+    parser.add_argument("--tile-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--inference-latency-ms", type=float, default=80.0)
+    parser.add_argument("--inference-per-image-ms", type=float, default=5.0)
+    parser.add_argument("--db-latency-ms", type=float, default=2.0)
+    parser.add_argument(
+        "--unchanged-fraction", type=float, default=0.0,
+        help="Share of tiles with identical imagery in both releases",
+    )
+    parser.add_argument(
+        "--caches", action="store_true", help="Keep the tile and inference caches on (in a temp dir)"
+    )
+    parser.add_argument("--output", default="", help="JSON path, benchmark_results/<time>.json by default")
+    parser.add_argument("--compare", default="", help="Earlier results JSON to compare against")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own output")
+    args = parser.parse_args(argv)
+
+    args.targets = [target.strip() for target in args.targets.split(",") if target.strip()]
+    unknown = set(args.targets) - set(TARGETS)
+    if unknown:
+        parser.error(f"unknown targets: {', '.join(sorted(unknown))}")
+    args.concurrency = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    return args
+
+
+if __name__ == "__main__":
+    main(parse_args())
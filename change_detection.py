@@ -0,0 +1,113 @@
+import numpy as np
+import shapely
+from shapely import STRtree
+
+# Hedge change detection across any number of releases. Each epoch's hedge
+# predictions are unioned (so overlapping detections aren't counted twice) and
+# split back into parts. Parts of one epoch are paired with the parts of
+# another through an STRtree, so every comparison only overlays polygons whose
+# bounding boxes actually meet instead of every pair.
+
+HEDGE_CLASS = "hedge"
+
+
+def epoch_parts(prediction_set, class_name=HEDGE_CLASS):
+    polygons = prediction_set.filter(class_name).to_shapely()
+    if len(polygons) == 0:
+        return np.empty(0, dtype=object)
+    union = shapely.union_all(polygons)
+    parts = shapely.get_parts(union)
+    # Slivers from make_valid can leave lines/points behind, only keep areas
+    return parts[shapely.area(parts) > 0]
+
+
+def uncovered(parts, other_parts, other_tree):
+    # Union of the pieces of `parts` not covered by `other_parts`
+    if len(parts) == 0:
+        return shapely.Polygon()
+    if len(other_parts) == 0:
+        return shapely.union_all(parts)
+
+    part_index, other_index = other_tree.query(parts, predicate="intersects")
+    pieces = parts.copy()
+    if len(part_index):
+        # Group the intersecting neighbours of each part
+        order = np.argsort(part_index, kind="stable")
+        part_index, other_index = part_index[order], other_index[order]
+        boundaries = np.flatnonzero(np.diff(part_index)) + 1
+        for group_parts, group_others in zip(
+            np.split(part_index, boundaries), np.split(other_index, boundaries)
+        ):
+            index = group_parts[0]
+            pieces[index] = shapely.difference(
+                parts[index], shapely.union_all(other_parts[group_others])
+            )
+    return shapely.union_all(pieces)
+
+
+def compare(parts_before, parts_after, tree_before=None, tree_after=None):
+    tree_before = tree_before or STRtree(parts_before)
+    tree_after = tree_after or STRtree(parts_after)
+    # Hedge present before but gone after is loss, the reverse is gain
+    loss = uncovered(parts_before, parts_after, tree_after)
+    gain = uncovered(parts_after, parts_before, tree_before)
+    return {"loss": loss, "gain": gain, "loss_area": loss.area, "gain_area": gain.area}
+
+
+def percentage_change(area_before, area_after):
+    if area_before + area_after == 0:
+        return None
+    return abs(area_after - area_before) / ((area_before + area_after) / 2) * 100
+
+
+def detect_changes(predictions, order=None, class_name=HEDGE_CLASS):
+    # predictions maps epoch (release date) -> PredictionSet. Epochs are
+    # compared oldest to newest unless an explicit order is given.
+    epochs = list(order) if order is not None else sorted(predictions)
+
+    parts = {epoch: epoch_parts(predictions[epoch], class_name) for epoch in epochs}
+    trees = {epoch: STRtree(parts[epoch]) for epoch in epochs}
+    areas = {
+        epoch: float(shapely.area(parts[epoch]).sum()) for epoch in epochs
+    }
+
+    def change(before, after):
+        result = compare(parts[before], parts[after], trees[before], trees[after])
+        result.update(
+            {
+                "before": before,
+                "after": after,
+                "before_area": areas[before],
+                "after_area": areas[after],
+                "percentage_difference": percentage_change(areas[before], areas[after]),
+            }
+        )
+        return result
+
+    # Consecutive releases give the time series, every earlier release is also
+    # compared against the newest one
+    consecutive = [change(before, after) for before, after in zip(epochs, epochs[1:])]
+    against_latest = [change(before, epochs[-1]) for before in epochs[:-2]]
+    if consecutive:
+        against_latest.append(consecutive[-1])
+
+    return {
+        "epochs": epochs,
+        "areas": areas,
+        "changes": consecutive,
+        "against_latest": against_latest,
+        "latest": consecutive[-1] if consecutive else None,
+    }
+
+
+def summarize(report):
+    # JSON-able view of a report, geometries dropped
+    def strip(change):
+        return {key: value for key, value in change.items() if key not in ("loss", "gain")}
+
+    return {
+        "epochs": report["epochs"],
+        "areas": report["areas"],
+        "changes": [strip(change) for change in report["changes"]],
+        "against_latest": [strip(change) for change in report["against_latest"]],
+    }
@@ -0,0 +1,245 @@
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import requests
+from dotenv import load_dotenv
+
+import upstream_limiter
+import wayback
+
+# Settings are read at import, not only when run as a script
+load_dotenv()
+
+# Offline index of which Wayback releases actually changed the imagery of
+# each tile. The builder fetches a region's tiles for every release, hashes
+# the bytes and keeps only the releases whose hash differs from the previous
+# one. /submit_scan then compares the two newest distinct releases of a tile
+# with one lookup, and skips tiles whose imagery never changed.
+
+CHANGE_INDEX_PATH = os.getenv("CHANGE_INDEX_PATH", "change_index.sqlite3")
+WAYBACK_CONFIG_URL = os.getenv(
+    "WAYBACK_CONFIG_URL",
+    "https://s3-us-west-2.amazonaws.com/config.maptiles.arcgis.com/waybackconfig.json",
+)
+CHANGE_INDEX_BATCH = int(os.getenv("CHANGE_INDEX_BATCH", 64))
+
+TITLE_DATE = re.compile(r"(\d{4}-\d{2}-\d{2})")
+
+
+def load_releases(url=WAYBACK_CONFIG_URL):
+    # {date: version} oldest first. waybackconfig.json maps each release
+    # number to an item whose title carries the release date.
+    try:
+        response = requests.get(url, timeout=wayback.WAYBACK_TIMEOUT)
+        response.raise_for_status()
+        config = response.json()
+    except (requests.RequestException, ValueError) as error:
+        print(f"Could not load {url} ({error}), using the built-in releases")
+        return dict(sorted(wayback.RELEASES.items()))
+
+    releases = {}
+    for version, item in config.items():
+        match = TITLE_DATE.search(item.get("itemTitle", ""))
+        if match:
+            releases[match.group(1)] = str(version)
+    return dict(sorted(releases.items()))
+
+
+def tile_digest(data):
+    # 16 bytes of sha256 are plenty to tell imagery apart
+    return hashlib.sha256(data).digest()[:16]
+
+
+class ChangeIndex:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS distinct_releases (
+                    zoom INTEGER NOT NULL,
+                    x INTEGER NOT NULL,
+                    y INTEGER NOT NULL,
+                    date TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    digest BLOB NOT NULL,
+                    PRIMARY KEY (zoom, x, y, date)
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS indexed_tiles (
+                    zoom INTEGER NOT NULL,
+                    x INTEGER NOT NULL,
+                    y INTEGER NOT NULL,
+                    last_date TEXT NOT NULL,
+                    PRIMARY KEY (zoom, x, y)
+                ) WITHOUT ROWID;
+                """
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, xtile, ytile, zoom):
+        # Distinct releases of the tile as {date: version} oldest first, None
+        # if the tile was never indexed
+        conn = self._connect()
+        if conn.execute(
+            "SELECT 1 FROM indexed_tiles WHERE zoom=? AND x=? AND y=?", (zoom, xtile, ytile)
+        ).fetchone() is None:
+            return None
+        rows = conn.execute(
+            "SELECT date, version FROM distinct_releases WHERE zoom=? AND x=? AND y=? ORDER BY date",
+            (zoom, xtile, ytile),
+        ).fetchall()
+        return dict(rows)
+
+    def pair(self, xtile, ytile, zoom):
+        # The newest two distinct releases, or the single release of a tile
+        # whose imagery never changed. None if the tile isn't indexed.
+        releases = self.lookup(xtile, ytile, zoom)
+        if not releases:
+            return None
+        return dict(list(releases.items())[-2:])
+
+    def pending(self, tiles, zoom, releases):
+        # tile -> (releases still to check, newest distinct digest so far)
+        conn = self._connect()
+        latest_date = max(releases)
+        work = {}
+        for xtile, ytile in tiles:
+            row = conn.execute(
+                "SELECT last_date FROM indexed_tiles WHERE zoom=? AND x=? AND y=?",
+                (zoom, xtile, ytile),
+            ).fetchone()
+            if row is not None and row[0] >= latest_date:
+                continue
+            last_date = row[0] if row else ""
+            previous = conn.execute(
+                """
+                SELECT digest FROM distinct_releases WHERE zoom=? AND x=? AND y=?
+                ORDER BY date DESC LIMIT 1
+                """,
+                (zoom, xtile, ytile),
+            ).fetchone()
+            todo = {date: version for date, version in releases.items() if date > last_date}
+            work[(xtile, ytile)] = (todo, previous[0] if previous else None)
+        return work
+
+    def record(self, zoom, xtile, ytile, digests, previous, last_date):
+        # digests maps date -> (version, digest or None) in date order
+        rows = []
+        for date, (version, digest) in digests.items():
+            if digest is None or digest == previous:
+                continue
+            rows.append((zoom, xtile, ytile, date, version, digest))
+            previous = digest
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO distinct_releases VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO indexed_tiles VALUES (?, ?, ?, ?)",
+                (zoom, xtile, ytile, last_date),
+            )
+
+    def stats(self):
+        conn = self._connect()
+        tiles = conn.execute("SELECT COUNT(*) FROM indexed_tiles").fetchone()[0]
+        distinct = conn.execute("SELECT COUNT(*) FROM distinct_releases").fetchone()[0]
+        unchanged = conn.execute(
+            """
+            SELECT COUNT(*) FROM (
+                SELECT 1 FROM distinct_releases GROUP BY zoom, x, y HAVING COUNT(*) = 1
+            )
+            """
+        ).fetchone()[0]
+        return {"tiles": tiles, "distinct_releases": distinct, "unchanged_tiles": unchanged}
+
+
+def build(index, tiles, zoom, releases, batch_size=CHANGE_INDEX_BATCH):
+    # Fetches only the releases each tile hasn't been checked against yet,
+    # so rerunning after a new Wayback release only costs one fetch per tile
+    work = index.pending(tiles, zoom, releases)
+    total = len(work)
+    done = 0
+    retry = 0
+    started = time.monotonic()
+    items = list(work.items())
+
+    for start in range(0, total, batch_size):
+        chunk = items[start : start + batch_size]
+        requests_by_key = {
+            (xtile, ytile, date): (version, zoom, xtile, ytile)
+            for (xtile, ytile), (todo, _) in chunk
+            for date, version in todo.items()
+        }
+        failed = set()
+        fetched = upstream_limiter.wait_out(wayback.fetch_tiles, requests_by_key, failed)
+
+        for (xtile, ytile), (todo, previous) in chunk:
+            digests = {}
+            for date, version in todo.items():
+                if (xtile, ytile, date) in failed:
+                    # Each digest is compared with the release before it, so
+                    # the releases after a failed one wait for the next run
+                    break
+                data = fetched[(xtile, ytile, date)]
+                digests[date] = (version, tile_digest(data) if data else None)
+            if len(digests) < len(todo):
+                retry += 1
+            if digests:
+                last_date = max(releases) if len(digests) == len(todo) else max(digests)
+                index.record(zoom, xtile, ytile, digests, previous, last_date)
+
+        done += len(chunk)
+        rate = done / max(time.monotonic() - started, 1e-9)
+        print(f"Indexed {done}/{total} tiles ({rate:.1f}/s), {retry} to retry")
+    return done
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    # None when CHANGE_INDEX_PATH is empty or the index hasn't been built
+    global _index
+    if not CHANGE_INDEX_PATH or not os.path.exists(CHANGE_INDEX_PATH):
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = ChangeIndex(CHANGE_INDEX_PATH)
+    return _index
+
+
+if __name__ == "__main__":
+    from area_scan import tiles_in_bbox
+
+    parser = argparse.ArgumentParser(description="Build the per-tile release change index")
+    parser.add_argument("--bbox", required=True, help="min_lat,min_lon,max_lat,max_lon")
+    parser.add_argument("--zoom", type=int, default=18)
+    parser.add_argument("--since", default="", help="Only releases on or after this date")
+    args = parser.parse_args()
+
+    min_lat, min_lon, max_lat, max_lon = (float(v) for v in args.bbox.split(","))
+    releases = {
+        date: version for date, version in load_releases().items() if date >= args.since
+    }
+    print(f"{len(releases)} releases from {min(releases)} to {max(releases)}")
+
+    index = ChangeIndex(CHANGE_INDEX_PATH)
+    tiles = list(tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, args.zoom))
+    build(index, tiles, args.zoom, releases)
+    print(index.stats())
@@ -0,0 +1,377 @@
+import atexit
+import io
+import csv
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+# How long a request waits for a free connection when all are checked out
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+# Connections idle for longer than this are pinged before being handed out
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", 30))
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "0") == "1"
+DB_WRITE_BEHIND_BATCH = int(os.getenv("DB_WRITE_BEHIND_BATCH", 50))
+DB_WRITE_BEHIND_WAIT_MS = float(os.getenv("DB_WRITE_BEHIND_WAIT_MS", 100))
+
+# Images live in the image store (see image_store.py), rows only reference
+# them. The legacy before_img/after_img text columns are left NULL.
+VIOLATION_COLUMNS = (
+    "description",
+    "latitude",
+    "longitude",
+    "county",
+    "severity",
+    "status",
+    "before_img_key",
+    "before_img_size",
+    "before_img_width",
+    "before_img_height",
+    "after_img_key",
+    "after_img_size",
+    "after_img_width",
+    "after_img_height",
+    "xtile",
+    "ytile",
+    "zoom",
+    "change_percent",
+    "loss_area_m2",
+    "gain_area_m2",
+    "loss_geojson",
+    "tile_key",
+)
+
+# A rescan of a tile refreshes its row instead of adding another one, the
+# review status set on the existing row is kept
+UPSERT_COLUMNS = tuple(
+    column for column in VIOLATION_COLUMNS if column not in ("tile_key", "status")
+)
+UPSERT_CLAUSE = "ON CONFLICT (tile_key) DO UPDATE SET " + ", ".join(
+    [f"{column} = EXCLUDED.{column}" for column in UPSERT_COLUMNS]
+    + ["updated_at = CURRENT_TIMESTAMP"]
+)
+
+POSTGIS_POINT = "ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)"
+
+SCHEMA_MIGRATIONS = (
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS before_img_key TEXT",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS before_img_size INTEGER",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS before_img_width INTEGER",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS before_img_height INTEGER",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS after_img_key TEXT",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS after_img_size INTEGER",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS after_img_width INTEGER",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS after_img_height INTEGER",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS xtile INTEGER",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS ytile INTEGER",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS zoom INTEGER",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS change_percent DOUBLE PRECISION",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS loss_area_m2 DOUBLE PRECISION",
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS gain_area_m2 DOUBLE PRECISION",
+    # GeoJSON in lon/lat (EPSG:4326) of the hedge lost between the two releases
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS loss_geojson JSONB",
+    "ALTER TABLE violations ALTER COLUMN before_img DROP NOT NULL",
+    "ALTER TABLE violations ALTER COLUMN after_img DROP NOT NULL",
+    # Scan identity (tile, releases, model), NULL for rows from before it existed
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS tile_key TEXT",
+    "CREATE UNIQUE INDEX IF NOT EXISTS violations_tile_key ON violations (tile_key)",
+    # Filters of the /violations query endpoint
+    "CREATE INDEX IF NOT EXISTS violations_county_status ON violations (county, status)",
+    # Lets the local R-tree of the query endpoint pick up rescanned rows
+    "ALTER TABLE violations ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS violations_updated_at ON violations (updated_at)",
+    # bbox filter of the query endpoint, only where PostGIS is installed
+    f"""
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'postgis') THEN
+            EXECUTE 'CREATE INDEX IF NOT EXISTS violations_location_gist ON violations USING GIST (({POSTGIS_POINT}))';
+        END IF;
+    END
+    $$
+    """,
+)
+
+
+class ConnectionPool:
+    def __init__(self, dsn, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        # ThreadedConnectionPool raises PoolError once maxconn connections are
+        # out, callers queue here for one to come back instead
+        self._available = threading.BoundedSemaphore(maxconn)
+        self.timeout = timeout
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        with self._lock:
+            last_used = self._last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < DB_HEALTHCHECK_INTERVAL:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        if not self._available.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError(
+                f"No database connection free after {self.timeout:g}s"
+            )
+        try:
+            # Managed Postgres drops idle connections, so anything stale gets
+            # discarded and replaced rather than failing the request
+            for _ in range(DB_POOL_MAX + 1):
+                conn = self._pool.getconn()
+                if self._healthy(conn):
+                    return conn
+                self._pool.putconn(conn, close=True)
+                with self._lock:
+                    self._last_used.pop(id(conn), None)
+            raise psycopg2.OperationalError("No healthy database connection available")
+        except Exception:
+            self._available.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            if close:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+        self._pool.putconn(conn, close=close)
+        self._available.release()
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ConnectionPool(os.getenv("DATABASE_URL"))
+                _pool_pid = os.getpid()
+    return _pool
+
+
+@contextmanager
+def connection():
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken or conn.closed != 0)
+
+
+def migrate():
+    # Idempotent, but takes locks on the violations table, so it runs as a
+    # deploy step (python db.py) rather than from request handlers
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            for statement in SCHEMA_MIGRATIONS:
+                cursor.execute(statement)
+
+
+def _adapt(value):
+    if isinstance(value, (dict, list)):
+        return psycopg2.extras.Json(value)
+    return value
+
+
+def _row_values(row):
+    return tuple(_adapt(row.get(column)) for column in VIOLATION_COLUMNS)
+
+
+def insert_violation(row):
+    insert_query = f"""
+    INSERT INTO violations ({", ".join(VIOLATION_COLUMNS)})
+    VALUES ({", ".join(["%s"] * len(VIOLATION_COLUMNS))})
+    {UPSERT_CLAUSE}
+    RETURNING id;
+    """
+    with metrics.span("database"), connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(insert_query, _row_values(row))
+            return cursor.fetchone()[0]
+
+
+def insert_violations(rows):
+    # Multi-row INSERT for batch jobs, ids come back in row order
+    rows = list(rows)
+    if not rows:
+        return []
+
+    # One statement can't upsert the same tile_key twice, the last row for a
+    # key wins and every row for it gets the same id back
+    unique = []
+    positions = []
+    seen = {}
+    for row in rows:
+        key = row.get("tile_key")
+        if key is not None and key in seen:
+            unique[seen[key]] = row
+        else:
+            if key is not None:
+                seen[key] = len(unique)
+            unique.append(row)
+        positions.append(seen[key] if key is not None else len(unique) - 1)
+
+    insert_query = f"""
+    INSERT INTO violations ({", ".join(VIOLATION_COLUMNS)})
+    VALUES %s
+    {UPSERT_CLAUSE}
+    RETURNING id;
+    """
+    with metrics.span("database"), connection() as conn:
+        with conn.cursor() as cursor:
+            result = psycopg2.extras.execute_values(
+                cursor,
+                insert_query,
+                [_row_values(row) for row in unique],
+                page_size=max(len(unique), 1),
+                fetch=True,
+            )
+            ids = [r[0] for r in result]
+            return [ids[position] for position in positions]
+
+
+def copy_violations(rows):
+    # COPY is the fastest path for large backfills but doesn't return ids or
+    # upsert, rows must not carry a tile_key already in the table
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    count = 0
+    for row in rows:
+        values = []
+        for column in VIOLATION_COLUMNS:
+            value = row.get(column)
+            if value is None:
+                value = "\\N"
+            elif isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            values.append(value)
+        writer.writerow(values)
+        count += 1
+    buf.seek(0)
+
+    with connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY violations ({', '.join(VIOLATION_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+                buf,
+            )
+    return count
+
+
+class WriteBehindQueue:
+    # Inserts queued rows from a background thread so the HTTP response doesn't
+    # wait on Postgres. Rows are grouped into multi-row INSERTs.
+
+    def __init__(self, batch_size=DB_WRITE_BEHIND_BATCH, max_wait_ms=DB_WRITE_BEHIND_WAIT_MS):
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, row):
+        future = Future()
+        self._queue.put((row, future))
+        return future
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def flush(self, timeout=None):
+        done = Future()
+        self._queue.put((None, done))
+        return done.result(timeout=timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size and batch[-1][0] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            markers = [future for row, future in batch if row is None]
+            batch = [(row, future) for row, future in batch if row is not None]
+            if batch:
+                self._write(batch)
+            for marker in markers:
+                marker.set_result(True)
+
+    def _write(self, batch):
+        try:
+            ids = insert_violations([row for row, _ in batch])
+        except Exception as error:
+            log.error("Error writing %d violations: %s", len(batch), error)
+            for _, future in batch:
+                future.set_exception(error)
+            return
+        for (_, future), new_id in zip(batch, ids):
+            future.set_result(new_id)
+
+
+_write_behind = None
+_write_behind_pid = None
+
+
+def get_write_behind():
+    global _write_behind, _write_behind_pid
+    if _write_behind is None or _write_behind_pid != os.getpid():
+        with _pool_lock:
+            if _write_behind is None or _write_behind_pid != os.getpid():
+                _write_behind = WriteBehindQueue()
+                _write_behind_pid = os.getpid()
+                atexit.register(_write_behind.flush, 10)
+    return _write_behind
+
+
+if __name__ == "__main__":
+    migrate()
+    print(f"Applied {len(SCHEMA_MIGRATIONS)} schema migrations")
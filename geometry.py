@@ -0,0 +1,215 @@
+import numpy as np
+import shapely
+
+# Predictions from client.infer come back as [{"x": .., "y": ..}, ...] dicts.
+# PredictionSet converts a response once into packed coordinate arrays (every
+# ring closed, concatenated, with ring offsets) so areas, class filtering and
+# shapely conversion run over all predictions at once.
+
+
+def _close_rings(coords, lengths):
+    # Appends each ring's first point to its end, fully vectorized
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    closed_lengths = lengths + 1
+    offsets = np.concatenate(([0], np.cumsum(closed_lengths))).astype(np.int64)
+
+    position = np.arange(offsets[-1]) - np.repeat(offsets[:-1], closed_lengths)
+    position[position == np.repeat(lengths, closed_lengths)] = 0
+    return coords[np.repeat(starts, closed_lengths) + position], offsets
+
+
+def _gather_rings(coords, offsets, indices):
+    lengths = np.diff(offsets)[indices]
+    new_offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    source = np.repeat(offsets[:-1][indices], lengths) + (
+        np.arange(new_offsets[-1]) - np.repeat(new_offsets[:-1], lengths)
+    )
+    return coords[source], new_offsets
+
+
+class PredictionSet:
+    __slots__ = ("coords", "ring_offsets", "classes", "confidences")
+
+    def __init__(self, coords, ring_offsets, classes, confidences):
+        self.coords = coords
+        self.ring_offsets = ring_offsets
+        self.classes = classes
+        self.confidences = confidences
+
+    @classmethod
+    def empty(cls):
+        return cls(
+            np.empty((0, 2), dtype=np.float64),
+            np.zeros(1, dtype=np.int64),
+            np.empty(0, dtype=object),
+            np.empty(0, dtype=np.float64),
+        )
+
+    @classmethod
+    def from_inference(cls, result):
+        # Predictions with fewer than three points can't form a polygon and
+        # are dropped here
+        predictions = [
+            prediction
+            for prediction in result.get("predictions", [])
+            if len(prediction.get("points") or ()) >= 3
+        ]
+        if not predictions:
+            return cls.empty()
+
+        lengths = np.fromiter(
+            (len(prediction["points"]) for prediction in predictions),
+            dtype=np.int64,
+            count=len(predictions),
+        )
+        flat = np.fromiter(
+            (
+                value
+                for prediction in predictions
+                for point in prediction["points"]
+                for value in (point["x"], point["y"])
+            ),
+            dtype=np.float64,
+            count=int(lengths.sum()) * 2,
+        ).reshape(-1, 2)
+
+        coords, offsets = _close_rings(flat, lengths)
+        classes = np.array([prediction.get("class") for prediction in predictions], dtype=object)
+        confidences = np.fromiter(
+            (prediction.get("confidence", 0.0) for prediction in predictions),
+            dtype=np.float64,
+            count=len(predictions),
+        )
+        return cls(coords, offsets, classes, confidences)
+
+    @classmethod
+    def from_shapely(cls, polygons, classes, confidences=None):
+        # Exterior rings only, predictions never carry holes
+        polygons = np.asarray(polygons, dtype=object)
+        if len(polygons) == 0:
+            return cls.empty()
+        exteriors = shapely.get_exterior_ring(polygons)
+        coords, index = shapely.get_coordinates(exteriors, return_index=True)
+        lengths = np.bincount(index, minlength=len(polygons))
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        if confidences is None:
+            confidences = np.zeros(len(polygons), dtype=np.float64)
+        return cls(
+            coords,
+            offsets,
+            np.asarray(classes, dtype=object),
+            np.asarray(confidences, dtype=np.float64),
+        )
+
+    @classmethod
+    def concat(cls, sets):
+        sets = [prediction_set for prediction_set in sets if len(prediction_set)]
+        if not sets:
+            return cls.empty()
+        coords = np.concatenate([s.coords for s in sets])
+        sizes = np.array([len(s.coords) for s in sets])
+        shifts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+        offsets = np.concatenate(
+            [[0]] + [s.ring_offsets[1:] + shift for s, shift in zip(sets, shifts)]
+        ).astype(np.int64)
+        return cls(
+            coords,
+            offsets,
+            np.concatenate([s.classes for s in sets]),
+            np.concatenate([s.confidences for s in sets]),
+        )
+
+    def __len__(self):
+        return len(self.ring_offsets) - 1
+
+    def areas(self):
+        # Shoelace over every ring at once. Cross terms that would join the
+        # end of one ring to the start of the next are zeroed out.
+        if len(self) == 0:
+            return np.empty(0, dtype=np.float64)
+
+        x = self.coords[:, 0]
+        y = self.coords[:, 1]
+        cross = np.empty(len(x), dtype=np.float64)
+        cross[:-1] = x[:-1] * y[1:] - x[1:] * y[:-1]
+        cross[-1] = 0.0
+        cross[self.ring_offsets[1:-1] - 1] = 0.0
+        return 0.5 * np.abs(np.add.reduceat(cross, self.ring_offsets[:-1]))
+
+    def total_area(self):
+        return float(self.areas().sum())
+
+    def select(self, indices):
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        if len(indices) == 0:
+            return PredictionSet.empty()
+        coords, offsets = _gather_rings(self.coords, self.ring_offsets, indices)
+        return PredictionSet(
+            coords, offsets, self.classes[indices], self.confidences[indices]
+        )
+
+    def filter(self, class_name, min_confidence=None):
+        mask = self.classes == class_name
+        if min_confidence is not None:
+            mask &= self.confidences >= min_confidence
+        return self.select(mask)
+
+    def translate(self, dx, dy):
+        return PredictionSet(
+            self.coords + np.array([dx, dy], dtype=np.float64),
+            self.ring_offsets,
+            self.classes,
+            self.confidences,
+        )
+
+    def bounds(self):
+        # (minx, miny, maxx, maxy) per polygon
+        if len(self) == 0:
+            return np.empty((0, 4), dtype=np.float64)
+        starts = self.ring_offsets[:-1]
+        return np.column_stack(
+            (
+                np.minimum.reduceat(self.coords[:, 0], starts),
+                np.minimum.reduceat(self.coords[:, 1], starts),
+                np.maximum.reduceat(self.coords[:, 0], starts),
+                np.maximum.reduceat(self.coords[:, 1], starts),
+            )
+        )
+
+    def to_shapely(self, make_valid=True):
+        # Array of shapely 2.x Polygons built straight from the packed arrays.
+        # Model output can self-intersect, make_valid keeps later overlays from
+        # raising TopologyException.
+        if len(self) == 0:
+            return np.empty(0, dtype=object)
+        polygons = shapely.from_ragged_array(
+            shapely.GeometryType.POLYGON,
+            self.coords,
+            (self.ring_offsets, np.arange(len(self) + 1, dtype=np.int64)),
+        )
+        if make_valid:
+            invalid = ~shapely.is_valid(polygons)
+            if invalid.any():
+                polygons[invalid] = shapely.make_valid(polygons[invalid])
+        return polygons
+
+    def to_inference(self):
+        # Back to the client.infer response shape, e.g. for rendering
+        predictions = []
+        for index in range(len(self)):
+            ring = self.coords[self.ring_offsets[index] : self.ring_offsets[index + 1] - 1]
+            predictions.append(
+                {
+                    "class": str(self.classes[index]),
+                    "confidence": float(self.confidences[index]),
+                    "points": [{"x": float(x), "y": float(y)} for x, y in ring],
+                }
+            )
+        return {"predictions": predictions}
+
+
+def from_results(results):
+    # {key: inference response} -> {key: PredictionSet}
+    return {key: PredictionSet.from_inference(result) for key, result in results.items()}
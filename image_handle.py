@@ -0,0 +1,115 @@
+import base64
+import hashlib
+import io
+
+import numpy as np
+from PIL import Image
+
+import metrics
+
+# Encoded image bytes travel through the pipeline as-is (tile fetch ->
+# inference -> rendering -> storage); decoding happens at most once and only
+# when pixels are actually needed, and base64 only at the JSON boundary.
+
+_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+)
+
+
+def sniff_mime_type(data):
+    for signature, mime_type in _SIGNATURES:
+        if data[: len(signature)] == signature:
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+class ImageHandle:
+    __slots__ = ("data", "mime_type", "_pil", "_array", "_digest")
+
+    def __init__(self, data, mime_type=None, pil_image=None):
+        self.data = bytes(data)
+        self.mime_type = mime_type or sniff_mime_type(self.data)
+        self._pil = pil_image
+        self._array = None
+        self._digest = None
+
+    @classmethod
+    def from_base64(cls, encoded):
+        return cls(base64.b64decode(encoded))
+
+    @classmethod
+    def from_path(cls, path):
+        with open(path, "rb") as file:
+            return cls(file.read())
+
+    @classmethod
+    def from_pil(cls, pil_image, format="PNG", **save_kwargs):
+        buf = io.BytesIO()
+        pil_image.save(buf, format=format, **save_kwargs)
+        return cls(buf.getvalue(), pil_image=pil_image)
+
+    @property
+    def pil(self):
+        if self._pil is None:
+            with metrics.span("decode"):
+                pil_image = Image.open(io.BytesIO(self.data))
+                if pil_image.mode not in ("RGB", "L"):
+                    pil_image = pil_image.convert("RGB")
+                pil_image.load()
+            self._pil = pil_image
+        return self._pil
+
+    @property
+    def array(self):
+        # Read-only view over the decoded pixels, shared by every consumer
+        if self._array is None:
+            array = np.asarray(self.pil)
+            array.flags.writeable = False
+            self._array = array
+        return self._array
+
+    @property
+    def size(self):
+        return self.pil.size
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+
+    def to_base64(self):
+        return base64.b64encode(self.data).decode("utf-8")
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            file.write(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    # Only the encoded bytes cross process boundaries, decoded pixels are
+    # rebuilt lazily on the other side
+    def __getstate__(self):
+        return (self.data, self.mime_type)
+
+    def __setstate__(self, state):
+        self.data, self.mime_type = state
+        self._pil = None
+        self._array = None
+        self._digest = None
+
+
+def as_image_handle(image):
+    # Accept handles, raw bytes or legacy base64 strings from older callers
+    if isinstance(image, ImageHandle):
+        return image
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return ImageHandle(image)
+    if isinstance(image, str):
+        return ImageHandle.from_base64(image)
+    raise TypeError(f"Unsupported image type: {type(image).__name__}")
@@ -0,0 +1,135 @@
+import bisect
+import os
+import threading
+
+from image_handle import sniff_mime_type
+
+# Sorted listing of a results folder (ssed/) kept in memory. The directory is
+# only rescanned when its mtime changes, and then only new or removed names
+# are handled. Writers in this process record their files directly, so
+# paging through the listing never re-lists the folder or touches file
+# contents.
+
+IMAGE_INDEX_DIR = os.getenv("IMAGE_INDEX_DIR", "ssed")
+IMAGE_INDEX_PAGE_SIZE = int(os.getenv("IMAGE_INDEX_PAGE_SIZE", 100))
+IMAGE_INDEX_MAX_PAGE_SIZE = int(os.getenv("IMAGE_INDEX_MAX_PAGE_SIZE", 1000))
+
+
+class ImageIndex:
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self._lock = threading.Lock()
+        self._names = []
+        # name -> {"size", "modified", "mime_type"}
+        self._entries = {}
+        self._dir_mtime = None
+
+    def _stat_entry(self, name, stat):
+        previous = self._entries.get(name)
+        mime_type = None
+        if previous and previous["modified"] == stat.st_mtime and previous["size"] == stat.st_size:
+            mime_type = previous["mime_type"]
+        return {"size": stat.st_size, "modified": stat.st_mtime, "mime_type": mime_type}
+
+    def _stat_dir(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        dir_mtime = self._stat_dir()
+        if dir_mtime == self._dir_mtime:
+            return
+
+        with self._lock:
+            if dir_mtime == self._dir_mtime:
+                return
+            # Only names that appeared or went away are looked at, entries
+            # already known keep their stat
+            names = set()
+            added = []
+            if dir_mtime is not None:
+                with os.scandir(self.directory) as scan:
+                    for entry in scan:
+                        if entry.name in self._entries:
+                            names.add(entry.name)
+                        elif entry.is_file():
+                            names.add(entry.name)
+                            added.append(entry.name)
+                            self._entries[entry.name] = self._stat_entry(entry.name, entry.stat())
+            if len(names) < len(self._entries):
+                for name in self._entries.keys() - names:
+                    del self._entries[name]
+                self._names = [name for name in self._names if name in names]
+            if added:
+                # Both runs are sorted already, timsort merges them in one pass
+                self._names = sorted(self._names + sorted(added))
+            self._dir_mtime = dir_mtime
+
+    def record(self, name, dir_mtime=None):
+        # Called by writers after saving a file, an overwrite keeps the
+        # directory mtime unchanged so it would otherwise be missed.
+        # dir_mtime is the directory's mtime from before the write: if the
+        # listing was current then, this write is the only change and the
+        # next refresh has nothing to rescan.
+        path = os.path.join(self.directory, name)
+        stat = os.stat(path)
+        current = self._stat_dir()
+        with self._lock:
+            if name not in self._entries:
+                bisect.insort(self._names, name)
+            self._entries[name] = self._stat_entry(name, stat)
+            if dir_mtime is not None and dir_mtime == self._dir_mtime:
+                self._dir_mtime = current
+
+    def save(self, name, image):
+        dir_mtime = self._stat_dir()
+        image.save(os.path.join(self.directory, name))
+        self.record(name, dir_mtime)
+
+    def get(self, name):
+        self.refresh()
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        if entry["mime_type"] is None:
+            with open(os.path.join(self.directory, name), "rb") as file:
+                entry["mime_type"] = sniff_mime_type(file.read(16))
+        return entry
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def page(self, after=None, limit=IMAGE_INDEX_PAGE_SIZE):
+        # Cursor is the last name of the previous page
+        self.refresh()
+        limit = max(1, min(int(limit), IMAGE_INDEX_MAX_PAGE_SIZE))
+        with self._lock:
+            start = bisect.bisect_right(self._names, after) if after else 0
+            names = self._names[start : start + limit + 1]
+            items = [
+                {
+                    "name": name,
+                    "size": self._entries[name]["size"],
+                    "modified": self._entries[name]["modified"],
+                }
+                for name in names[:limit]
+            ]
+            total = len(self._names)
+        next_cursor = items[-1]["name"] if len(names) > limit else None
+        return {"images": items, "next_cursor": next_cursor, "total": total}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                os.makedirs(IMAGE_INDEX_DIR, exist_ok=True)
+                _index = ImageIndex(IMAGE_INDEX_DIR)
+    return _index
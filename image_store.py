@@ -0,0 +1,211 @@
+import os
+import re
+import threading
+
+from dotenv import load_dotenv
+
+from image_handle import ImageHandle, as_image_handle
+
+# Settings are read at import, also when run as the backfill script
+load_dotenv()
+
+# Rendered before/after images are stored as objects keyed by the sha256 of
+# their bytes, so identical renders are only stored once. The violations row
+# only keeps the key, size and dimensions.
+
+IMAGE_STORE = os.getenv("IMAGE_STORE", "local")
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_store")
+IMAGE_STORE_BUCKET = os.getenv("IMAGE_STORE_BUCKET")
+IMAGE_STORE_ENDPOINT = os.getenv("IMAGE_STORE_ENDPOINT")
+IMAGE_STORE_PREFIX = os.getenv("IMAGE_STORE_PREFIX", "violations/")
+
+EXTENSIONS = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+CONTENT_TYPES = {extension: mime for mime, extension in EXTENSIONS.items()}
+
+KEY_PATTERN = re.compile(r"^[0-9a-f]{64}\.(png|jpg|webp|gif)$")
+
+
+def is_valid_key(key):
+    return bool(KEY_PATTERN.match(key))
+
+
+def content_type_for(key):
+    return CONTENT_TYPES.get(key.rsplit(".", 1)[-1], "application/octet-stream")
+
+
+def key_for(image):
+    image = as_image_handle(image)
+    return f"{image.digest}.{EXTENSIONS.get(image.mime_type, 'bin')}"
+
+
+def describe(image, key):
+    width, height = image.size
+    return {
+        "key": key,
+        "size": len(image.data),
+        "width": width,
+        "height": height,
+        "content_type": image.mime_type,
+    }
+
+
+class LocalImageStore:
+    def __init__(self, root=IMAGE_STORE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def put(self, image):
+        image = as_image_handle(image)
+        key = key_for(image)
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(image.data)
+            os.replace(tmp_path, path)
+        return describe(image, key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        with open(self.path(key), "rb") as file:
+            return ImageHandle(file.read(), content_type_for(key))
+
+
+class S3ImageStore:
+    # Works against AWS S3 or any S3-compatible endpoint (MinIO, R2, ...)
+
+    def __init__(
+        self, bucket=IMAGE_STORE_BUCKET, endpoint_url=IMAGE_STORE_ENDPOINT, prefix=IMAGE_STORE_PREFIX
+    ):
+        try:
+            import boto3
+        except ImportError as error:
+            raise RuntimeError("IMAGE_STORE=s3 requires boto3 to be installed") from error
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def object_key(self, key):
+        return f"{self.prefix}{key}"
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except ClientError:
+            return False
+
+    def put(self, image):
+        image = as_image_handle(image)
+        key = key_for(image)
+        if not self.exists(key):
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.object_key(key),
+                Body=image.data,
+                ContentType=image.mime_type,
+                CacheControl="public, max-age=31536000, immutable",
+            )
+        return describe(image, key)
+
+    def get(self, key):
+        response = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))
+        return ImageHandle(response["Body"].read(), content_type_for(key))
+
+    def get_range(self, key, byte_range=None):
+        # Returns the boto3 response so the caller can stream Body in chunks
+        kwargs = {"Bucket": self.bucket, "Key": self.object_key(key)}
+        if byte_range:
+            kwargs["Range"] = byte_range
+        return self.client.get_object(**kwargs)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if IMAGE_STORE == "s3":
+                    _store = S3ImageStore()
+                else:
+                    _store = LocalImageStore()
+    return _store
+
+
+def store_columns(prefix, image):
+    # Row columns for one stored image, prefix is before_img or after_img
+    stored = get_store().put(image)
+    return {
+        f"{prefix}_key": stored["key"],
+        f"{prefix}_size": stored["size"],
+        f"{prefix}_width": stored["width"],
+        f"{prefix}_height": stored["height"],
+    }
+
+
+def store_pair(before_img, after_img):
+    # Row columns for a before/after pair
+    row = store_columns("before_img", before_img)
+    row.update(store_columns("after_img", after_img))
+    return row
+
+
+def backfill_database(batch_size=100):
+    # Moves base64 images still sitting in old violations rows into the store
+    import db
+
+    db.migrate()
+    moved = 0
+    while True:
+        with db.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT id, before_img, after_img FROM violations
+                    WHERE before_img IS NOT NULL OR after_img IS NOT NULL
+                    ORDER BY id LIMIT %s
+                    """,
+                    (batch_size,),
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    return moved
+
+                for violation_id, before_img, after_img in rows:
+                    # Either column can be NULL in old rows, only the images
+                    # that exist are moved
+                    columns = {}
+                    for prefix, encoded in (("before_img", before_img), ("after_img", after_img)):
+                        if encoded:
+                            columns.update(
+                                store_columns(prefix, ImageHandle.from_base64(encoded))
+                            )
+                    assignments = "".join(f"{column} = %s, " for column in columns)
+                    cursor.execute(
+                        f"UPDATE violations SET {assignments}before_img = NULL, after_img = NULL WHERE id = %s",
+                        tuple(columns.values()) + (violation_id,),
+                    )
+                    moved += 1
+        print(f"Moved images for {moved} violations")
+
+
+if __name__ == "__main__":
+    print(f"Backfilled {backfill_database()} violations")
@@ -0,0 +1,171 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Inference results memoized by (sha256 of the image bytes, project, model
+# version). The model version is part of the key, so bumping MODEL_VERSION
+# misses on every old entry and those rows are purged on start-up.
+
+DEFAULT_CACHE_PATH = "inference_cache.sqlite3"
+DEFAULT_TTL = 30 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 200000
+
+
+class InferenceCache:
+    def __init__(
+        self,
+        path,
+        project_id,
+        model_version,
+        ttl=DEFAULT_TTL,
+        max_entries=DEFAULT_MAX_ENTRIES,
+    ):
+        self.project_id = str(project_id)
+        self.model_version = str(model_version)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                digest TEXT NOT NULL,
+                project_id TEXT NOT NULL,
+                model_version TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (digest, project_id, model_version)
+            )
+            """
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+        )
+        self.purge_stale_versions()
+
+    def purge_stale_versions(self):
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM results WHERE project_id=? AND model_version != ?",
+                (self.project_id, self.model_version),
+            )
+            self.evictions += cursor.rowcount
+
+    def get_many(self, digests):
+        # Returns {digest: result} for the digests that are cached and fresh
+        digests = list(set(digests))
+        if not digests:
+            return {}
+
+        now = time.time()
+        found = {}
+        with self._lock:
+            for start in range(0, len(digests), 500):
+                chunk = digests[start : start + 500]
+                rows = self._db.execute(
+                    f"""
+                    SELECT digest, result, created_at FROM results
+                    WHERE project_id=? AND model_version=?
+                    AND digest IN ({", ".join("?" * len(chunk))})
+                    """,
+                    (self.project_id, self.model_version, *chunk),
+                ).fetchall()
+                for digest, result, created_at in rows:
+                    if now - created_at <= self.ttl:
+                        found[digest] = json.loads(result)
+
+            if found:
+                self._db.executemany(
+                    "UPDATE results SET last_used=? WHERE digest=? AND project_id=? AND model_version=?",
+                    [(now, d, self.project_id, self.model_version) for d in found],
+                )
+            self.hits += len(found)
+            self.misses += len(digests) - len(found)
+        return found
+
+    def put_many(self, results):
+        # results maps digest -> inference response
+        if not results:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        digest,
+                        self.project_id,
+                        self.model_version,
+                        json.dumps(result),
+                        now,
+                        now,
+                    )
+                    for digest, result in results.items()
+                ],
+            )
+            self._evict()
+
+    def _evict(self):
+        cursor = self._db.execute(
+            "DELETE FROM results WHERE created_at < ?", (time.time() - self.ttl,)
+        )
+        self.evictions += cursor.rowcount
+
+        count = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            cursor = self._db.execute(
+                """
+                DELETE FROM results WHERE rowid IN (
+                    SELECT rowid FROM results ORDER BY last_used LIMIT ?
+                )
+                """,
+                (count - self.max_entries,),
+            )
+            self.evictions += cursor.rowcount
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            "entries": self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0],
+            "model_version": self.model_version,
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(project_id, model_version):
+    # INFERENCE_CACHE_PATH="" disables the cache
+    path = os.getenv("INFERENCE_CACHE_PATH", DEFAULT_CACHE_PATH)
+    if not path:
+        return None
+
+    key = (os.getpid(), str(project_id), str(model_version))
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = InferenceCache(
+                path,
+                project_id,
+                model_version,
+                ttl=float(os.getenv("INFERENCE_CACHE_TTL", DEFAULT_TTL)),
+                max_entries=int(
+                    os.getenv("INFERENCE_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES)
+                ),
+            )
+            _caches[key] = cache
+    return cache
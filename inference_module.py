@@ -1,262 +1,315 @@
-from inference_sdk import InferenceHTTPClient
+from inference_sdk import InferenceConfiguration, InferenceHTTPClient
 from PIL import Image
-import matplotlib.pyplot as plt
 import os
 import numpy as np
-import io
-import base64
-import cv2
-
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from image_handle import as_image_handle
+import inference_cache
+import metrics
+import preprocessing
+import similarity
+from geometry import from_results
+from change_detection import detect_changes
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-def configure_client(api_key, api_url):
-    os.environ["API_KEY"] = api_key
-    return InferenceHTTPClient(api_url=api_url, api_key=os.environ["API_KEY"])
-
+log = logging.getLogger(__name__)
 
-def polygon_area(points):
-    x = [p["x"] for p in points]
-    y = [p["y"] for p in points]
-    return 0.5 * np.abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+# Number of images sent per inference request, how many requests may be in
+# flight at once, and how long a partial batch waits for more images
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", 8))
+INFERENCE_MAX_CONCURRENCY = int(os.getenv("INFERENCE_MAX_CONCURRENCY", 4))
+INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", 20))
 
 
-from shapely.geometry import MultiPolygon, Polygon
-from matplotlib.patches import Polygon as MplPolygon
-
-
-def draw_predictions(image, predictions, fill_color="red", alpha=1.0):
-    plt.figure(figsize=(10, 10))
-    plt.imshow(image)
-    ax = plt.gca()
-
-    if isinstance(predictions, MultiPolygon):
-        # Iterate over each Polygon in the MultiPolygon
-        for polygon in predictions.geoms:
-            x, y = polygon.exterior.xy
-            ax.add_patch(
-                MplPolygon(
-                    np.column_stack([x, y]), 
-                    fill=True, 
-                    edgecolor=fill_color, 
-                    facecolor=fill_color, 
-                    alpha=alpha
-                )
-            )
-    elif isinstance(predictions, Polygon):
-        # Handle a single Polygon
-        x, y = predictions.exterior.xy
-        ax.add_patch(
-            MplPolygon(
-                np.column_stack([x, y]), 
-                fill=True, 
-                edgecolor=fill_color, 
-                facecolor=fill_color, 
-                alpha=alpha
-            )
+def configure_client(api_key, api_url):
+    os.environ["API_KEY"] = api_key
+    client = InferenceHTTPClient(api_url=api_url, api_key=os.environ["API_KEY"])
+    client.configure(
+        InferenceConfiguration(
+            max_batch_size=INFERENCE_BATCH_SIZE,
+            max_concurrent_requests=INFERENCE_MAX_CONCURRENCY,
         )
-    else:
-        # Assuming predictions is a dictionary with key "predictions"
-        for prediction in predictions["predictions"]:
-            points = prediction["points"]
-            mpl_polygon = MplPolygon(
-                [(p["x"], p["y"]) for p in points], 
-                fill=True, 
-                edgecolor=fill_color, 
-                facecolor=fill_color, 
-                alpha=alpha
-            )
-            ax.add_patch(mpl_polygon)
-            ax.text(
-                points[0]["x"],
-                points[0]["y"],
-                prediction["class"],
-                color="white",
-                fontsize=12,
+    )
+    return client
+
+
+def infer_images(client, images, project_id, model_version):
+    # Send a list of images in as few inference requests as the client's batch
+    # size allows, results come back in the same order as the images
+    if not images:
+        return []
+    results = client.infer(list(images), model_id=f"{project_id}/{model_version}")
+    if isinstance(results, dict):
+        results = [results]
+    return results
+
+
+def infer_cached(images, project_id, model_version, infer):
+    # images are ImageHandles, infer takes a list of PIL images and returns the
+    # results in order. Only images whose bytes haven't been seen for this
+    # model version (and preprocessing config) reach the inference server.
+    cache = inference_cache.get_cache(project_id, model_version)
+    if cache is None:
+        return infer(preprocessing.prepare(images))
+
+    # Results of preprocessed tiles are cached apart from raw ones
+    config = preprocessing.config_key()
+    keys = [image.digest if config is None else f"{image.digest}:{config}" for image in images]
+    cached = cache.get_many(keys)
+    metrics.CACHE_REQUESTS.inc(len(cached), cache="inference", result="hit")
+    metrics.CACHE_REQUESTS.inc(len(keys) - len(cached), cache="inference", result="miss")
+
+    missing = {}
+    for key, image in zip(keys, images):
+        if key not in cached and key not in missing:
+            missing[key] = image
+
+    fresh = {}
+    if missing:
+        results = infer(preprocessing.prepare(list(missing.values())))
+        fresh = dict(zip(missing.keys(), results))
+        cache.put_many(fresh)
+
+    return [cached[key] if key in cached else fresh[key] for key in keys]
+
+
+class InferenceBatcher:
+    # Collects images submitted from many threads (e.g. concurrent scans) and
+    # flushes them to the inference server as one batch once batch_size images
+    # are waiting or the oldest one has waited max_wait_ms
+
+    def __init__(
+        self,
+        client,
+        project_id,
+        model_version,
+        batch_size=INFERENCE_BATCH_SIZE,
+        max_wait_ms=INFERENCE_MAX_WAIT_MS,
+        max_concurrency=INFERENCE_MAX_CONCURRENCY,
+    ):
+        self.client = client
+        self.project_id = project_id
+        self.model_version = model_version
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_concurrency), thread_name_prefix="inference"
+        )
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, image):
+        future = Future()
+        self._queue.put((image, future))
+        return future
+
+    def infer_many(self, images):
+        futures = [self.submit(image) for image in images]
+        return [future.result() for future in futures]
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch):
+        metrics.INFERENCE_IMAGES.inc(len(batch))
+        try:
+            with metrics.span("inference"):
+                results = infer_images(
+                    self.client,
+                    [image for image, _ in batch],
+                    self.project_id,
+                    self.model_version,
+                )
+        except Exception as error:
+            metrics.INFERENCE_ERRORS.inc(error=type(error).__name__)
+            metrics.UPSTREAM_RESPONSES.inc(
+                upstream="inference", status=getattr(error, "status_code", None) or "error"
             )
+            for _, future in batch:
+                future.set_exception(error)
+            return
 
-    plt.axis("off")
-    plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-
-    buf = io.BytesIO()
-    plt.savefig(buf, format="png", bbox_inches="tight", pad_inches=0)
-    buf.seek(0)
-    plt.close()
-    return base64.b64encode(buf.read()).decode("utf-8")
+        metrics.UPSTREAM_RESPONSES.inc(upstream="inference", status=200)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
 
 
-from skimage import exposure, img_as_ubyte
+_batchers = {}
+_batchers_lock = threading.Lock()
 
 
-def preprocess_image(pil_image):
-    # Convert PIL image to numpy array
-    img_array = np.array(pil_image)
+def get_batcher(api_key, api_url, project_id, model_version):
+    # One batcher per model and process so concurrent requests share batches
+    key = (os.getpid(), api_url, project_id, model_version)
+    with _batchers_lock:
+        batcher = _batchers.get(key)
+        if batcher is None:
+            batcher = InferenceBatcher(
+                configure_client(api_key, api_url), project_id, model_version
+            )
+            _batchers[key] = batcher
+    return batcher
 
-    # Apply CLAHE
-    if img_array.ndim == 3:
-        # Convert the image to LAB color space
-        lab = cv2.cvtColor(img_array, cv2.COLOR_RGB2LAB)
-        l, a, b = cv2.split(lab)
 
-        # Apply CLAHE to the L channel
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        cl = clahe.apply(l)
+def polygon_area(points):
+    x = np.fromiter((p["x"] for p in points), dtype=np.float64, count=len(points))
+    y = np.fromiter((p["y"] for p in points), dtype=np.float64, count=len(points))
+    return 0.5 * np.abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
 
-        # Merge the CLAHE enhanced L channel back with A and B channels
-        limg = cv2.merge((cl, a, b))
 
-        # Convert LAB back to RGB
-        img_array = cv2.cvtColor(limg, cv2.COLOR_LAB2RGB)
-    else:
-        # Apply CLAHE to the grayscale image
-        img_array = exposure.equalize_adapthist(img_array, clip_limit=0.03)
-        img_array = img_as_ubyte(img_array)
+from overlay import render_overlay
 
-    # Convert back to PIL image
-    return Image.fromarray(img_array)
 
+def draw_predictions(image, predictions, fill_color="red", alpha=1.0):
+    # Rendered straight onto the tile at native resolution, see overlay.py
+    return render_overlay(image, predictions, fill_color=fill_color, alpha=alpha)
 
-def process_image(base64_image, client, project_id, model_version):
-    image_data = base64.b64decode(base64_image)
-    pil_image = Image.open(io.BytesIO(image_data))
 
-    if pil_image.mode == "RGBA":
+def preprocess_image(pil_image):
+    # Always applies CLAHE, whatever PREPROCESS_CLAHE says, see preprocessing.py
+    if pil_image.mode not in ("RGB", "L"):
         pil_image = pil_image.convert("RGB")
+    return Image.fromarray(preprocessing.apply_stack(np.array(pil_image)[None])[0])
+
+
+def load_image(image):
+    # Raw tile bytes stay encoded until something needs the pixels
+    return as_image_handle(image)
 
-    # Preprocess the image using CLAHE
-    # preprocessed_image = preprocess_image(pil_image)
 
-    preprocessed_image = pil_image
+def process_image(image, client, project_id, model_version):
+    handle = load_image(image)
+    pil_image = handle.pil
+
+    # CLAHE when PREPROCESS_CLAHE is on, the plain tile otherwise
+    preprocessed_image = preprocessing.prepare([handle])[0]
 
     results = client.infer(preprocessed_image, model_id=f"{project_id}/{model_version}")
 
     return results, pil_image
 
 
-# def main(api_key, api_url, project_id, model_version, base64_images):
-#     client = configure_client(api_key, api_url)
-#     processed_images = {}
-#     results = {}
-#     pil_images = {}
-#     for year, base64_image in base64_images.items():
-#         results[year], pil_images[year] = process_image(
-#             base64_image, client, project_id, model_version
-#         )
-
-
-#     total_area = 0
-#     for year, result in results.items():
-#         for prediction in result["predictions"]:
-#             if prediction["class"] == "hedge":
-#                 area = polygon_area(prediction["points"])
-#                 total_area += area
-#                 print(f"Detected hedge with area: {area:.2f} square pixels")
-
-#     from shapely.geometry import Polygon
-
-#     print("results",results)
-
-#     try:
-            
-#         hedge1 = Polygon(
-#             [(p["x"], p["y"]) for p in results["2024-03-07"]["predictions"][0]["points"]]
-#         )
-#         hedge2 = Polygon(
-#             [(p["x"], p["y"]) for p in results["2023-02-23"]["predictions"][0]["points"]]
-#         )
-
-#         difference = hedge1.difference(hedge2)
-#         print(
-#             f"Difference in area between 2024-03-07 and 2023-02-23: {difference.area:.2f} square pixels"
-#         )
-
-#         processed_images["difference"] = (draw_predictions(
-#             pil_images["2023-02-23"] , difference, fill_color="orange", alpha=0.4
-#         ))
-#         processed_images["2023-02-23"] = draw_predictions(
-#             pil_images["2024-03-07"], results["2023-02-23"], fill_color="blue", alpha=0
-#         )
-#     except:
-
-#         processed_images["difference"] = (draw_predictions(
-#             pil_images["2023-02-23"] , results["2023-02-23"], fill_color="orange", alpha=0
-#         ))
-#         processed_images["2023-02-23"] = draw_predictions(
-#             pil_images["2024-03-07"], results["2023-02-23"], fill_color="blue", alpha=0
-#         )
-        
-
-#     print(f"Total area of all detected hedges: {total_area:.2f} square pixels")
-
-#     return processed_images
-
-def main(api_key, api_url, project_id, model_version, base64_images):
-    client = configure_client(api_key, api_url)
+def run(api_key, api_url, project_id, model_version, images, results=None, precheck=True):
+    # images maps release date -> image. Returns the rendered images, the
+    # percentage change between the two newest releases and the full change
+    # report across every release. Callers that already have inference
+    # results (e.g. from a mosaic) pass them in and skip inference here.
+    # Near-identical tiles short-circuit to an empty "unchanged" outcome.
     processed_images = {}
-    results = {}
     pil_images = {}
     hedge_areas = {}
 
-    for year, base64_image in base64_images.items():
-        results[year], pil_images[year] = process_image(
-            base64_image, client, project_id, model_version
-        )
+    for year, image in images.items():
+        pil_images[year] = load_image(image)
         hedge_areas[year] = 0  # Initialize area for each image
 
-    total_area = 0
-    for year, result in results.items():
-        for prediction in result["predictions"]:
-            if prediction["class"] == "hedge":
-                area = polygon_area(prediction["points"])
-                hedge_areas[year] += area  # Accumulate area for the specific image
-                total_area += area
-                print(f"Detected hedge with area: {area:.2f} square pixels")
-
-    from shapely.geometry import Polygon
-
-    # print("results", results)
+    years = list(pil_images.keys())
+    if results is None and precheck:
+        same, metric = similarity.unchanged([pil_images[year] for year in sorted(years)])
+        if same:
+            log.debug("Tiles unchanged between releases (max block difference %.1f)", metric)
+            return {
+                "processed_images": {},
+                "percentage_difference": 0,
+                "report": None,
+                "results": {},
+                "predictions": {},
+                "images": pil_images,
+                "unchanged": True,
+                "similarity": metric,
+            }
+
+    if results is None:
+        results = {}
+        # All years go through the shared batcher together instead of one
+        # client.infer call per year
+        batcher = get_batcher(api_key, api_url, project_id, model_version)
+        for year, result in zip(
+            years,
+            infer_cached(
+                [pil_images[y] for y in years],
+                project_id,
+                model_version,
+                batcher.infer_many,
+            ),
+        ):
+            results[year] = result
+
+    # Each response is packed into coordinate arrays once, areas and shapely
+    # polygons both come from the packed form
+    predictions = from_results(results)
 
-    try:
-        hedge1 = Polygon(
-            [(p["x"], p["y"]) for p in results["2024-03-07"]["predictions"][0]["points"]]
-        )
-        hedge2 = Polygon(
-            [(p["x"], p["y"]) for p in results["2023-02-23"]["predictions"][0]["points"]]
-        )
-
-        difference = hedge1.difference(hedge2)
-        print(
-            f"Difference in area between 2024-03-07 and 2023-02-23: {difference.area:.2f} square pixels"
+    total_area = 0
+    for year, prediction_set in predictions.items():
+        for area in prediction_set.filter("hedge").areas():
+            hedge_areas[year] += area  # Accumulate area for the specific image
+            total_area += area
+
+    with metrics.span("diff"):
+        report = detect_changes(predictions)
+    latest = report["latest"]
+    percentage_difference = None
+
+    if latest is not None:
+        before, after = latest["before"], latest["after"]
+        log.debug(
+            "Hedge loss between %s and %s: %.2f square pixels, gain: %.2f square pixels",
+            before, after, latest["loss_area"], latest["gain_area"],
         )
 
         processed_images["difference"] = draw_predictions(
-            pil_images["2023-02-23"], difference, fill_color="orange", alpha=0.4
+            pil_images[before], latest["loss"], fill_color="orange", alpha=0.4
         )
-        processed_images["2023-02-23"] = draw_predictions(
-            pil_images["2024-03-07"], results["2023-02-23"], fill_color="blue", alpha=0
+        processed_images[before] = draw_predictions(
+            pil_images[after], results[before], fill_color="blue", alpha=0
         )
 
-        # Calculate the percentage difference
-        area1 = hedge1.area
-        area2 = hedge2.area
-        percentage_difference = abs(area1 - area2) / ((area1 + area2) / 2) * 100
-        print(f"Percentage difference: {percentage_difference:.2f}%")
+        percentage_difference = latest["percentage_difference"]
+        if percentage_difference is not None:
+            log.debug("Percentage difference: %.2f%%", percentage_difference)
+    else:
+        log.debug("Need at least two releases to detect changes")
+        for year in years:
+            processed_images[year] = draw_predictions(
+                pil_images[year], results[year], fill_color="blue", alpha=0
+            )
 
-    except Exception as e:
-        print(f"Error calculating areas or drawing predictions: {str(e)}")
-        processed_images["difference"] = draw_predictions(
-            pil_images["2023-02-23"], results["2023-02-23"], fill_color="orange", alpha=0
-        )
-        processed_images["2023-02-23"] = draw_predictions(
-            pil_images["2024-03-07"], results["2023-02-23"], fill_color="blue", alpha=0
-        )
-        percentage_difference = None
+    log.debug("Total area of all detected hedges: %.2f square pixels", total_area)
+
+    return {
+        "processed_images": processed_images,
+        "percentage_difference": percentage_difference,
+        "report": report,
+        "results": results,
+        "predictions": predictions,
+        "images": pil_images,
+    }
 
-    print(f"Total area of all detected hedges: {total_area:.2f} square pixels")
 
-    return processed_images, percentage_difference
+def main(api_key, api_url, project_id, model_version, images):
+    outcome = run(api_key, api_url, project_id, model_version, images)
+    return outcome["processed_images"], outcome["percentage_difference"]
 
 if __name__ == "__main__":
     api_key = os.getenv("API_KEY")
@@ -0,0 +1,263 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Submit/poll mode for /submit_scan. The web tier only enqueues work and hands
+# back a job id; scans run in a pool of worker processes so a slow upstream
+# never ties up a request thread.
+
+SCAN_JOB_WORKERS = int(os.getenv("SCAN_JOB_WORKERS", os.cpu_count() or 2))
+SCAN_JOB_MAX_QUEUE = int(os.getenv("SCAN_JOB_MAX_QUEUE", 500))
+# Finished jobs are kept this long for clients to collect their results
+SCAN_JOB_TTL = float(os.getenv("SCAN_JOB_TTL", 600))
+SCAN_JOB_START_METHOD = os.getenv("SCAN_JOB_START_METHOD", "spawn")
+
+
+class QueueFull(Exception):
+    pass
+
+
+def run_job(lat, lon):
+    # Runs inside a worker process
+    import scan_pipeline
+
+    started_at = time.time()
+    try:
+        result = scan_pipeline.run_scan(lat, lon)
+        return {"started_at": started_at, "result": result, "error": None}
+    except Exception as error:
+        return {"started_at": started_at, "result": None, "error": str(error)}
+
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+class JobQueue:
+    def __init__(self, workers=SCAN_JOB_WORKERS, max_queue=SCAN_JOB_MAX_QUEUE):
+        self.max_queue = max_queue
+        self._executor = self._new_executor(workers)
+        self._jobs = {}
+        self._futures = {}
+        # scan key -> id of the unfinished job scanning it
+        self._active = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+        self.workers = workers
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.stages = {}
+
+    def _new_executor(self, workers):
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context(SCAN_JOB_START_METHOD),
+        )
+
+    def _replace_broken(self, executor):
+        # A worker that dies (OOM kill, segfault) breaks the whole pool, every
+        # later submit would fail, so it gets replaced with a fresh one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = self._new_executor(self.workers)
+                executor.shutdown(wait=False, cancel_futures=True)
+                log.warning("Scan worker pool was broken, started a new one")
+
+    def _submit_job(self, lat, lon):
+        # (executor, future), the executor is needed to tell whether a later
+        # BrokenProcessPool is about the current pool
+        executor = self._executor
+        try:
+            return executor, executor.submit(run_job, lat, lon)
+        except BrokenProcessPool:
+            self._replace_broken(executor)
+            executor = self._executor
+            return executor, executor.submit(run_job, lat, lon)
+
+    def _expire(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job["finished_at"] and now - job["finished_at"] > SCAN_JOB_TTL:
+                del self._jobs[job_id]
+
+    def _pending(self):
+        return sum(1 for job in self._jobs.values() if job["finished_at"] is None)
+
+    def submit(self, lat, lon, key=None):
+        # Jobs with the same key share one queued/running job, workers are
+        # separate processes so this is where identical scans get coalesced
+        with self._lock:
+            self._expire()
+            if key is not None and key in self._active:
+                return self._active[key]
+            if self._pending() >= self.max_queue:
+                raise QueueFull("Scan queue is full, try again shortly")
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "id": job_id,
+                "status": "queued",
+                "lat": lat,
+                "lon": lon,
+                "key": key,
+                "submitted_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "error": None,
+            }
+            self.submitted += 1
+            if key is not None:
+                self._active[key] = job_id
+
+        try:
+            executor, future = self._submit_job(lat, lon)
+        except Exception:
+            # Otherwise the job would stay queued forever and identical scans
+            # would keep coalescing onto it
+            with self._lock:
+                self._jobs.pop(job_id, None)
+                if key is not None and self._active.get(key) == job_id:
+                    del self._active[key]
+                self.submitted -= 1
+            raise
+
+        with self._lock:
+            self._futures[job_id] = future
+        future.add_done_callback(
+            lambda f, job_id=job_id, executor=executor: self._finish(job_id, f, executor)
+        )
+        return job_id
+
+    def _finish(self, job_id, future, executor):
+        try:
+            outcome = future.result()
+        except Exception as error:
+            # The worker process itself died
+            outcome = {"started_at": None, "result": None, "error": str(error)}
+            if isinstance(error, BrokenProcessPool):
+                self._replace_broken(executor)
+
+        with self._changed:
+            self._futures.pop(job_id, None)
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            if self._active.get(job["key"]) == job_id:
+                del self._active[job["key"]]
+
+            job["started_at"] = outcome["started_at"]
+            job["finished_at"] = time.time()
+            job["result"] = outcome["result"]
+            job["error"] = outcome["error"]
+            job["status"] = "failed" if outcome["error"] else "done"
+
+            if outcome["error"]:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+            if job["started_at"]:
+                self._record("queue_wait", job["started_at"] - job["submitted_at"])
+                self._record("total", job["finished_at"] - job["submitted_at"])
+            for stage, seconds in ((outcome["result"] or {}).get("timings") or {}).items():
+                self._record(stage, seconds)
+
+            self._changed.notify_all()
+
+    def _record(self, stage, seconds):
+        if stage not in self.stages:
+            self.stages[stage] = StageStats()
+        self.stages[stage].add(seconds)
+        # Worker processes keep their own metrics, their timings reach
+        # /metrics through here
+        metrics.JOB_STAGE_SECONDS.observe(seconds, stage=stage)
+
+    def _snapshot(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        job = dict(job)
+        future = self._futures.get(job_id)
+        if job["status"] == "queued" and future is not None and future.running():
+            job["status"] = "running"
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._snapshot(job_id)
+
+    def watch(self, job_id, poll_interval=0.5):
+        # Yields job snapshots until the job finishes
+        while True:
+            with self._changed:
+                job = self._snapshot(job_id)
+                if job is None:
+                    return
+                if job["finished_at"] is None:
+                    self._changed.wait(timeout=poll_interval)
+                    job = self._snapshot(job_id)
+            if job is None:
+                return
+            yield job
+            if job["finished_at"] is not None:
+                return
+
+    def stats(self):
+        with self._lock:
+            running = sum(
+                1
+                for job_id, future in self._futures.items()
+                if future.running()
+            )
+            pending = self._pending()
+            return {
+                "workers": self.workers,
+                "queue_depth": pending - running,
+                "running": running,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "stages": {
+                    stage: stats.to_dict() for stage, stats in self.stages.items()
+                },
+            }
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                _job_queue = JobQueue()
+    return _job_queue
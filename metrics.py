@@ -0,0 +1,203 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process counters and histograms rendered in the Prometheus text format
+# on /metrics. Recording is a dict lookup and an increment under a per-metric
+# lock, cheap enough for the per-tile hot path. Each process keeps its own
+# values; scan job workers report their stage timings back through jobs.py,
+# async scan workers through collect_stages.
+
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(
+                (key, (list(counts), total, count))
+                for key, (counts, total, count) in self._values.items()
+            )
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = Histogram(
+    "sceach_stage_seconds",
+    "Time spent in each scan stage (fetch, decode, inference, diff, render, database)",
+    ("stage",),
+)
+JOB_STAGE_SECONDS = Histogram(
+    "sceach_job_stage_seconds",
+    "Stage timings reported by scan job worker processes, plus queue_wait and total",
+    ("stage",),
+)
+HTTP_REQUESTS = Counter(
+    "sceach_http_requests_total", "HTTP requests served", ("method", "endpoint", "status")
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "sceach_http_request_seconds", "HTTP request latency", ("endpoint",)
+)
+CACHE_REQUESTS = Counter(
+    "sceach_cache_requests_total", "Cache lookups by cache and result", ("cache", "result")
+)
+UPSTREAM_RESPONSES = Counter(
+    "sceach_upstream_responses_total",
+    "Responses from upstream services by status code (or error)",
+    ("upstream", "status"),
+)
+UPSTREAM_REJECTED = Counter(
+    "sceach_upstream_rejected_total",
+    "Upstream requests refused locally by the outbound limiter, by reason",
+    ("host", "reason"),
+)
+UPSTREAM_WAIT_SECONDS = Histogram(
+    "sceach_upstream_wait_seconds",
+    "Time requests waited for an outbound limiter slot",
+    ("host",),
+)
+SIMILARITY_CHECKS = Counter(
+    "sceach_similarity_checks_total",
+    "Pixel pre-checks before inference, by outcome (unchanged skips inference)",
+    ("result",),
+)
+INFERENCE_IMAGES = Counter(
+    "sceach_inference_images_total", "Images sent to the inference server"
+)
+INFERENCE_ERRORS = Counter(
+    "sceach_inference_errors_total", "Failed inference requests", ("error",)
+)
+
+
+_collecting = threading.local()
+
+
+@contextmanager
+def span(stage):
+    # `with metrics.span("fetch"):` or `@metrics.span("render")`
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        stages = getattr(_collecting, "stages", None)
+        if stages is not None:
+            stages.append((stage, seconds))
+
+
+@contextmanager
+def collect_stages():
+    # Also keeps the spans of this thread as [(stage, seconds)], so a worker
+    # process can send them back to be recorded where /metrics is served
+    stages = []
+    _collecting.stages = stages
+    try:
+        yield stages
+    finally:
+        _collecting.stages = None
+
+
+def record_stages(stages):
+    for stage, seconds in stages:
+        STAGE_SECONDS.observe(seconds, stage=stage)
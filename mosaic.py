@@ -0,0 +1,207 @@
+import hashlib
+import os
+
+import numpy as np
+import shapely
+from PIL import Image
+
+import inference_module
+import wayback
+from geometry import PredictionSet
+from image_handle import ImageHandle
+from tile_math import TILE_SIZE
+
+# Hedges that cross a tile edge get clipped when a single tile is inferred.
+# The mosaic stage fetches the neighbourhood around the scanned tile, stitches
+# it into one array and infers on the whole mosaic (or on overlapping windows
+# of it). Predictions are merged across seams, then clipped to the centre
+# tile and returned in its pixel coordinates. Off by default: a radius of 1
+# fetches 9 tiles per release instead of 1.
+
+SCAN_MOSAIC_RADIUS = int(os.getenv("SCAN_MOSAIC_RADIUS", 0))
+# "full" infers the whole mosaic at once, "windows" infers overlapping windows
+MOSAIC_MODE = os.getenv("MOSAIC_MODE", "full")
+MOSAIC_WINDOW = int(os.getenv("MOSAIC_WINDOW", 512))
+MOSAIC_STRIDE = int(os.getenv("MOSAIC_STRIDE", 256))
+
+
+class Mosaic:
+    __slots__ = ("radius", "tiles", "array", "digest")
+
+    def __init__(self, radius, tiles, tile_size=TILE_SIZE):
+        # tiles maps (dx, dy) offsets from the centre to ImageHandles (or None
+        # where the upstream had no imagery, left black)
+        self.radius = radius
+        self.tiles = tiles
+
+        side = (2 * radius + 1) * tile_size
+        # Every tile is decoded straight into its slot of one preallocated
+        # array, no intermediate row/column concatenation
+        self.array = np.zeros((side, side, 3), dtype=np.uint8)
+        digest = hashlib.sha256(f"mosaic:{radius}".encode())
+        for (dx, dy), tile in sorted(tiles.items()):
+            digest.update(f"{dx},{dy}:".encode())
+            if tile is None:
+                continue
+            digest.update(tile.digest.encode())
+            pixels = tile.array
+            if pixels.ndim == 2:
+                pixels = pixels[..., None]
+            top = (dy + radius) * tile_size
+            left = (dx + radius) * tile_size
+            self.array[top : top + tile_size, left : left + tile_size] = pixels[
+                :tile_size, :tile_size, :3
+            ]
+        self.digest = digest.hexdigest()
+
+    @property
+    def center(self):
+        return self.tiles.get((0, 0))
+
+
+class MosaicWindow:
+    # Quacks like an ImageHandle as far as inference_module.infer_cached is
+    # concerned: a cache digest plus a PIL image built from an array view
+    __slots__ = ("array", "left", "top", "digest", "_pil")
+
+    def __init__(self, mosaic, left, top, size):
+        self.array = mosaic.array[top : top + size, left : left + size]
+        self.left = left
+        self.top = top
+        self.digest = hashlib.sha256(
+            f"{mosaic.digest}:{left},{top},{size}".encode()
+        ).hexdigest()
+        self._pil = None
+
+    @property
+    def pil(self):
+        if self._pil is None:
+            self._pil = Image.fromarray(self.array)
+        return self._pil
+
+
+def offsets(radius):
+    return [
+        (dx, dy)
+        for dy in range(-radius, radius + 1)
+        for dx in range(-radius, radius + 1)
+    ]
+
+
+def fetch_mosaics(years_versions, zoom, xtile, ytile, radius=SCAN_MOSAIC_RADIUS):
+    # One concurrent fetch for every tile of every release, neighbours are
+    # served from and written to the tile cache like any other tile
+    requests = mosaic_requests(years_versions, zoom, xtile, ytile, radius)
+    return build_mosaics(years_versions, wayback.fetch_tiles(requests), radius)
+
+
+def mosaic_requests(years_versions, zoom, xtile, ytile, radius=SCAN_MOSAIC_RADIUS):
+    return {
+        (year, dx, dy): (version, zoom, xtile + dx, ytile + dy)
+        for year, version in years_versions.items()
+        for dx, dy in offsets(radius)
+    }
+
+
+def build_mosaics(years_versions, fetched, radius=SCAN_MOSAIC_RADIUS):
+    # fetched maps (year, dx, dy) -> tile bytes or None
+    mosaics = {}
+    for year in years_versions:
+        tiles = {}
+        for dx, dy in offsets(radius):
+            data = fetched[(year, dx, dy)]
+            tiles[(dx, dy)] = ImageHandle(data) if data else None
+        mosaics[year] = Mosaic(radius, tiles)
+    return mosaics
+
+
+def windows(mosaic, mode=MOSAIC_MODE, size=MOSAIC_WINDOW, stride=MOSAIC_STRIDE):
+    side = mosaic.array.shape[0]
+    if mode != "windows" or size >= side:
+        return [MosaicWindow(mosaic, 0, 0, side)]
+
+    starts = list(range(0, side - size + 1, stride))
+    if starts[-1] != side - size:
+        starts.append(side - size)
+    return [MosaicWindow(mosaic, left, top, size) for top in starts for left in starts]
+
+
+def merge(prediction_sets, center_box, shift):
+    # Predictions from overlapping windows are unioned per class, so a hedge
+    # split by a window seam (or detected twice in an overlap) becomes one
+    # polygon. Parts are then clipped to the centre tile, so areas and
+    # geometry never include hedge outside the scanned tile.
+    combined = PredictionSet.concat(prediction_sets)
+    if len(combined) == 0:
+        return PredictionSet.empty()
+
+    polygons = combined.to_shapely()
+    merged = []
+    merged_classes = []
+    merged_confidences = []
+    for class_name in np.unique(combined.classes.astype(str)):
+        mask = combined.classes == class_name
+        class_polygons = polygons[mask]
+        parts = shapely.get_parts(shapely.union_all(class_polygons))
+        parts = parts[(shapely.get_type_id(parts) == 3) & shapely.intersects(parts, center_box)]
+        if len(parts) == 0:
+            continue
+
+        # Each merged part keeps the best confidence among its members
+        tree = shapely.STRtree(class_polygons)
+        part_index, member_index = tree.query(parts, predicate="intersects")
+        confidences = np.zeros(len(parts), dtype=np.float64)
+        np.maximum.at(confidences, part_index, combined.confidences[mask][member_index])
+
+        # Clipping can split a part or leave only an edge where it merely
+        # touched the tile, only polygon pieces with area are kept
+        clipped, part_of = shapely.get_parts(
+            shapely.intersection(parts, center_box), return_index=True
+        )
+        keep = (shapely.get_type_id(clipped) == 3) & (shapely.area(clipped) > 0)
+        clipped = clipped[keep]
+        if len(clipped) == 0:
+            continue
+
+        merged.append(clipped)
+        merged_classes.extend([class_name] * len(clipped))
+        merged_confidences.append(confidences[part_of[keep]])
+
+    if not merged:
+        return PredictionSet.empty()
+    return PredictionSet.from_shapely(
+        np.concatenate(merged), merged_classes, np.concatenate(merged_confidences)
+    ).translate(-shift, -shift)
+
+
+def infer_mosaics(mosaics, project_id, model_version, infer):
+    # mosaics maps year -> Mosaic, infer takes a list of PIL images. Returns
+    # year -> inference response in centre-tile pixel coordinates.
+    year_windows, flat = plan_windows(mosaics)
+    responses = inference_module.infer_cached(flat, project_id, model_version, infer)
+    return merge_responses(mosaics, year_windows, responses)
+
+
+def plan_windows(mosaics):
+    # Windows per year plus the flat list sent for inference, in that order
+    year_windows = {year: windows(mosaic) for year, mosaic in mosaics.items()}
+    flat = [window for year in mosaics for window in year_windows[year]]
+    return year_windows, flat
+
+
+def merge_responses(mosaics, year_windows, responses):
+    results = {}
+    position = 0
+    for year, mosaic in mosaics.items():
+        shift = mosaic.radius * TILE_SIZE
+        center_box = shapely.box(shift, shift, shift + TILE_SIZE, shift + TILE_SIZE)
+        sets = []
+        for window in year_windows[year]:
+            sets.append(
+                PredictionSet.from_inference(responses[position]).translate(
+                    window.left, window.top
+                )
+            )
+            position += 1
+        results[year] = merge(sets, center_box, shift).to_inference()
+    return results
@@ -0,0 +1,170 @@
+import io
+import os
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+from shapely.geometry import (
+    GeometryCollection,
+    LinearRing,
+    LineString,
+    MultiLineString,
+    MultiPoint,
+    MultiPolygon,
+    Point,
+    Polygon,
+)
+
+import metrics
+from image_handle import ImageHandle, as_image_handle
+
+# Draws predictions straight onto the tile at its native resolution instead of
+# going through a matplotlib figure. Fills are drawn into a mask and alpha
+# blended onto the tile, labels are drawn on top at full opacity.
+
+RENDER_FORMAT = os.getenv("RENDER_FORMAT", "PNG").upper()
+RENDER_QUALITY = int(os.getenv("RENDER_QUALITY", 85))
+
+MIME_TYPES = {"PNG": "image/png", "WEBP": "image/webp", "JPEG": "image/jpeg"}
+
+_font = None
+
+
+def get_font():
+    global _font
+    if _font is None:
+        try:
+            _font = ImageFont.load_default(size=12)
+        except TypeError:
+            # Pillow < 10.1 only has the fixed size bitmap font
+            _font = ImageFont.load_default()
+    return _font
+
+
+def rgba(color, alpha=1.0):
+    r, g, b = ImageColor.getrgb(color)[:3]
+    return (r, g, b, int(round(max(0.0, min(1.0, alpha)) * 255)))
+
+
+def iter_shapes(geometry):
+    # Flatten any shapely geometry into ("polygon", exterior, holes),
+    # ("line", coords) and ("point", (x, y)) primitives
+    if geometry is None or geometry.is_empty:
+        return
+    if isinstance(geometry, Polygon):
+        yield (
+            "polygon",
+            list(geometry.exterior.coords),
+            [list(ring.coords) for ring in geometry.interiors],
+        )
+    elif isinstance(geometry, (LineString, LinearRing)):
+        yield ("line", list(geometry.coords))
+    elif isinstance(geometry, Point):
+        yield ("point", (geometry.x, geometry.y))
+    elif isinstance(
+        geometry, (MultiPolygon, MultiLineString, MultiPoint, GeometryCollection)
+    ):
+        for geom in geometry.geoms:
+            yield from iter_shapes(geom)
+
+
+def iter_prediction_shapes(predictions):
+    # Inference responses as returned by client.infer, yields the shape and
+    # the label to draw at its first vertex
+    for prediction in predictions["predictions"]:
+        points = [(p["x"], p["y"]) for p in prediction["points"]]
+        if len(points) >= 3:
+            yield ("polygon", points, []), prediction["class"], points[0]
+        elif len(points) == 2:
+            yield ("line", points), prediction["class"], points[0]
+        elif points:
+            yield ("point", points[0]), prediction["class"], points[0]
+
+
+def encode(pil_image, format=None, quality=None):
+    format = (format or RENDER_FORMAT).upper()
+    if format == "JPG":
+        format = "JPEG"
+    if format not in MIME_TYPES:
+        raise ValueError(f"Unsupported render format: {format}")
+
+    quality = RENDER_QUALITY if quality is None else quality
+    buf = io.BytesIO()
+    if format == "JPEG":
+        pil_image.convert("RGB").save(buf, format="JPEG", quality=quality)
+    elif format == "WEBP":
+        pil_image.save(buf, format="WEBP", quality=quality)
+    else:
+        pil_image.save(buf, format="PNG")
+
+    return ImageHandle(buf.getvalue(), MIME_TYPES[format])
+
+
+@metrics.span("render")
+def render_overlay(
+    image,
+    predictions,
+    fill_color="red",
+    alpha=1.0,
+    fill=True,
+    line_color="blue",
+    label_color="white",
+    background=None,
+    format=None,
+    quality=None,
+):
+    if background is not None:
+        size = as_image_handle(image).size if image is not None else (256, 256)
+        base = Image.new("RGBA", size, background)
+    else:
+        base = as_image_handle(image).pil.convert("RGBA")
+
+    labels = []
+    if isinstance(predictions, dict):
+        shapes = []
+        for shape, label, anchor in iter_prediction_shapes(predictions):
+            shapes.append(shape)
+            labels.append((anchor, label))
+    else:
+        shapes = list(iter_shapes(predictions))
+
+    color = rgba(fill_color, alpha)
+
+    if fill:
+        # Polygons (with holes punched out) are rasterised into a single mask
+        # so overlapping shapes don't double up their alpha
+        mask = Image.new("L", base.size, 0)
+        mask_draw = ImageDraw.Draw(mask)
+        for shape in shapes:
+            if shape[0] == "polygon":
+                mask_draw.polygon(shape[1], fill=255, outline=255)
+                for hole in shape[2]:
+                    mask_draw.polygon(hole, fill=0)
+            elif shape[0] == "line":
+                mask_draw.line(shape[1], fill=255, width=1)
+
+        layer = Image.new("RGBA", base.size, (0, 0, 0, 0))
+        layer.paste(color, mask=mask)
+        base = Image.alpha_composite(base, layer)
+        draw = ImageDraw.Draw(base)
+        for shape in shapes:
+            if shape[0] == "point":
+                x, y = shape[1]
+                draw.ellipse((x - 2, y - 2, x + 2, y + 2), fill=rgba(line_color))
+    else:
+        draw = ImageDraw.Draw(base)
+        for shape in shapes:
+            if shape[0] == "polygon":
+                draw.line(shape[1] + shape[1][:1], fill=color, width=1)
+                for hole in shape[2]:
+                    draw.line(hole + hole[:1], fill=color, width=1)
+            elif shape[0] == "line":
+                draw.line(shape[1], fill=rgba(line_color), width=1)
+            elif shape[0] == "point":
+                x, y = shape[1]
+                draw.ellipse((x - 2, y - 2, x + 2, y + 2), fill=rgba(line_color))
+
+    if labels:
+        font = get_font()
+        for (x, y), label in labels:
+            draw.text((x, y), str(label), fill=rgba(label_color), font=font)
+
+    return encode(base, format=format, quality=quality)
@@ -0,0 +1,94 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Optional contrast enhancement of tiles before inference. CLAHE runs on the
+# lightness channel only (grayscale tiles directly), entirely in uint8 through
+# OpenCV. Tiles of the same shape are stacked so the colour conversions run
+# once per batch instead of once per tile.
+
+PREPROCESS_CLAHE = os.getenv("PREPROCESS_CLAHE", "0") == "1"
+CLAHE_CLIP_LIMIT = float(os.getenv("CLAHE_CLIP_LIMIT", 2.0))
+CLAHE_TILE_GRID = int(os.getenv("CLAHE_TILE_GRID", 8))
+
+# cv2.CLAHE objects aren't safe to share between threads, each thread keeps
+# its own instead of creating one per call
+_local = threading.local()
+
+
+def enabled():
+    return PREPROCESS_CLAHE
+
+
+def config_key():
+    # Part of the inference cache key, None when preprocessing is off so the
+    # cache entries of raw tiles stay valid
+    if not PREPROCESS_CLAHE:
+        return None
+    return f"clahe:{CLAHE_CLIP_LIMIT}:{CLAHE_TILE_GRID}"
+
+
+def get_clahe():
+    clahe = getattr(_local, "clahe", None)
+    if clahe is None:
+        clahe = cv2.createCLAHE(
+            clipLimit=CLAHE_CLIP_LIMIT, tileGridSize=(CLAHE_TILE_GRID, CLAHE_TILE_GRID)
+        )
+        _local.clahe = clahe
+    return clahe
+
+
+def clahe_gray(stack):
+    # stack is an owned (n, h, w) uint8 array, equalized in place
+    clahe = get_clahe()
+    for plane in stack:
+        clahe.apply(plane, dst=plane)
+    return stack
+
+
+def clahe_rgb(stack):
+    # stack is an owned (n, h, w, 3) uint8 array, equalized in place. Colour
+    # conversion is per pixel, so the whole stack converts as one tall image.
+    n, height, width, _ = stack.shape
+    tall = stack.reshape(n * height, width, 3)
+    cv2.cvtColor(tall, cv2.COLOR_RGB2LAB, dst=tall)
+    lightness = np.ascontiguousarray(stack[..., 0])
+    clahe_gray(lightness)
+    stack[..., 0] = lightness
+    cv2.cvtColor(tall, cv2.COLOR_LAB2RGB, dst=tall)
+    return stack
+
+
+def apply_stack(stack):
+    stack = np.ascontiguousarray(stack, dtype=np.uint8)
+    if stack.ndim == 3:
+        return clahe_gray(stack)
+    return clahe_rgb(stack)
+
+
+def prepare(images):
+    # images quack like ImageHandles (.array and .pil). Returns the PIL images
+    # to send for inference, in order.
+    if not PREPROCESS_CLAHE:
+        return [image.pil for image in images]
+
+    groups = {}
+    for index, image in enumerate(images):
+        array = image.array
+        if array.ndim == 3 and array.shape[2] == 4:
+            array = array[..., :3]
+        groups.setdefault(array.shape, []).append((index, array))
+
+    prepared = [None] * len(images)
+    for members in groups.values():
+        # np.stack copies, so the read-only tile arrays are never touched
+        stack = apply_stack(np.stack([array for _, array in members]))
+        for (index, _), pixels in zip(members, stack):
+            prepared[index] = Image.fromarray(pixels)
+    return prepared
@@ -0,0 +1,355 @@
+import logging
+import os
+import time
+
+import psycopg2
+
+import change_index
+import db
+import image_store
+import inference_module
+import metrics
+import mosaic
+import similarity
+import wayback
+from singleflight import SingleFlight
+from change_detection import summarize
+from image_handle import ImageHandle
+from tile_math import (
+    geometry_area_m2,
+    geometry_to_lonlat,
+    ground_resolution,
+    latlon_to_tile,
+    tile_center,
+    to_geojson,
+)
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+api_key = os.getenv("API_KEY")
+api_url = os.getenv("API_URL")
+project_id = os.getenv("PROJECT_ID")
+model_version = int(os.getenv("MODEL_VERSION"))
+
+ZOOM = 18
+# Identical scans finishing within this window are answered from memory
+SCAN_RESULT_TTL = float(os.getenv("SCAN_RESULT_TTL", 60))
+SCAN_RESULT_CACHE_ITEMS = int(os.getenv("SCAN_RESULT_CACHE_ITEMS", 64))
+
+_scans = SingleFlight(SCAN_RESULT_TTL, SCAN_RESULT_CACHE_ITEMS)
+
+
+class ScanError(Exception):
+    pass
+
+
+def save_to_database(
+    description,
+    latitude,
+    longitude,
+    county,
+    severity,
+    status,
+    before_img,
+    after_img,
+    extra=None,
+):
+    row = {
+        "description": description,
+        "latitude": latitude,
+        "longitude": longitude,
+        "county": county,
+        "severity": severity,
+        "status": status,
+    }
+    # Structured columns such as the georeferenced loss geometry
+    row.update(extra or {})
+    return save_violation(row, before_img, after_img)
+
+
+def save_violation(row, before_img, after_img):
+    # Image bytes go to the image store, the row only keeps keys and sizes
+    row.update(image_store.store_pair(before_img, after_img))
+
+    if db.DB_WRITE_BEHIND:
+        # Queued for the background writer, the id isn't known yet
+        db.get_write_behind().submit(row)
+        return None
+
+    try:
+        return db.insert_violation(row)
+    except (Exception, psycopg2.DatabaseError) as error:
+        log.error("Error saving violation: %s", error)
+        raise
+
+
+def georeference(report, xtile, ytile, zoom):
+    # Square pixels -> square metres and pixel geometry -> lon/lat GeoJSON
+    center_lat, _ = tile_center(xtile, ytile, zoom)
+    pixel_m2 = float(ground_resolution(center_lat, zoom) ** 2)
+
+    geo = {
+        "metres_per_pixel": float(ground_resolution(center_lat, zoom)),
+        "areas_m2": {epoch: area * pixel_m2 for epoch, area in report["areas"].items()},
+        "loss_area_m2": 0.0,
+        "gain_area_m2": 0.0,
+        "loss": None,
+        "gain": None,
+    }
+
+    latest = report["latest"]
+    if latest is not None:
+        loss_m2, gain_m2 = geometry_area_m2(
+            [latest["loss"], latest["gain"]], xtile, ytile, zoom
+        )
+        geo["loss_area_m2"] = float(loss_m2)
+        geo["gain_area_m2"] = float(gain_m2)
+        geo["loss"] = to_geojson(geometry_to_lonlat(latest["loss"], xtile, ytile, zoom))
+        geo["gain"] = to_geojson(geometry_to_lonlat(latest["gain"], xtile, ytile, zoom))
+    return geo
+
+
+def releases_for_tile(xtile, ytile, zoom=ZOOM):
+    # The two newest releases with distinct imagery when the tile is in the
+    # change index (a single release if it never changed), otherwise the
+    # configured WAYBACK_RELEASES
+    index = change_index.get_index()
+    if index is not None:
+        pair = index.pair(xtile, ytile, zoom)
+        if pair:
+            return pair
+    return wayback.enabled_releases()
+
+
+def unchanged_scan(xtile, ytile, zoom, years_versions, timings, similarity=None):
+    # Result for a tile whose imagery is the same in every compared release
+    # (per the change index, or the pixel pre-check), nothing was inferred
+    center_lat, _ = tile_center(xtile, ytile, zoom)
+    return {
+        "xtile": xtile,
+        "ytile": ytile,
+        "zoom": zoom,
+        "processed_images": {},
+        "percentage_difference": 0,
+        "report": None,
+        "geo": {
+            "metres_per_pixel": float(ground_resolution(center_lat, zoom)),
+            "areas_m2": {},
+            "loss_area_m2": 0.0,
+            "gain_area_m2": 0.0,
+            "loss": None,
+            "gain": None,
+        },
+        "timings": timings,
+        "unchanged": True,
+        "releases": list(years_versions),
+        "similarity": similarity,
+    }
+
+
+def precheck(xtile, ytile, zoom, tiles, timings):
+    # No-change result when every release's tile is near-identical to the
+    # previous one, None when inference is needed
+    same, metric = similarity.unchanged([tiles[year] for year in sorted(tiles)])
+    if not same:
+        return None
+    return unchanged_scan(xtile, ytile, zoom, tiles, timings, similarity=metric)
+
+
+def scan_tile(xtile, ytile, zoom=ZOOM, years_versions=None):
+    # Fetch -> infer -> diff -> render for a single tile, shared by
+    # /submit_scan and the area scans
+    if years_versions is None:
+        years_versions = releases_for_tile(xtile, ytile, zoom)
+    timings = {}
+
+    if len(years_versions) < 2:
+        return unchanged_scan(xtile, ytile, zoom, years_versions, timings)
+
+    if mosaic.SCAN_MOSAIC_RADIUS > 0:
+        return scan_mosaic(xtile, ytile, zoom, years_versions, timings)
+
+    # Fetch every enabled release at once over the shared session
+    started = time.perf_counter()
+    fetched = wayback.fetch_releases(years_versions, zoom, xtile, ytile)
+    timings["fetch"] = time.perf_counter() - started
+
+    tiles = {}
+    for year, tile_data in fetched.items():
+        if tile_data:
+            tiles[year] = ImageHandle(tile_data)
+        else:
+            raise ScanError(f"Failed to fetch tile for year {year}")
+
+    unchanged = precheck(xtile, ytile, zoom, tiles, timings)
+    if unchanged is not None:
+        return unchanged
+
+    return analyse(xtile, ytile, zoom, tiles, None, timings)
+
+
+def scan_mosaic(xtile, ytile, zoom, years_versions, timings):
+    # Infers on the neighbourhood around the tile so hedges crossing its
+    # edges are detected whole, see mosaic.py
+    started = time.perf_counter()
+    mosaics = mosaic.fetch_mosaics(
+        years_versions, zoom, xtile, ytile, mosaic.SCAN_MOSAIC_RADIUS
+    )
+    timings["fetch"] = time.perf_counter() - started
+
+    tiles = {}
+    for year, year_mosaic in mosaics.items():
+        if year_mosaic.center is None:
+            raise ScanError(f"Failed to fetch tile for year {year}")
+        tiles[year] = year_mosaic.center
+
+    unchanged = precheck(xtile, ytile, zoom, tiles, timings)
+    if unchanged is not None:
+        return unchanged
+
+    started = time.perf_counter()
+    batcher = inference_module.get_batcher(api_key, api_url, project_id, model_version)
+    results = mosaic.infer_mosaics(
+        mosaics, project_id, model_version, batcher.infer_many
+    )
+    timings["mosaic_inference"] = time.perf_counter() - started
+
+    return analyse(xtile, ytile, zoom, tiles, results, timings)
+
+
+def analyse(xtile, ytile, zoom, tiles, results, timings):
+    started = time.perf_counter()
+    # scan_tile already ran the pixel pre-check
+    outcome = inference_module.run(
+        api_key, api_url, project_id, model_version, tiles, results=results, precheck=False
+    )
+    processed_images = outcome["processed_images"]
+    percentage_difference = outcome["percentage_difference"]
+    timings["inference"] = time.perf_counter() - started
+
+    if percentage_difference == None:
+        percentage_difference = 0
+
+    try:
+        percentage_difference = percentage_difference.__round__(2)
+    except:
+        percentage_difference = 0
+
+    if len(processed_images) < 2:
+        raise ScanError("Not enough processed images returned")
+
+    return {
+        "xtile": xtile,
+        "ytile": ytile,
+        "zoom": zoom,
+        "processed_images": processed_images,
+        "percentage_difference": percentage_difference,
+        "report": outcome["report"],
+        "geo": georeference(outcome["report"], xtile, ytile, zoom),
+        "timings": timings,
+    }
+
+
+def analyse_collecting(*args):
+    # analyse for a worker process, its stage timings come back alongside the
+    # scan since the process's own metrics are never served
+    with metrics.collect_stages() as stages:
+        scan = analyse(*args)
+    return scan, stages
+
+
+def scan_key(xtile, ytile, zoom=ZOOM, years_versions=None):
+    # Everything that changes a scan's outcome: the tile, the releases
+    # compared and the model. Also stored as violations.tile_key.
+    if years_versions is None:
+        years_versions = releases_for_tile(xtile, ytile, zoom)
+    releases = ",".join(f"{year}:{version}" for year, version in sorted(years_versions.items()))
+    return f"{zoom}/{xtile}/{ytile}@{releases}#{project_id}/{model_version}"
+
+
+def scan_stats():
+    return _scans.stats()
+
+
+def run_scan(lat, lon, zoom=ZOOM):
+    # Full /submit_scan: scan the tile containing lat/lon, save the violation
+    # and build the JSON response. Runs in the request thread or in a job
+    # worker process, so it only returns plain JSON-able data. Concurrent
+    # scans of the same tile share one run, see singleflight.py.
+    xtile, ytile = latlon_to_tile(lat, lon, zoom)
+    years_versions = releases_for_tile(xtile, ytile, zoom)
+    key = scan_key(xtile, ytile, zoom, years_versions)
+    return _scans.do(
+        key, _run_scan, lat, lon, xtile, ytile, zoom, key, years_versions
+    )
+
+
+def violation_row(lat, lon, scan, key):
+    # The violations row for a finished scan, minus the image columns
+    percentage_difference = scan["percentage_difference"]
+    geo = scan["geo"]
+    return {
+        "description": str(percentage_difference) + "% - "+ "Illegal trimming of hedges",
+        "latitude": lat,
+        "longitude": lon,
+        "county": "Cork",
+        "severity": percentage_difference,
+        "status": "pending",
+        "tile_key": key,
+        "xtile": scan["xtile"],
+        "ytile": scan["ytile"],
+        "zoom": scan["zoom"],
+        "change_percent": percentage_difference,
+        "loss_area_m2": geo["loss_area_m2"],
+        "gain_area_m2": geo["gain_area_m2"],
+        "loss_geojson": geo["loss"],
+    }
+
+
+def _run_scan(lat, lon, xtile, ytile, zoom, key, years_versions):
+    scan = scan_tile(xtile, ytile, zoom, years_versions)
+    if scan.get("unchanged"):
+        # Nothing to review, no violation is recorded
+        return scan_response(scan, None)
+
+    # The first two rendered images are stored as before/after
+    processed_values = list(scan["processed_images"].values())
+
+    log.debug("Saving violation at lat %s, lon %s", lat, lon)
+    started = time.perf_counter()
+    try:
+        inserted_id = save_violation(
+            violation_row(lat, lon, scan, key), processed_values[0], processed_values[1]
+        )
+    except (Exception, psycopg2.DatabaseError):
+        raise ScanError("Failed to save processed images to the database")
+    scan["timings"]["database"] = time.perf_counter() - started
+
+    return scan_response(scan, inserted_id)
+
+
+def scan_response(scan, inserted_id):
+    processed_images = scan["processed_images"]
+    # Rendered images stay as raw bytes until here, the JSON response is the
+    # only place that needs base64
+    return {
+        "processed_images": {
+            key: image.to_base64() for key, image in processed_images.items()
+        },
+        "image_urls": {
+            key: f"/images/{image_store.key_for(image)}"
+            for key, image in processed_images.items()
+        },
+        "new_id": inserted_id,
+        "difference": scan["percentage_difference"],
+        "changes": summarize(scan["report"]) if scan["report"] else None,
+        "geo": scan["geo"],
+        "timings": scan["timings"],
+        "unchanged": scan.get("unchanged", False),
+        "similarity": scan.get("similarity"),
+    }
@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+# Cheap pre-check before inference: tiles are box-downsampled to small
+# grayscale thumbnails and compared block by block. Recompression noise
+# averages out inside a block, while a removed hedge still shifts the blocks
+# it covers by tens of grey levels, so the largest block difference separates
+# the two. Byte-identical tiles are caught from their digests without
+# decoding.
+
+# Largest per-block difference (0-255 grey levels) still treated as "no
+# change", 0 turns the pre-check off
+SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", 6))
+# Box filter factor, a 256px tile becomes a 32x32 thumbnail
+SIMILARITY_REDUCE = int(os.getenv("SIMILARITY_REDUCE", 8))
+
+
+def enabled():
+    return SIMILARITY_THRESHOLD > 0
+
+
+def thumbnail(image):
+    # image quacks like an ImageHandle (.pil)
+    pil_image = image.pil
+    if pil_image.mode != "L":
+        pil_image = pil_image.convert("L")
+    return np.asarray(pil_image.reduce(SIMILARITY_REDUCE), dtype=np.int16)
+
+
+def difference(image1, image2):
+    # Largest absolute block difference between two tiles, 0 for identical
+    # bytes. Tiles of different sizes are never considered similar.
+    if image1.digest == image2.digest:
+        return 0.0
+    thumb1 = thumbnail(image1)
+    thumb2 = thumbnail(image2)
+    if thumb1.shape != thumb2.shape:
+        return float("inf")
+    return float(np.abs(thumb1 - thumb2).max())
+
+
+def max_difference(images):
+    # images in release order, only consecutive releases are compared
+    return max(
+        (difference(before, after) for before, after in zip(images, images[1:])),
+        default=0.0,
+    )
+
+
+def unchanged(images, threshold=None):
+    # (is_unchanged, metric) for tiles in release order
+    threshold = SIMILARITY_THRESHOLD if threshold is None else threshold
+    if threshold <= 0 or len(images) < 2:
+        return False, None
+    with metrics.span("precheck"):
+        metric = max_difference(images)
+    result = metric <= threshold
+    metrics.SIMILARITY_CHECKS.inc(result="unchanged" if result else "changed")
+    return result, metric
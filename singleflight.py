@@ -0,0 +1,132 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Request coalescing: concurrent calls with the same key share one
+# computation, and finished results are kept for a short TTL so a burst of
+# identical requests right after it completes doesn't start another one.
+
+
+class SingleFlight:
+    def __init__(self, ttl=0.0, max_items=0):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        # key -> (expires_at, value), oldest first
+        self._results = OrderedDict()
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+
+    def _cached(self, key, now):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return entry
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            entry = self._cached(key, time.monotonic())
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            value = fn(*args, **kwargs)
+        except BaseException as error:
+            with self._lock:
+                del self._in_flight[key]
+            # Failures are handed to everyone waiting but never cached
+            future.set_exception(error)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            if self.ttl > 0 and self.max_items > 0:
+                self._results[key] = (time.monotonic() + self.ttl, value)
+                self._results.move_to_end(key)
+                while len(self._results) > self.max_items:
+                    self._results.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._in_flight),
+                "cached": len(self._results),
+                "hits": self.hits,
+                "shared": self.shared,
+                "misses": self.misses,
+            }
+
+
+class AsyncSingleFlight:
+    # Same contract for coroutines on one event loop. The shared computation
+    # runs as its own task, so a caller that disconnects doesn't cancel it for
+    # everyone else waiting on the key.
+
+    def __init__(self, ttl=0.0, max_items=0):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._in_flight = {}
+        self._results = OrderedDict()
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+
+    _cached = SingleFlight._cached
+
+    def _done(self, key, task):
+        self._in_flight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        if self.ttl > 0 and self.max_items > 0:
+            self._results[key] = (time.monotonic() + self.ttl, task.result())
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_items:
+                self._results.popitem(last=False)
+
+    async def do(self, key, fn, *args, **kwargs):
+        entry = self._cached(key, time.monotonic())
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done, key=key: self._done(key, done))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def stats(self):
+        return {
+            "in_flight": len(self._in_flight),
+            "cached": len(self._results),
+            "hits": self.hits,
+            "shared": self.shared,
+            "misses": self.misses,
+        }
@@ -0,0 +1,239 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Wayback releases are immutable once published, so a tile fetched for a given
+# (version, zoom, x, y) never needs to be downloaded again. Tiles are stored
+# content-addressed (sha256 of the bytes) so identical imagery shared between
+# releases is only kept once on disk, and an sqlite index maps tile keys to
+# blobs and tracks last access for LRU eviction.
+
+DEFAULT_CACHE_DIR = "tile_cache"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MEMORY_ITEMS = 256
+
+
+class TileCache:
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, memory_items=0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite3"),
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tiles (
+                version TEXT NOT NULL,
+                zoom INTEGER NOT NULL,
+                x INTEGER NOT NULL,
+                y INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (version, zoom, x, y)
+            )
+            """
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS tiles_digest ON tiles (digest)"
+        )
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            )
+            """
+        )
+        # Running total of blob bytes, so a put doesn't sum the whole table
+        self._total_bytes = self._sum_bytes()
+
+    def _sum_bytes(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest)
+
+    def _remember(self, key, data):
+        if not self.memory_items:
+            return
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, version, zoom, x, y):
+        key = (str(version), int(zoom), int(x), int(y))
+
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return data
+
+            row = self._db.execute(
+                "SELECT digest FROM tiles WHERE version=? AND zoom=? AND x=? AND y=?",
+                key,
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            try:
+                with open(self._blob_path(row[0]), "rb") as file:
+                    data = file.read()
+            except FileNotFoundError:
+                # Blob removed underneath us, treat it as a miss and drop the entry
+                self._db.execute(
+                    "DELETE FROM tiles WHERE version=? AND zoom=? AND x=? AND y=?",
+                    key,
+                )
+                self.misses += 1
+                return None
+
+            self._db.execute(
+                "UPDATE tiles SET last_used=? WHERE version=? AND zoom=? AND x=? AND y=?",
+                (time.time(),) + key,
+            )
+            self.hits += 1
+            self._remember(key, data)
+            return data
+
+    def put(self, version, zoom, x, y, data):
+        key = (str(version), int(zoom), int(x), int(y))
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write to a temp file first so readers never see a partial tile
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as file:
+                    file.write(data)
+                os.replace(tmp_path, path)
+
+            inserted = self._db.execute(
+                "INSERT OR IGNORE INTO blobs (digest, size) VALUES (?, ?)",
+                (digest, len(data)),
+            ).rowcount
+            if inserted:
+                self._total_bytes += len(data)
+            self._db.execute(
+                "INSERT OR REPLACE INTO tiles (version, zoom, x, y, digest, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                key + (digest, time.time()),
+            )
+            self._remember(key, data)
+            self._evict()
+
+        return digest
+
+    def digest(self, version, zoom, x, y):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest FROM tiles WHERE version=? AND zoom=? AND x=? AND y=?",
+                (str(version), int(zoom), int(x), int(y)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def total_bytes(self):
+        with self._lock:
+            return self._total_bytes
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        # Other processes sharing the directory add blobs too, recount once
+        # before deciding what to drop
+        total = self._sum_bytes()
+        while total > self.max_bytes:
+            row = self._db.execute(
+                "SELECT version, zoom, x, y, digest FROM tiles ORDER BY last_used LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+
+            key, digest = tuple(row[:4]), row[4]
+            self._db.execute(
+                "DELETE FROM tiles WHERE version=? AND zoom=? AND x=? AND y=?", key
+            )
+            self._memory.pop(key, None)
+            self.evictions += 1
+
+            # Only drop the blob once no other release points at the same bytes
+            still_used = self._db.execute(
+                "SELECT 1 FROM tiles WHERE digest=? LIMIT 1", (digest,)
+            ).fetchone()
+            if still_used is None:
+                size = self._db.execute(
+                    "SELECT size FROM blobs WHERE digest=?", (digest,)
+                ).fetchone()
+                self._db.execute("DELETE FROM blobs WHERE digest=?", (digest,))
+                try:
+                    os.remove(self._blob_path(digest))
+                except FileNotFoundError:
+                    pass
+                if size:
+                    total -= size[0]
+        self._total_bytes = total
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "memory_items": len(self._memory),
+        }
+
+
+_default_cache = None
+_default_cache_pid = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    # Shared cache configured from the environment, TILE_CACHE_DIR="" disables
+    # it. One per process, a forked child doesn't reuse the parent's sqlite
+    # connection.
+    global _default_cache, _default_cache_pid
+    if _default_cache is None or _default_cache_pid != os.getpid():
+        with _default_cache_lock:
+            if _default_cache is None or _default_cache_pid != os.getpid():
+                cache_dir = os.getenv("TILE_CACHE_DIR", DEFAULT_CACHE_DIR)
+                if not cache_dir:
+                    return None
+                _default_cache = TileCache(
+                    cache_dir,
+                    max_bytes=int(os.getenv("TILE_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+                    memory_items=int(
+                        os.getenv("TILE_CACHE_MEMORY_ITEMS", DEFAULT_MEMORY_ITEMS)
+                    ),
+                )
+                _default_cache_pid = os.getpid()
+    return _default_cache
@@ -0,0 +1,114 @@
+import math
+
+import numpy as np
+import shapely
+from shapely.geometry import mapping
+
+
+def latlon_to_tile(lat, lon, zoom):
+    lat_rad = math.radians(lat)
+    n = 2.0**zoom
+    xtile = int((lon + 180.0) / 360.0 * n)
+    ytile = int(
+        (1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi)
+        / 2.0
+        * n
+    )
+    return xtile, ytile
+
+
+def tile_to_latlon(xtile, ytile, zoom):
+    # North-west corner of the tile, pass fractional indices for other points
+    n = 2.0**zoom
+    lon = xtile / n * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * ytile / n))))
+    return lat, lon
+
+
+def tile_center(xtile, ytile, zoom):
+    return tile_to_latlon(xtile + 0.5, ytile + 0.5, zoom)
+
+
+def tile_bounds(xtile, ytile, zoom):
+    # (min_lon, min_lat, max_lon, max_lat), the same order shapely uses
+    north, west = tile_to_latlon(xtile, ytile, zoom)
+    south, east = tile_to_latlon(xtile + 1, ytile + 1, zoom)
+    return west, south, east, north
+
+
+# Web Mercator (EPSG:3857) constants, tiles are TILE_SIZE pixels square
+EARTH_RADIUS = 6378137.0
+EARTH_CIRCUMFERENCE = 2 * math.pi * EARTH_RADIUS
+TILE_SIZE = 256
+
+
+def ground_resolution(lat, zoom, tile_size=TILE_SIZE):
+    # Metres per pixel at the given latitude(s), works on scalars or arrays
+    return np.cos(np.radians(lat)) * EARTH_CIRCUMFERENCE / (tile_size * 2.0**zoom)
+
+
+def pixel_to_lonlat(coords, xtile, ytile, zoom, tile_size=TILE_SIZE):
+    # (N, 2) array of tile pixel (x, y) -> (N, 2) array of (lon, lat).
+    # lon/lat order so the output can go straight into shapely/GeoJSON.
+    coords = np.asarray(coords, dtype=np.float64)
+    world = tile_size * 2.0**zoom
+    global_x = xtile * tile_size + coords[..., 0]
+    global_y = ytile * tile_size + coords[..., 1]
+
+    lonlat = np.empty(coords.shape, dtype=np.float64)
+    lonlat[..., 0] = global_x / world * 360.0 - 180.0
+    lonlat[..., 1] = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * global_y / world))))
+    return lonlat
+
+
+def lonlat_to_pixel(coords, xtile, ytile, zoom, tile_size=TILE_SIZE):
+    # Inverse of pixel_to_lonlat
+    coords = np.asarray(coords, dtype=np.float64)
+    world = tile_size * 2.0**zoom
+    lat_rad = np.radians(coords[..., 1])
+
+    pixels = np.empty(coords.shape, dtype=np.float64)
+    pixels[..., 0] = (coords[..., 0] + 180.0) / 360.0 * world - xtile * tile_size
+    pixels[..., 1] = (
+        (1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) / 2.0 * world
+        - ytile * tile_size
+    )
+    return pixels
+
+
+def geometry_to_lonlat(geometries, xtile, ytile, zoom, tile_size=TILE_SIZE):
+    # Shapely geometry (or array of them) in tile pixels -> lon/lat, every
+    # vertex is transformed in one vectorized call
+    return shapely.transform(
+        geometries, lambda coords: pixel_to_lonlat(coords, xtile, ytile, zoom, tile_size)
+    )
+
+
+def pixel_area_to_m2(areas, lats, zoom, tile_size=TILE_SIZE):
+    # Square pixels at the given latitude(s) -> square metres
+    return np.asarray(areas, dtype=np.float64) * ground_resolution(lats, zoom, tile_size) ** 2
+
+
+def geometry_area_m2(geometries, xtile, ytile, zoom, tile_size=TILE_SIZE):
+    # Pixel areas scaled by the ground resolution at each geometry's centroid,
+    # accurate to well under a percent at tile scale
+    geometries = np.asarray(geometries, dtype=object)
+    areas = shapely.area(geometries)
+    centroids = shapely.get_coordinates(shapely.centroid(geometries))
+    if len(centroids) != geometries.size:
+        # Empty geometries have no centroid, their area is zero anyway
+        centroid_y = np.full(geometries.shape, tile_size / 2.0)
+        non_empty = ~shapely.is_empty(geometries)
+        centroid_y[non_empty] = centroids[:, 1]
+    else:
+        centroid_y = centroids[:, 1].reshape(geometries.shape)
+    lats = pixel_to_lonlat(
+        np.stack((np.zeros_like(centroid_y), centroid_y), axis=-1), xtile, ytile, zoom, tile_size
+    )[..., 1]
+    return pixel_area_to_m2(areas, lats, zoom, tile_size)
+
+
+def to_geojson(geometry):
+    if geometry is None or geometry.is_empty:
+        return None
+    return mapping(geometry)
@@ -0,0 +1,261 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+# Outbound limiter for upstream hosts (Wayback). Each host gets a token bucket
+# whose rate adapts AIMD style: it creeps up while responses are fine and is
+# cut multiplicatively on a 429, and a Retry-After header pauses the host for
+# as long as it asks. A circuit breaker stops sending after repeated failures
+# (5xx, timeouts and connection errors, not 429s) and lets one probe through
+# once the cooldown is over. Callers that can't get a slot in time get
+# UpstreamBusy, which the API turns into a 503 with Retry-After. Limits are
+# per process.
+
+# Requests per second each host starts at and never exceeds, 0 disables rate
+# limiting (the circuit breaker still applies)
+UPSTREAM_RATE = float(os.getenv("UPSTREAM_RATE", 50))
+UPSTREAM_MIN_RATE = float(os.getenv("UPSTREAM_MIN_RATE", 1))
+UPSTREAM_BURST = float(os.getenv("UPSTREAM_BURST", 50))
+# Additive increase in requests/s per second of clean responses, and the
+# factor the rate is multiplied by on a 429
+UPSTREAM_RATE_INCREASE = float(os.getenv("UPSTREAM_RATE_INCREASE", 1))
+UPSTREAM_RATE_DECREASE = float(os.getenv("UPSTREAM_RATE_DECREASE", 0.5))
+# Longest a request waits for a slot before failing with UpstreamBusy
+UPSTREAM_MAX_WAIT = float(os.getenv("UPSTREAM_MAX_WAIT", 10))
+UPSTREAM_BREAKER_FAILURES = int(os.getenv("UPSTREAM_BREAKER_FAILURES", 5))
+UPSTREAM_BREAKER_COOLDOWN = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", 30))
+# How many busy periods bulk sweeps wait out before giving up on a tile
+UPSTREAM_BULK_ATTEMPTS = int(os.getenv("UPSTREAM_BULK_ATTEMPTS", 5))
+
+# A burst of 429s from requests already in flight counts as one signal
+DECREASE_INTERVAL = 1.0
+
+
+class UpstreamBusy(Exception):
+    def __init__(self, host, retry_after, reason):
+        self.host = host
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+        super().__init__(f"Upstream {host} is busy ({reason}), retry in {self.retry_after}s")
+
+
+def parse_retry_after(value, now=None):
+    # Seconds to wait from a Retry-After header (delta-seconds or HTTP date)
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = time.time() if now is None else now
+    return max(0.0, when.timestamp() - now)
+
+
+class HostLimiter:
+    def __init__(
+        self,
+        host,
+        rate=UPSTREAM_RATE,
+        min_rate=UPSTREAM_MIN_RATE,
+        burst=UPSTREAM_BURST,
+        increase=UPSTREAM_RATE_INCREASE,
+        decrease=UPSTREAM_RATE_DECREASE,
+        max_wait=UPSTREAM_MAX_WAIT,
+        breaker_failures=UPSTREAM_BREAKER_FAILURES,
+        breaker_cooldown=UPSTREAM_BREAKER_COOLDOWN,
+    ):
+        self.host = host
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate) if rate > 0 else 0
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.increase = increase
+        self.decrease = decrease
+        self.max_wait = max_wait
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+
+        self._lock = threading.Lock()
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+        # Retry-After from the host, nothing is sent before this
+        self.blocked_until = 0.0
+        self._next_decrease = 0.0
+        # closed -> open after breaker_failures failures in a row -> half_open
+        # after the cooldown, where a single probe decides
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.throttled = 0
+        self.rejected = 0
+
+    def _busy(self, retry_after, reason):
+        self.rejected += 1
+        metrics.UPSTREAM_REJECTED.inc(host=self.host, reason=reason)
+        return UpstreamBusy(self.host, retry_after, reason)
+
+    def reserve(self, max_wait=None):
+        # Takes a slot and returns how long to sleep before sending, or raises
+        # UpstreamBusy if the breaker is open or the wait is too long
+        max_wait = self.max_wait if max_wait is None else max_wait
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                reopen_at = self._opened_at + self.breaker_cooldown
+                if now < reopen_at:
+                    raise self._busy(reopen_at - now, "circuit open")
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open":
+                if self._probing:
+                    raise self._busy(self.breaker_cooldown, "circuit half-open")
+                self._probing = True
+
+            wait = max(0.0, self.blocked_until - now)
+            if self.rate > 0:
+                self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+
+            if wait > max_wait:
+                if self.rate > 0:
+                    self.tokens += 1
+                self._probing = False
+                raise self._busy(wait, "rate limited")
+        if wait > 0:
+            metrics.UPSTREAM_WAIT_SECONDS.observe(wait, host=self.host)
+        return wait
+
+    def acquire(self, max_wait=None):
+        delay = self.reserve(max_wait)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, max_wait=None):
+        delay = self.reserve(max_wait)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def record(self, status, retry_after=None):
+        # status is the HTTP status, None for connection errors and timeouts
+        retry_after = parse_retry_after(retry_after)
+        with self._lock:
+            now = time.monotonic()
+            throttled = status == 429 or (status == 503 and retry_after is not None)
+            if throttled:
+                self.throttled += 1
+                if retry_after is not None:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+                if self.rate > 0 and now >= self._next_decrease:
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self.tokens = min(self.tokens, 0.0)
+                    self._next_decrease = now + DECREASE_INTERVAL
+                    log.warning("%s throttled us, rate now %.1f/s", self.host, self.rate)
+
+            # A 429 means the host is up and pacing us, which the rate cut
+            # and Retry-After handle, so only errors count toward the breaker
+            if status is None or status >= 500:
+                self.failures += 1
+                if self.state == "half_open" or self.failures >= self.breaker_failures:
+                    if self.state != "open":
+                        log.warning(
+                            "Circuit to %s open for %.0fs after %d failures",
+                            self.host, self.breaker_cooldown, self.failures,
+                        )
+                    self.state = "open"
+                    self._opened_at = now
+                    self._probing = False
+                return
+            if throttled:
+                # Neither a failure nor a success, a half-open probe is retried
+                self._probing = False
+                return
+
+            # Any other answer (including 404 for a missing tile) means the
+            # host is keeping up
+            self.failures = 0
+            if self.state == "half_open":
+                log.info("Circuit to %s closed", self.host)
+                self.state = "closed"
+                self._probing = False
+            if self.rate > 0:
+                self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def retry_after(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "open":
+                return self._opened_at + self.breaker_cooldown - now
+            return max(self.blocked_until - now, 1.0 / self.rate if self.rate > 0 else 0.0)
+
+    def busy(self, reason):
+        # For callers that ran out of retries on 429s
+        return self._busy(self.retry_after(), reason)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "rate": round(self.rate, 3),
+                "max_rate": self.max_rate,
+                "tokens": round(self.tokens, 3),
+                "blocked_for": round(max(0.0, self.blocked_until - time.monotonic()), 3),
+                "failures": self.failures,
+                "throttled": self.throttled,
+                "rejected": self.rejected,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(url):
+    # One limiter per upstream host and process
+    host = urlsplit(url).netloc
+    key = (os.getpid(), host)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = HostLimiter(host)
+    return limiter
+
+
+def stats():
+    pid = os.getpid()
+    with _limiters_lock:
+        limiters = [(host, limiter) for (owner, host), limiter in _limiters.items() if owner == pid]
+    return {host: limiter.stats() for host, limiter in limiters}
+
+
+def wait_out(fn, *args, attempts=UPSTREAM_BULK_ATTEMPTS, **kwargs):
+    # For bulk sweeps: sleep through busy periods instead of failing, so a
+    # sweep runs as fast as the upstream allows and no faster
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except UpstreamBusy as error:
+            if attempt == attempts - 1:
+                raise
+            log.info("%s, waiting", error)
+            time.sleep(error.retry_after)
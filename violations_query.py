@@ -0,0 +1,242 @@
+import datetime
+import os
+import threading
+import time
+
+import numpy as np
+import shapely
+
+import db
+
+# Viewport queries over stored violations. With PostGIS the bbox filter runs
+# against a GiST expression index on the lat/lon columns; without it a local
+# R-tree (shapely STRtree over every violation's point) picks candidate ids
+# and Postgres only filters those by primary key.
+
+VIOLATIONS_PAGE_SIZE = int(os.getenv("VIOLATIONS_PAGE_SIZE", 200))
+VIOLATIONS_MAX_PAGE_SIZE = int(os.getenv("VIOLATIONS_MAX_PAGE_SIZE", 1000))
+# How often the local R-tree picks up new and updated rows, and fully reloads
+VIOLATIONS_INDEX_REFRESH = float(os.getenv("VIOLATIONS_INDEX_REFRESH", 5))
+VIOLATIONS_INDEX_RELOAD = float(os.getenv("VIOLATIONS_INDEX_RELOAD", 600))
+# Most R-tree candidate ids sent to Postgres in one statement
+VIOLATIONS_CANDIDATE_BATCH = int(os.getenv("VIOLATIONS_CANDIDATE_BATCH", 1000))
+
+RECORD_COLUMNS = (
+    "id",
+    "description",
+    "latitude",
+    "longitude",
+    "county",
+    "severity",
+    "status",
+    "change_percent",
+    "loss_area_m2",
+    "before_img_key",
+    "after_img_key",
+)
+
+POSTGIS_POINT = db.POSTGIS_POINT
+
+# Rows committed late can carry an updated_at older than the newest one
+# already seen, so each refresh looks back this far again
+UPDATE_OVERLAP = datetime.timedelta(seconds=30)
+
+
+class QueryError(Exception):
+    pass
+
+
+class LocalSpatialIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ids = np.empty(0, dtype=np.int64)
+        self.points = np.empty((0, 2), dtype=np.float64)
+        self.tree = None
+        self.max_id = 0
+        self.updated_after = None
+        self.refreshed_at = 0.0
+        self.reloaded_at = 0.0
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self.refreshed_at < VIOLATIONS_INDEX_REFRESH:
+            return
+        with self._lock:
+            if now - self.refreshed_at < VIOLATIONS_INDEX_REFRESH:
+                return
+
+            full = now - self.reloaded_at >= VIOLATIONS_INDEX_RELOAD or self.updated_after is None
+            query = """
+            SELECT id, longitude, latitude, updated_at FROM violations
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            """
+            params = ()
+            if not full:
+                # New rows, and rescans that may have moved an existing one
+                query += " AND (id > %s OR updated_at > %s)"
+                params = (self.max_id, self.updated_after - UPDATE_OVERLAP)
+            with db.connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(query + " ORDER BY id", params)
+                    rows = cursor.fetchall()
+
+            if full:
+                self.ids = np.empty(0, dtype=np.int64)
+                self.points = np.empty((0, 2), dtype=np.float64)
+                self.reloaded_at = now
+
+            changed = full
+            if rows:
+                ids = np.array([row[0] for row in rows], dtype=np.int64)
+                points = np.array([row[1:3] for row in rows], dtype=np.float64)
+                updated = [row[3] for row in rows if row[3] is not None]
+                if updated:
+                    newest = max(updated)
+                    if self.updated_after is None or newest > self.updated_after:
+                        self.updated_after = newest
+
+                positions = np.searchsorted(self.ids, ids)
+                known = positions < len(self.ids)
+                known[known] = self.ids[positions[known]] == ids[known]
+                moved = known.copy()
+                moved[known] = np.any(self.points[positions[known]] != points[known], axis=1)
+                if moved.any():
+                    self.points[positions[moved]] = points[moved]
+                    changed = True
+                if not known.all():
+                    ids = np.concatenate((self.ids, ids[~known]))
+                    points = np.concatenate((self.points, points[~known]))
+                    order = np.argsort(ids, kind="stable")
+                    self.ids, self.points = ids[order], points[order]
+                    changed = True
+                if len(self.ids):
+                    self.max_id = int(self.ids[-1])
+            if self.updated_after is None:
+                # Empty table, anything that arrives later is picked up by id
+                self.updated_after = datetime.datetime.now(datetime.timezone.utc)
+
+            if changed:
+                # STRtree is immutable, rebuilding from packed arrays is cheap
+                self.tree = shapely.STRtree(shapely.points(self.points))
+            self.refreshed_at = now
+
+    def query(self, min_lon, min_lat, max_lon, max_lat):
+        # Sorted ids of the violations inside the box
+        self.refresh()
+        tree, ids = self.tree, self.ids
+        if tree is None or len(ids) == 0:
+            return np.empty(0, dtype=np.int64)
+        hits = tree.query(shapely.box(min_lon, min_lat, max_lon, max_lat))
+        return np.sort(ids[hits])
+
+
+_local_index = LocalSpatialIndex()
+_postgis = None
+_postgis_lock = threading.Lock()
+
+
+def has_postgis():
+    # Checked once per process, the GiST index comes with the schema migrations
+    global _postgis
+    if _postgis is None:
+        with _postgis_lock:
+            if _postgis is None:
+                with db.connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(
+                            "SELECT 1 FROM pg_extension WHERE extname = 'postgis'"
+                        )
+                        _postgis = cursor.fetchone() is not None
+    return _postgis
+
+
+def parse_bbox(value):
+    # min_lon,min_lat,max_lon,max_lat (GeoJSON/WMS order)
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in value.split(","))
+    except (AttributeError, ValueError):
+        raise QueryError("bbox must be min_lon,min_lat,max_lon,max_lat")
+    if min_lon > max_lon or min_lat > max_lat:
+        raise QueryError("bbox minimums must not exceed maximums")
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def query_violations(
+    bbox=None,
+    county=None,
+    status=None,
+    min_severity=None,
+    max_severity=None,
+    after_id=None,
+    limit=VIOLATIONS_PAGE_SIZE,
+):
+    # Keyset pagination on id: pass the returned next_cursor as after_id
+    limit = max(1, min(int(limit), VIOLATIONS_MAX_PAGE_SIZE))
+    clauses = []
+    params = []
+    candidate_ids = None
+
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        if has_postgis():
+            clauses.append(f"{POSTGIS_POINT} && ST_MakeEnvelope(%s, %s, %s, %s, 4326)")
+            params.extend([min_lon, min_lat, max_lon, max_lat])
+        else:
+            candidate_ids = _local_index.query(min_lon, min_lat, max_lon, max_lat)
+            if after_id is not None:
+                candidate_ids = candidate_ids[candidate_ids > after_id]
+            if len(candidate_ids) == 0:
+                return {"items": [], "next_cursor": None}
+            # Filled in per batch of candidates below
+            clauses.append("id = ANY(%s)")
+    if county:
+        clauses.append("county = %s")
+        params.append(county)
+    if status:
+        clauses.append("status = %s")
+        params.append(status)
+    if min_severity is not None:
+        clauses.append("severity >= %s")
+        params.append(min_severity)
+    if max_severity is not None:
+        clauses.append("severity <= %s")
+        params.append(max_severity)
+    if after_id is not None:
+        clauses.append("id > %s")
+        params.append(after_id)
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    query = f"""
+    SELECT {", ".join(RECORD_COLUMNS)} FROM violations
+    {where}
+    ORDER BY id
+    LIMIT %s
+    """
+
+    with db.connection() as conn:
+        with conn.cursor() as cursor:
+            if candidate_ids is None:
+                cursor.execute(query, params + [limit + 1])
+                rows = cursor.fetchall()
+            else:
+                # Candidates go in id order, a batch at a time, until the
+                # page (plus one row to know there is more) is full
+                rows = []
+                batch = max(limit + 1, VIOLATIONS_CANDIDATE_BATCH)
+                for start in range(0, len(candidate_ids), batch):
+                    chunk = candidate_ids[start:start + batch].tolist()
+                    cursor.execute(query, [chunk] + params + [limit + 1 - len(rows)])
+                    rows.extend(cursor.fetchall())
+                    if len(rows) > limit:
+                        break
+
+    items = []
+    for row in rows[:limit]:
+        record = dict(zip(RECORD_COLUMNS, row))
+        for column in ("before_img_key", "after_img_key"):
+            key = record.pop(column)
+            record[column.replace("_key", "_url")] = f"/images/{key}" if key else None
+        items.append(record)
+
+    next_cursor = items[-1]["id"] if len(rows) > limit else None
+    return {"items": items, "next_cursor": next_cursor}
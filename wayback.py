@@ -0,0 +1,212 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+import tile_cache
+import upstream_limiter
+
+# Settings are read at import, whichever module imports this first
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+WAYBACK_URL = os.getenv(
+    "WAYBACK_URL",
+    "https://wayback.maptiles.arcgis.com/arcgis/rest/services/World_Imagery/MapServer/tile",
+)
+WAYBACK_TIMEOUT = float(os.getenv("WAYBACK_TIMEOUT", 10))
+WAYBACK_RETRIES = int(os.getenv("WAYBACK_RETRIES", 3))
+WAYBACK_BACKOFF = float(os.getenv("WAYBACK_BACKOFF", 0.3))
+WAYBACK_MAX_WORKERS = int(os.getenv("WAYBACK_MAX_WORKERS", 8))
+
+# All known releases, newest first. Only the ones listed in WAYBACK_RELEASES
+# (comma separated dates) are fetched for a scan.
+RELEASES = {
+    "2024-03-07": "60013",
+    "2023-06-13": "25982",
+    "2023-02-23": "57965",
+    "2017-10-04": "15212",
+    "2016-10-25": "4222",
+}
+DEFAULT_RELEASES = "2024-03-07,2023-02-23"
+
+
+class TileFetchError(Exception):
+    # The tile couldn't be fetched right now (connection error, timeout or an
+    # error status), unlike a 404 for a tile the release doesn't have
+    pass
+
+
+HEADERS = {
+    "Referer": "https://livingatlas.arcgis.com/",
+    "Origin": "https://livingatlas.arcgis.com",
+    "sec-ch-ua": '"Not)A;Brand";v="99", "Google Chrome";v="127", "Chromium";v="127"',
+    "sec-ch-ua-mobile": "?0",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36",
+    "sec-ch-ua-platform": '"Windows"',
+}
+
+
+def parse_releases(years):
+    years_versions = {}
+    for year in years.split(","):
+        year = year.strip()
+        if not year:
+            continue
+        # Allow raw "date:version" pairs for releases not in RELEASES yet
+        if ":" in year:
+            year, version = year.split(":", 1)
+            years_versions[year] = version
+        elif year in RELEASES:
+            years_versions[year] = RELEASES[year]
+        else:
+            raise ValueError(
+                f"Unknown Wayback release {year!r} in WAYBACK_RELEASES, use one of "
+                f"{', '.join(RELEASES)} or a date:version pair"
+            )
+    return years_versions
+
+
+# Checked once here so a typo stops the server at startup instead of failing
+# every scan
+ENABLED_RELEASES = parse_releases(os.getenv("WAYBACK_RELEASES", DEFAULT_RELEASES))
+
+
+def enabled_releases():
+    return dict(ENABLED_RELEASES)
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    # One keep-alive session per process, sized so every worker gets a pooled
+    # connection instead of opening a new TCP/TLS connection per tile
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                retry = Retry(
+                    total=WAYBACK_RETRIES,
+                    backoff_factor=WAYBACK_BACKOFF,
+                    status_forcelist=(500, 502, 503, 504),
+                    allowed_methods=("GET",),
+                    raise_on_status=False,
+                    # 429s and Retry-After belong to upstream_limiter
+                    respect_retry_after_header=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=WAYBACK_MAX_WORKERS,
+                    pool_maxsize=WAYBACK_MAX_WORKERS,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.headers.update(HEADERS)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+                _session_pid = os.getpid()
+    return _session
+
+
+def tile_url(version, zoom, x, y):
+    return f"{WAYBACK_URL}/{version}/{zoom}/{y}/{x}"
+
+
+def fetch_tile(version, zoom, x, y, strict=False):
+    # Tile bytes, or None if the tile is missing or couldn't be fetched. With
+    # strict, a failed fetch raises TileFetchError so it can be retried.
+    cache = tile_cache.get_default_cache()
+    if cache is not None:
+        cached = cache.get(version, zoom, x, y)
+        if cached is not None:
+            metrics.CACHE_REQUESTS.inc(cache="tile", result="hit")
+            return cached
+        metrics.CACHE_REQUESTS.inc(cache="tile", result="miss")
+
+    # Cached tiles never touch the limiter, so they are still served while
+    # the upstream is throttling us or the circuit is open
+    url = tile_url(version, zoom, x, y)
+    limiter = upstream_limiter.get_limiter(url)
+
+    # 429s are retried here rather than by urllib3 so every attempt goes
+    # through the limiter, which waits out Retry-After
+    for _ in range(WAYBACK_RETRIES + 1):
+        limiter.acquire()
+        log.debug("GET %s", url)
+        try:
+            response = get_session().get(url, timeout=WAYBACK_TIMEOUT)
+        except requests.RequestException as error:
+            limiter.record(None)
+            metrics.UPSTREAM_RESPONSES.inc(upstream="wayback", status="error")
+            log.warning("Error fetching %s: %s", url, error)
+            if strict:
+                raise TileFetchError(f"Error fetching {url}: {error}") from error
+            return None
+
+        limiter.record(response.status_code, response.headers.get("Retry-After"))
+        metrics.UPSTREAM_RESPONSES.inc(upstream="wayback", status=response.status_code)
+        if response.status_code != 429:
+            break
+    else:
+        raise limiter.busy("rate limited by upstream")
+
+    if response.status_code == 200:
+        if cache is not None:
+            cache.put(version, zoom, x, y, response.content)
+        return response.content
+    if strict and response.status_code != 404:
+        raise TileFetchError(f"{url} returned {response.status_code}")
+    return None
+
+
+_executor = None
+_executor_pid = None
+
+
+def get_executor():
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        with _session_lock:
+            if _executor is None or _executor_pid != os.getpid():
+                _executor = ThreadPoolExecutor(
+                    max_workers=WAYBACK_MAX_WORKERS, thread_name_prefix="wayback"
+                )
+                _executor_pid = os.getpid()
+    return _executor
+
+
+def fetch_tiles(requests_by_key, failed=None):
+    # requests_by_key maps any key to a (version, zoom, x, y) tuple, all tiles
+    # are fetched concurrently and returned under the same keys. Given a set
+    # as `failed`, keys whose fetch failed (rather than being missing) are
+    # added to it.
+    with metrics.span("fetch"):
+        executor = get_executor()
+        futures = {
+            key: executor.submit(fetch_tile, *tile, strict=failed is not None)
+            for key, tile in requests_by_key.items()
+        }
+        tiles = {}
+        for key, future in futures.items():
+            try:
+                tiles[key] = future.result()
+            except TileFetchError:
+                failed.add(key)
+                tiles[key] = None
+        return tiles
+
+
+def fetch_releases(years_versions, zoom, x, y):
+    return fetch_tiles(
+        {year: (version, zoom, x, y) for year, version in years_versions.items()}
+    )